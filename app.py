@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Flask implementation of the Image Service API.
+
+Serves the same routes as API Gateway by calling the Lambda handlers
+in-process through a thin event adapter, so both deployments share one code
+path. Run it under gunicorn for the container deployment:
+
+    gunicorn -c gunicorn.conf.py app:app
+"""
+import base64
+import importlib
+import json
+import os
+import sys
+
+from botocore.exceptions import ClientError
+from flask import Flask, Response, request
+
+REPO_ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, 'lambda_functions'))
+
+from setup_infrastructure import API_ROUTES, API_BINARY_MEDIA_TYPES, LAMBDA_FUNCTIONS
+from image_metadata import decode_item
+
+# API Gateway caps payloads at 10 MB; a base64 JSON upload of a 10 MB image is ~13.4 MB
+MAX_REQUEST_SIZE = 16 * 1024 * 1024
+# Downloads are copied from S3 to the client in chunks of this size
+STREAM_CHUNK_SIZE = 256 * 1024
+
+app = Flask(__name__)
+app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_SIZE
+
+ROUTED_FUNCTIONS = {route['function_name'] for route in API_ROUTES}
+HANDLER_MODULES = {
+    func_config['name']: importlib.import_module(func_config['handler'].split('.')[0])
+    for func_config in LAMBDA_FUNCTIONS
+    if func_config['name'] in ROUTED_FUNCTIONS
+}
+
+def json_response(status_code, data):
+    return Response(
+        json.dumps(data),
+        status=status_code,
+        headers={'Access-Control-Allow-Origin': '*'},
+        mimetype='application/json'
+    )
+
+def is_binary(content_type):
+    media_type = (content_type or '').split(';')[0].strip().lower()
+    for pattern in API_BINARY_MEDIA_TYPES + ['application/octet-stream']:
+        if pattern == '*/*':
+            # Only there so API Gateway passes compressed responses through
+            continue
+        if media_type == pattern or (pattern.endswith('/*') and media_type.startswith(pattern[:-1])):
+            return True
+    return False
+
+def build_event(path_parameters):
+    """Translate the current request into an API Gateway proxy event"""
+    body = request.get_data()
+    # The handlers read non-base64 bodies as latin-1 (binary) or UTF-8 text,
+    # which is what API Gateway passes; neither needs a base64 round trip
+    if is_binary(request.content_type):
+        body = body.decode('latin-1')
+    else:
+        body = body.decode('utf-8', errors='replace')
+    return {
+        'resource': request.url_rule.rule if request.url_rule else request.path,
+        'path': request.path,
+        'httpMethod': request.method,
+        'headers': dict(request.headers),
+        'queryStringParameters': request.args.to_dict() or None,
+        'pathParameters': path_parameters or None,
+        'body': body or None,
+        'isBase64Encoded': False
+    }
+
+def to_flask_response(result):
+    body = result.get('body') or ''
+    if result.get('isBase64Encoded'):
+        body = base64.b64decode(body)
+    return Response(body, status=result['statusCode'], headers=result.get('headers', {}))
+
+def iter_object(body):
+    try:
+        yield from body.iter_chunks(STREAM_CHUNK_SIZE)
+    finally:
+        body.close()
+
+def stream_download(image_id):
+    """Stream the object straight from S3 instead of read() + base64 in view_image"""
+    view_image = HANDLER_MODULES['view-image']
+    s3_client, dynamodb = view_image.get_clients()
+    response = dynamodb.Table(view_image.DYNAMODB_TABLE).get_item(Key={'image_id': image_id})
+    if 'Item' not in response:
+        return json_response(404, {'error': 'Image not found'})
+    metadata = decode_item(response['Item'])
+    try:
+        s3_response = s3_client.get_object(Bucket=view_image.S3_BUCKET, Key=metadata['s3_key'])
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchKey':
+            return json_response(404, {'error': 'Image file not found in storage'})
+        raise
+    return Response(
+        iter_object(s3_response['Body']),
+        headers={
+            'Content-Type': s3_response['ContentType'],
+            'Content-Length': str(s3_response['ContentLength']),
+            'Content-Disposition': f'attachment; filename="{metadata["filename"]}"',
+            'Access-Control-Allow-Origin': '*'
+        },
+        direct_passthrough=True
+    )
+
+def make_view(route):
+    handler_module = HANDLER_MODULES[route['function_name']]
+
+    def view(**path_parameters):
+        if (route['function_name'] == 'view-image'
+                and request.args.get('download', 'false').lower() == 'true'
+                and request.args.get('metadata_only', 'false').lower() != 'true'):
+            return stream_download(path_parameters['image_id'])
+        return to_flask_response(handler_module.lambda_handler(build_event(path_parameters), None))
+
+    return view
+
+for route in API_ROUTES:
+    rule = route['path'].replace('{', '<').replace('}', '>')
+    app.add_url_rule(
+        rule,
+        endpoint=f"{route['method']} {route['path']}",
+        view_func=make_view(route),
+        methods=[route['method']]
+    )
+
+@app.errorhandler(404)
+def not_found(error):
+    return json_response(404, {'error': 'Not found'})
+
+@app.errorhandler(405)
+def method_not_allowed(error):
+    return json_response(405, {'error': 'Method not allowed'})
+
+@app.errorhandler(413)
+def request_too_large(error):
+    return json_response(413, {'error': 'Request body too large'})
+
+# Create every handler's clients up front. Each gunicorn worker imports the app
+# after forking, so clients are never shared across processes.
+for handler_module in HANDLER_MODULES.values():
+    if hasattr(handler_module, 'get_clients'):
+        handler_module.get_clients()
+    elif hasattr(handler_module, 'get_dynamodb'):
+        handler_module.get_dynamodb()
+
+if __name__ == "__main__":
+    app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 8000)))
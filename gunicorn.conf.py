@@ -0,0 +1,19 @@
+"""
+gunicorn settings for the Flask deployment (`gunicorn -c gunicorn.conf.py app:app`).
+Every setting can be overridden from the environment.
+"""
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+# Sync workers: the handlers share boto3 resources, which are not thread-safe,
+# so concurrency comes from processes rather than threads
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'sync'
+# Match the Lambda timeout so both deployments fail slow requests the same way
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+keepalive = 5
+# Load the app in each worker after fork; boto3 clients must not cross processes
+preload_app = False
+accesslog = '-'
+errorlog = '-'
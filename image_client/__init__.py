@@ -0,0 +1,13 @@
+"""
+Python client for the Image Service API.
+
+    from image_client import ImageClient
+
+    with ImageClient('http://localhost:8000') as client:
+        image = client.upload('photo.png', user_id='user123', tags=['demo'])
+        for item in client.list(user_id='user123'):
+            print(item['image_id'])
+"""
+from image_client.client import ImageClient, ImageServiceError
+
+__all__ = ['ImageClient', 'ImageServiceError']
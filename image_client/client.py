@@ -0,0 +1,205 @@
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_TIMEOUT = (5, 30)
+DEFAULT_MAX_WORKERS = 8
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+# Statuses worth retrying: throttling and transient server/gateway errors
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+class ImageServiceError(Exception):
+    """A non-2xx response from the API"""
+
+    def __init__(self, status_code, message, response=None):
+        super().__init__(f"{status_code}: {message}")
+        self.status_code = status_code
+        self.message = message
+        self.response = response
+
+class ImageClient:
+    """
+    Client for the Image Service API.
+
+    One pooled, keep-alive `requests.Session` is shared by every call,
+    including the worker threads of the bulk methods, so bulk operations
+    reuse up to `max_workers` connections instead of opening one per request.
+    GET and DELETE are retried with exponential backoff on 429/5xx. Uploads
+    carry an Idempotency-Key and are retried the same way, and also on
+    timeouts and while the server is still running an earlier attempt: the
+    server replays the stored result instead of storing the image twice.
+    """
+
+    def __init__(self, base_url, max_workers=DEFAULT_MAX_WORKERS, retries=3, backoff_factor=0.3,
+                 timeout=DEFAULT_TIMEOUT):
+        self.base_url = base_url.rstrip('/')
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset(['GET', 'HEAD', 'DELETE']),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _request(self, method, path, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        response = self.session.request(method, f"{self.base_url}{path}", **kwargs)
+        if not response.ok:
+            try:
+                message = response.json().get('error', response.text)
+            except ValueError:
+                message = response.text
+            raise ImageServiceError(response.status_code, message, response)
+        return response
+
+    def _retry_delay(self, attempt, response=None):
+        """Seconds to wait before retry `attempt`: Retry-After when given, else exponential backoff"""
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return int(retry_after)
+        return self.backoff_factor * (2 ** attempt)
+
+    def upload(self, image, user_id, title='', description='', tags=None, filename=None,
+               content_type='application/octet-stream', reject_duplicates=False, idempotency_key=None):
+        """
+        Upload an image as multipart/form-data. `image` is a path, bytes or a
+        binary file object. Returns the API response (image_id, metadata).
+        With reject_duplicates, a near-duplicate of one of the user's images
+        raises ImageServiceError with status 409.
+        Every attempt of one call sends the same Idempotency-Key (a new UUID
+        unless `idempotency_key` is given), so a retry whose predecessor was
+        stored gets the original response back.
+        """
+        if isinstance(image, (str, os.PathLike)):
+            filename = filename or os.path.basename(image)
+            with open(image, 'rb') as f:
+                return self.upload(f, user_id, title, description, tags, filename, content_type,
+                                   reject_duplicates, idempotency_key)
+        if not filename:
+            raise ValueError('filename is required when uploading bytes or a file object')
+
+        fields = [('user_id', user_id), ('title', title), ('description', description)]
+        fields.extend(('tags', tag) for tag in tags or [])
+        headers = {'Idempotency-Key': idempotency_key or str(uuid.uuid4())}
+        # A file object is rewound for each attempt; one that cannot be is sent once
+        position = image.tell() if hasattr(image, 'seekable') and image.seekable() else None
+        attempts = self.retries + 1 if isinstance(image, (bytes, bytearray)) or position is not None else 1
+        for attempt in range(attempts):
+            if position is not None:
+                image.seek(position)
+            try:
+                response = self._request(
+                    'POST', '/images',
+                    params={'reject_duplicates': 'true'} if reject_duplicates else None,
+                    headers=headers,
+                    data=fields,
+                    files={'image': (filename, image, content_type)}
+                )
+                return response.json()
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == attempts - 1:
+                    raise
+                delay = self._retry_delay(attempt)
+            except ImageServiceError as e:
+                # A 409 with Retry-After is an earlier attempt still running;
+                # other 409s (near-duplicates) are final
+                in_progress = e.status_code == 409 and 'Retry-After' in e.response.headers
+                if attempt == attempts - 1 or not (in_progress or e.status_code in RETRY_STATUSES):
+                    raise
+                delay = self._retry_delay(attempt, e.response)
+            time.sleep(delay)
+
+    def list(self, page_size=50, **filters):
+        """
+        Iterate over images matching `filters` (user_id, tags, date_from,
+        date_to, title, format, min_width, ..., summary=True), newest first.
+        Further pages are fetched only as the iterator is consumed.
+        """
+        params = {name: value for name, value in filters.items() if value is not None}
+        params['limit'] = page_size
+        while True:
+            page = self._request('GET', '/images', params=params).json()
+            yield from page['images']
+            if not page.get('next_token'):
+                return
+            params['next_token'] = page['next_token']
+
+    def get(self, image_id):
+        """Return an image's metadata"""
+        response = self._request('GET', f"/images/{image_id}", params={'metadata_only': 'true'})
+        return response.json()['metadata']
+
+    def similar(self, image_id, max_distance=None, limit=None):
+        """The user's images that look like this one, nearest first, each with its `distance`"""
+        params = {'max_distance': max_distance, 'limit': limit}
+        response = self._request(
+            'GET', f"/images/{image_id}/similar",
+            params={name: value for name, value in params.items() if value is not None}
+        )
+        return response.json()['images']
+
+    def download_to(self, image_id, path):
+        """Stream an image to `path` without holding it in memory; returns bytes written"""
+        written = 0
+        with self._request('GET', f"/images/{image_id}", params={'download': 'true'}, stream=True) as response:
+            with open(path, 'wb') as f:
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+                    written += len(chunk)
+        return written
+
+    def delete(self, image_id, user_id):
+        return self._request('DELETE', f"/images/{image_id}", json={'user_id': user_id}).json()
+
+    def _fan_out(self, function, items, progress):
+        """
+        Run function(item) for every item on a bounded thread pool. Returns
+        results in input order; a failed item's slot holds its exception.
+        progress(done, total, item, result) is called as each item finishes.
+        """
+        results = [None] * len(items)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(function, item): index for index, item in enumerate(items)}
+            for done, future in enumerate(as_completed(futures), 1):
+                index = futures[future]
+                try:
+                    results[index] = future.result()
+                except (ImageServiceError, requests.RequestException, OSError) as e:
+                    results[index] = e
+                if progress:
+                    progress(done, len(items), items[index], results[index])
+        return results
+
+    def upload_many(self, uploads, progress=None):
+        """
+        Upload concurrently. `uploads` is a list of dicts of `upload()`
+        keyword arguments; see `_fan_out` for the result format.
+        """
+        return self._fan_out(lambda kwargs: self.upload(**kwargs), list(uploads), progress)
+
+    def delete_many(self, image_ids, user_id, progress=None):
+        """Delete concurrently; see `_fan_out` for the result format"""
+        return self._fan_out(lambda image_id: self.delete(image_id, user_id), list(image_ids), progress)
@@ -0,0 +1,46 @@
+import os
+
+import boto3
+
+LOCALSTACK_ENDPOINT = os.environ.get('LOCALSTACK_ENDPOINT', 'http://localhost:4566')
+
+# One session per container, shared by every handler loaded into it, so each
+# service model is loaded and each connection pool opened only once
+_session = None
+_services = {}
+
+def get_session():
+    global _session
+    if _session is None:
+        _session = boto3.session.Session(
+            aws_access_key_id='test',
+            aws_secret_access_key='test',
+            region_name='us-east-1'
+        )
+    return _session
+
+def get_client(service_name):
+    """Return the container's client for a service, creating it on first use"""
+    key = ('client', service_name)
+    if key not in _services:
+        _services[key] = get_session().client(service_name, endpoint_url=LOCALSTACK_ENDPOINT)
+    return _services[key]
+
+def get_resource(service_name):
+    """Return the container's resource for a service, creating it on first use"""
+    key = ('resource', service_name)
+    if key not in _services:
+        _services[key] = get_session().resource(service_name, endpoint_url=LOCALSTACK_ENDPOINT)
+    return _services[key]
+
+def prewarm(*factories):
+    """
+    Call each factory at import time when running in Lambda, which sets
+    AWS_LAMBDA_FUNCTION_NAME. Handlers pass the functions that create their
+    clients, so that work happens during the init phase rather than on the
+    first request. Elsewhere (tools, tests, the Flask server) nothing is
+    created until first use.
+    """
+    if os.environ.get('AWS_LAMBDA_FUNCTION_NAME'):
+        for factory in factories:
+            factory()
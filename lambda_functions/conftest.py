@@ -0,0 +1,81 @@
+import base64
+import io
+import json
+import os
+
+import boto3
+import pytest
+from moto import mock_dynamodb, mock_s3, mock_sqs
+
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'test')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'test')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import aws_clients
+import setup_infrastructure as infra
+
+@pytest.fixture
+def aws(monkeypatch):
+    """
+    The service's buckets, tables and queues in moto, with the handlers'
+    shared clients pointed at it instead of LocalStack
+    """
+    with mock_dynamodb(), mock_s3(), mock_sqs():
+        dynamodb_client = boto3.client('dynamodb', region_name=infra.AWS_REGION)
+        infra.create_s3_bucket(boto3.client('s3', region_name=infra.AWS_REGION))
+        infra.create_dynamodb_table(dynamodb_client)
+        infra.create_user_stats_table(dynamodb_client)
+        infra.create_idempotency_table(dynamodb_client)
+        infra.create_processing_queues(boto3.client('sqs', region_name=infra.AWS_REGION))
+        monkeypatch.setattr(aws_clients, 'LOCALSTACK_ENDPOINT', None)
+        monkeypatch.setattr(aws_clients, '_session', None)
+        monkeypatch.setattr(aws_clients, '_services', {})
+        # moto applies a query's Limit before ordering by the sort key, so a
+        # descending page holds the oldest items; unlimited queries come back
+        # in order, and the handlers' lazy paging reads them the same way
+        aws_clients.get_session().events.register('provide-client-params.dynamodb.Query', drop_query_limit)
+        yield boto3.resource('dynamodb', region_name=infra.AWS_REGION)
+
+def drop_query_limit(params, **kwargs):
+    params.pop('Limit', None)
+
+@pytest.fixture
+def concurrent_write(aws):
+    """
+    Run a write right before the handler's next transactions, as a
+    concurrent request would between its read and its write.
+    concurrent_write(fn, times=1) runs fn before that many transactions.
+    """
+    client = aws_clients.get_resource('dynamodb').meta.client
+    pending = []
+
+    def before_transaction(**kwargs):
+        if pending:
+            pending.pop()()
+
+    client.meta.events.register('before-call.dynamodb.TransactWriteItems', before_transaction)
+
+    def schedule(fn, times=1):
+        pending.extend([fn] * times)
+    yield schedule
+    client.meta.events.unregister('before-call.dynamodb.TransactWriteItems', before_transaction)
+
+def png_bytes(color='red'):
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new('RGB', (8, 8), color=color).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+def upload_event(user_id, color='red', idempotency_key=None, **fields):
+    """A JSON upload request as API Gateway passes it to upload-image"""
+    body = {
+        'user_id': user_id,
+        'filename': 'test.png',
+        'image_data': base64.b64encode(png_bytes(color)).decode('utf-8'),
+        **fields
+    }
+    headers = {'Content-Type': 'application/json'}
+    if idempotency_key is not None:
+        headers['Idempotency-Key'] = idempotency_key
+    return {'headers': headers, 'body': json.dumps(body)}
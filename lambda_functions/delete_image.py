@@ -1,30 +1,27 @@
 import json
-import boto3
+import base64
 import os
+from decimal import Decimal
 from botocore.exceptions import ClientError
+from aws_clients import get_client, get_resource, prewarm
+from image_metadata import (
+    USER_STATS_TABLE, RECENT_WRITE_ATTEMPTS, decode_item, usage_key, usage_update, remove_recent, set_recent
+)
 
 S3_BUCKET = os.environ.get('S3_BUCKET', 'image-storage-bucket')
 DYNAMODB_TABLE = os.environ.get('DYNAMODB_TABLE', 'image-metadata')
-LOCALSTACK_ENDPOINT = os.environ.get('LOCALSTACK_ENDPOINT', 'http://localhost:4566')
 
 def get_clients():
-    s3_client = boto3.client(
-        's3',
-        endpoint_url=LOCALSTACK_ENDPOINT,
-        aws_access_key_id='test',
-        aws_secret_access_key='test',
-        region_name='us-east-1'
-    )
-    
-    dynamodb = boto3.resource(
-        'dynamodb',
-        endpoint_url=LOCALSTACK_ENDPOINT,
-        aws_access_key_id='test',
-        aws_secret_access_key='test',
-        region_name='us-east-1'
-    )
-    
-    return s3_client, dynamodb
+    """Return AWS clients, shared with every other handler in the container"""
+    return get_client('s3'), get_resource('dynamodb')
+
+class DecimalEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, Decimal):
+            return int(obj) if obj % 1 == 0 else float(obj)
+        if isinstance(obj, set):
+            return sorted(obj)
+        return super(DecimalEncoder, self).default(obj)
 
 def lambda_handler(event, context):
 
@@ -33,7 +30,11 @@ def lambda_handler(event, context):
         table = dynamodb.Table(DYNAMODB_TABLE)
         image_id = event['pathParameters']['image_id']
         if event.get('body'):
-            body = json.loads(event['body'])
+            raw_body = event['body']
+            # With API_BINARY_MEDIA_TYPES '*/*' API Gateway passes every body base64 encoded
+            if event.get('isBase64Encoded', False):
+                raw_body = base64.b64decode(raw_body)
+            body = json.loads(raw_body)
             requesting_user_id = body.get('user_id')
         else:
             return {
@@ -60,7 +61,9 @@ def lambda_handler(event, context):
                 })
             }
         
-        metadata = response['Item']
+        metadata = decode_item(response['Item'])
+        # decode_item drops user_key, which names the item the counters are in
+        counter_key = usage_key(response['Item'])
         
         if metadata['user_id'] != requesting_user_id:
             return {
@@ -76,13 +79,66 @@ def lambda_handler(event, context):
         
         s3_key = metadata['s3_key']
 
+        # Remove the metadata, decrement the usage counters and drop the image
+        # from the recent list atomically; the condition makes a concurrent
+        # delete of the same image a no-op. Ownership was checked above
+        # (sharded items do not store user_id). Images of sharded users are
+        # counted in their shard's counter item and never in a recent list.
+        stats_table = dynamodb.Table(USER_STATS_TABLE)
+        stats_projection = {'ProjectionExpression': 'recent, recent_version'}
+        usage = {}
+        if counter_key == metadata['user_id']:
+            # Consistent, so an image uploaded just before is in the list read;
+            # a stale list would skip the update and leave the entry behind
+            usage = stats_table.get_item(
+                Key={'user_id': counter_key}, ConsistentRead=True, **stats_projection
+            ).get('Item', {})
+        for attempt in range(RECENT_WRITE_ATTEMPTS):
+            stats_update = usage_update(counter_key, metadata['content_type'], metadata['file_size'], delta=-1)
+            recent = usage.get('recent', [])
+            if any(entry['i'] == image_id for entry in recent):
+                # The last attempt drops the list rather than failing the delete
+                last_attempt = attempt == RECENT_WRITE_ATTEMPTS - 1
+                set_recent(stats_update, usage, None if last_attempt else remove_recent(recent, image_id))
+            try:
+                dynamodb.meta.client.transact_write_items(TransactItems=[
+                    {
+                        'Delete': {
+                            'TableName': DYNAMODB_TABLE,
+                            'Key': {'image_id': image_id},
+                            'ConditionExpression': 'attribute_exists(image_id)'
+                        }
+                    },
+                    stats_update
+                ])
+                break
+            except dynamodb.meta.client.exceptions.TransactionCanceledException as e:
+                reasons = e.response.get('CancellationReasons', [])
+                if reasons and reasons[0].get('Code') == 'ConditionalCheckFailed':
+                    return {
+                        'statusCode': 404,
+                        'headers': {
+                            'Content-Type': 'application/json',
+                            'Access-Control-Allow-Origin': '*'
+                        },
+                        'body': json.dumps({
+                            'error': 'Image not found'
+                        })
+                    }
+                if len(reasons) < 2 or reasons[1].get('Code') != 'ConditionalCheckFailed':
+                    raise
+                # Another upload or delete changed the recent list; re-read and retry
+                usage = stats_table.get_item(
+                    Key={'user_id': counter_key}, ConsistentRead=True, **stats_projection
+                ).get('Item', {})
+
         try:
             s3_client.delete_object(Bucket=S3_BUCKET, Key=s3_key)
+            if metadata.get('thumbnail_key'):
+                s3_client.delete_object(Bucket=S3_BUCKET, Key=metadata['thumbnail_key'])
         except ClientError as e:
             print(f"Warning: Failed to delete image from S3: {e}")
         
-        table.delete_item(Key={'image_id': image_id})
-        
         return {
             'statusCode': 200,
             'headers': {
@@ -93,7 +149,7 @@ def lambda_handler(event, context):
                 'message': 'Image deleted successfully',
                 'image_id': image_id,
                 'deleted_metadata': dict(metadata)
-            })
+            }, cls=DecimalEncoder)
         }
         
     except Exception as e:
@@ -109,3 +165,5 @@ def lambda_handler(event, context):
                 'details': str(e)
             })
         }
+
+prewarm(get_clients)
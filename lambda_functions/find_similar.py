@@ -0,0 +1,121 @@
+import json
+import os
+from decimal import Decimal
+from aws_clients import get_resource, prewarm
+from http_compression import compress_response
+from image_metadata import USER_STATS_TABLE, decode_item
+from image_similarity import DUPLICATE_MAX_DISTANCE, HASH_SIZE, get_user_index, parse_hash
+
+DYNAMODB_TABLE = os.environ.get('DYNAMODB_TABLE', 'image-metadata')
+MAX_RESULTS = 100
+
+def get_dynamodb():
+    """Return the DynamoDB resource, shared with every other handler in the container"""
+    return get_resource('dynamodb')
+
+class DecimalEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, Decimal):
+            return int(obj) if obj % 1 == 0 else float(obj)
+        if isinstance(obj, set):
+            return sorted(obj)
+        return super(DecimalEncoder, self).default(obj)
+
+def error_response(status_code, message):
+    return {
+        'statusCode': status_code,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*'
+        },
+        'body': json.dumps({
+            'error': message
+        })
+    }
+
+def fetch_items(dynamodb, image_ids):
+    """Metadata for up to 100 images by ID; images deleted since indexing are left out"""
+    items = {}
+    request = {DYNAMODB_TABLE: {'Keys': [{'image_id': image_id} for image_id in image_ids]}}
+    while request:
+        response = dynamodb.batch_get_item(RequestItems=request)
+        for item in response['Responses'].get(DYNAMODB_TABLE, []):
+            items[item['image_id']] = decode_item(item)
+        request = response.get('UnprocessedKeys')
+    return items
+
+def lambda_handler(event, context):
+    """
+    Images of the same user whose perceptual hash is within max_distance bits
+    of this image's, nearest first
+    """
+    try:
+        dynamodb = get_dynamodb()
+        table = dynamodb.Table(DYNAMODB_TABLE)
+        image_id = event['pathParameters']['image_id']
+        query_params = event.get('queryStringParameters') or {}
+        try:
+            max_distance = int(query_params.get('max_distance', DUPLICATE_MAX_DISTANCE))
+            limit = int(query_params.get('limit', 20))
+        except ValueError:
+            return error_response(400, 'max_distance and limit must be integers')
+        if not 0 <= max_distance <= HASH_SIZE * HASH_SIZE or not 1 <= limit <= MAX_RESULTS:
+            return error_response(400, f'max_distance must be 0-{HASH_SIZE * HASH_SIZE} and limit 1-{MAX_RESULTS}')
+
+        response = table.get_item(Key={'image_id': image_id})
+        if 'Item' not in response:
+            return error_response(404, 'Image not found')
+        image = decode_item(response['Item'])
+        if 'phash' not in image:
+            return error_response(409, 'Image has not been processed yet; retry shortly')
+
+        user_id = image['user_id']
+        stats = dynamodb.Table(USER_STATS_TABLE).get_item(
+            Key={'user_id': user_id},
+            ProjectionExpression='key_shards'
+        ).get('Item', {})
+        user_index = get_user_index(table, user_id, int(stats.get('key_shards', 0)))
+        # One extra match: the image itself is in the index at distance 0
+        matches = [
+            (match_id, distance)
+            for match_id, distance in user_index.search(parse_hash(image['phash']), max_distance, limit + 1)
+            if match_id != image_id
+        ][:limit]
+        items = fetch_items(dynamodb, [match_id for match_id, _ in matches]) if matches else {}
+        similar = [
+            dict(items[match_id], distance=distance)
+            for match_id, distance in matches
+            if match_id in items
+        ]
+
+        return compress_response(event, {
+            'statusCode': 200,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*'
+            },
+            'body': json.dumps({
+                'image_id': image_id,
+                'phash': image['phash'],
+                'max_distance': max_distance,
+                'images': similar,
+                'count': len(similar),
+                'indexed_images': len(user_index)
+            }, cls=DecimalEncoder)
+        })
+
+    except Exception as e:
+        print(f"Error finding similar images: {e}")
+        return {
+            'statusCode': 500,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*'
+            },
+            'body': json.dumps({
+                'error': 'Failed to find similar images',
+                'details': str(e)
+            })
+        }
+
+prewarm(get_dynamodb)
@@ -0,0 +1,87 @@
+import base64
+import gzip
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bodies smaller than this are sent as-is: the saving does not pay for the
+# CPU time and the Content-Encoding round trip.
+COMPRESSION_MIN_BYTES = int(os.environ.get('COMPRESSION_MIN_BYTES', 1024))
+# Levels picked with `python tools/benchmark.py compression`
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', 5))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', 4))
+
+def _gzip(data):
+    # mtime=0 keeps the output deterministic for identical bodies
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+def _brotli(data):
+    return brotli.compress(data, quality=BROTLI_QUALITY, mode=brotli.MODE_TEXT)
+
+# Preferred first when the client accepts several at the same q-value
+ENCODERS = {'gzip': _gzip}
+if brotli is not None:
+    ENCODERS = {'br': _brotli, 'gzip': _gzip}
+
+def accepted_encodings(headers):
+    """q-value per coding from the Accept-Encoding header (case-insensitive lookup)"""
+    value = ''
+    for key, header_value in (headers or {}).items():
+        if key.lower() == 'accept-encoding':
+            value = header_value or ''
+            break
+    accepted = {}
+    for part in value.split(','):
+        coding, _, params = part.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[coding] = q
+    return accepted
+
+def negotiate_encoding(headers):
+    """The content coding to respond with, or None for identity"""
+    accepted = accepted_encodings(headers)
+    best, best_q = None, 0.0
+    for coding in ENCODERS:
+        q = accepted.get(coding, accepted.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+def compress_response(event, response):
+    """
+    Compress a text (JSON) proxy response for clients that accept it. The
+    compressed body is returned base64 encoded with isBase64Encoded set, which
+    API Gateway decodes back to bytes (see API_BINARY_MEDIA_TYPES).
+    """
+    body = response.get('body')
+    if not body or response.get('isBase64Encoded'):
+        return response
+    response['headers'] = dict(response.get('headers') or {}, Vary='Accept-Encoding')
+    data = body.encode('utf-8')
+    if len(data) < COMPRESSION_MIN_BYTES:
+        return response
+    coding = negotiate_encoding(event.get('headers'))
+    if coding is None:
+        return response
+    compressed = ENCODERS[coding](data)
+    if len(compressed) >= len(data):
+        return response
+    response['headers']['Content-Encoding'] = coding
+    # Release the uncompressed body before the base64 copies of the
+    # compressed one are made; for an embedded image it is the largest object
+    del body, data, response['body']
+    response['body'] = base64.b64encode(compressed).decode('ascii')
+    response['isBase64Encoded'] = True
+    return response
@@ -0,0 +1,91 @@
+import hashlib
+import json
+import os
+import time
+
+from botocore.exceptions import ClientError
+
+IDEMPOTENCY_TABLE = os.environ.get('IDEMPOTENCY_TABLE', 'idempotency-keys')
+# How long a completed request is replayed for. DynamoDB TTL deletes expired
+# records some time later, so expiry is also checked when claiming.
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', 24 * 60 * 60))
+# An in-progress claim older than this belongs to a request that died
+# (timeout, crash) and may be taken over; above the function timeout
+IDEMPOTENCY_CLAIM_TIMEOUT = int(os.environ.get('IDEMPOTENCY_CLAIM_TIMEOUT', 60))
+MAX_KEY_LENGTH = 255
+
+def record_key(user_id, idempotency_key):
+    """Keys are scoped per user: two users may pick the same key"""
+    return f"{user_id}#{idempotency_key}"
+
+def request_fingerprint(upload):
+    """Hash of everything an upload stores, to tell a retry from a reused key"""
+    digest = hashlib.sha256(json.dumps(
+        [upload['user_id'], upload['filename'], upload['title'], upload['description'], upload['tags']]
+    ).encode('utf-8'))
+    digest.update(upload['image_bytes'])
+    return digest.hexdigest()
+
+def claim_key(table, key, fingerprint):
+    """
+    Claim a key for a new request with a conditional put. Returns None when
+    this request owns the key, otherwise the record of the request that does.
+    """
+    now = int(time.time())
+    try:
+        table.put_item(
+            Item={
+                'idempotency_key': key,
+                'status': 'in_progress',
+                'fingerprint': fingerprint,
+                'claimed_at': now,
+                'expires_at': now + IDEMPOTENCY_TTL_SECONDS
+            },
+            ConditionExpression=(
+                'attribute_not_exists(idempotency_key) OR expires_at < :now'
+                ' OR (#status = :in_progress AND claimed_at < :abandoned)'
+            ),
+            ExpressionAttributeNames={'#status': 'status'},
+            ExpressionAttributeValues={
+                ':now': now,
+                ':in_progress': 'in_progress',
+                ':abandoned': now - IDEMPOTENCY_CLAIM_TIMEOUT
+            }
+        )
+        return None
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+    existing = table.get_item(Key={'idempotency_key': key}, ConsistentRead=True).get('Item')
+    # Released between the put and the read: report it as still running so
+    # the client retries and claims it
+    return existing or {'status': 'in_progress', 'fingerprint': fingerprint}
+
+def complete_key(table, key, response):
+    """Store the response of a finished request for replay"""
+    now = int(time.time())
+    table.update_item(
+        Key={'idempotency_key': key},
+        UpdateExpression='SET #status = :completed, status_code = :status_code, response_body = :body, '
+                         'expires_at = :expires_at',
+        ExpressionAttributeNames={'#status': 'status'},
+        ExpressionAttributeValues={
+            ':completed': 'completed',
+            ':status_code': response['statusCode'],
+            ':body': response['body'],
+            ':expires_at': now + IDEMPOTENCY_TTL_SECONDS
+        }
+    )
+
+def release_key(table, key):
+    """Drop an in-progress claim so a retry runs the request again"""
+    try:
+        table.delete_item(
+            Key={'idempotency_key': key},
+            ConditionExpression='#status = :in_progress',
+            ExpressionAttributeNames={'#status': 'status'},
+            ExpressionAttributeValues={':in_progress': 'in_progress'}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
@@ -0,0 +1,116 @@
+import io
+import os
+
+# Largest accepted frame, in pixels. Headers claiming more are rejected before
+# any pixel data is decoded.
+MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS', 50 * 1000 * 1000))
+
+FORMAT_CONTENT_TYPES = {
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+    'GIF': 'image/gif',
+    'BMP': 'image/bmp',
+    'WEBP': 'image/webp'
+}
+
+FORMAT_EXTENSIONS = {
+    'JPEG': {'.jpg', '.jpeg'},
+    'PNG': {'.png'},
+    'GIF': {'.gif'},
+    'BMP': {'.bmp'},
+    'WEBP': {'.webp'}
+}
+
+# Pillow reports multi-picture JPEGs from some cameras as MPO
+PILLOW_FORMAT_ALIASES = {'MPO': 'JPEG'}
+
+class ImageValidationError(ValueError):
+    """The payload is not an acceptable image"""
+
+class _MemoryReader(io.RawIOBase):
+    """Seekable read-only file over a bytes-like object, without copying it"""
+
+    def __init__(self, data):
+        self._view = memoryview(data)
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = max(0, min(len(buffer), len(self._view) - self._pos))
+        buffer[:count] = self._view[self._pos:self._pos + count]
+        self._pos += count
+        return count
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._pos = max(0, offset)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self._view.release()
+        super().close()
+
+def sniff_format(data):
+    """Identify the image format from its magic bytes, or return None"""
+    header = bytes(data[:12])
+    if header.startswith(b'\xff\xd8\xff'):
+        return 'JPEG'
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'PNG'
+    if header.startswith((b'GIF87a', b'GIF89a')):
+        return 'GIF'
+    if header.startswith(b'BM'):
+        return 'BMP'
+    if header.startswith(b'RIFF') and header[8:12] == b'WEBP':
+        return 'WEBP'
+    return None
+
+def inspect_image(data):
+    """
+    Verify that data is a supported image and return its header properties:
+    format, content_type, width, height, mode and frame_count.
+
+    Only the header is parsed (Pillow opens images lazily), so the cost does
+    not grow with the pixel count.
+    """
+    sniffed_format = sniff_format(data)
+    if sniffed_format is None:
+        raise ImageValidationError('File content is not a supported image format')
+
+    from PIL import Image
+
+    with _MemoryReader(data) as reader:
+        try:
+            with Image.open(reader, formats=[sniffed_format]) as image:
+                width, height = image.size
+                if width * height > MAX_IMAGE_PIXELS:
+                    raise ImageValidationError(
+                        f'Image dimensions {width}x{height} exceed the {MAX_IMAGE_PIXELS} pixel limit'
+                    )
+                detected_format = PILLOW_FORMAT_ALIASES.get(image.format, image.format)
+                info = {
+                    'format': detected_format,
+                    'content_type': FORMAT_CONTENT_TYPES[detected_format],
+                    'width': width,
+                    'height': height,
+                    'mode': image.mode,
+                    'frame_count': getattr(image, 'n_frames', 1)
+                }
+        except ImageValidationError:
+            raise
+        except Image.DecompressionBombError as e:
+            raise ImageValidationError(str(e))
+        except (OSError, SyntaxError, ValueError):
+            raise ImageValidationError(f'Could not read {sniffed_format} image header')
+    return info
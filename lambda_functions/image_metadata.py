@@ -0,0 +1,286 @@
+import os
+
+# Every upload day is split into this many partitions of the recency index so
+# a busy day does not become a hot key. Readers query all shards, so the value
+# may be raised but must never be lowered.
+RECENCY_SHARDS = int(os.environ.get('RECENCY_SHARDS', 4))
+RECENCY_INDEX = 'recency-index'
+
+def image_shard(image_id, shards):
+    """Stable shard number for an image, derived from its UUID"""
+    return int(image_id.replace('-', ''), 16) % shards
+
+def recency_shard(image_id):
+    return image_shard(image_id, RECENCY_SHARDS)
+
+def recency_bucket(day, shard):
+    return f"{day}#{shard}"
+
+def recency_keys(image_id, created_at):
+    """Attributes that place an item in the recency index (created_day, created_sort)"""
+    return {
+        'created_day': recency_bucket(created_at[:10], recency_shard(image_id)),
+        'created_sort': f"{created_at}#{image_id}"
+    }
+
+# Opt-in write sharding for very active users. A user whose user-stats item
+# has key_shards = N gets new images keyed user_key = "user_id#shard" on
+# user-key-index instead of user-id-index. Images written earlier stay where
+# they are, so N may be raised at any time but never lowered.
+USER_KEY_INDEX = 'user-key-index'
+
+def user_key(user_id, shard):
+    return f"{user_id}#{shard}"
+
+def user_id_error(user_id):
+    """
+    Why user_id cannot be used, or None. '#' is reserved: it joins a user and
+    a shard in user_key and in the counter items' keys, so a user "hot#0"
+    would share quota and stats with shard 0 of "hot".
+    """
+    if not isinstance(user_id, str):
+        return 'user_id must be a string'
+    if '#' in user_id:
+        return "user_id must not contain '#'"
+    return None
+
+def usage_key(item):
+    """
+    The user-stats item holding the counters an image counts towards. A
+    sharded user's images count towards the item of their user_key, so the
+    counter writes are spread like the index writes; images from before
+    sharding stay counted in the user's own item.
+    """
+    return item.get('user_key') or item['user_id']
+
+def user_key_attributes(user_id, image_id, key_shards):
+    """The user_key attribute for a sharded user's new image; {} for unsharded users"""
+    if not key_shards:
+        return {}
+    return {'user_key': user_key(user_id, image_shard(image_id, key_shards))}
+
+# Written only so items land in the indexes; not part of the API's item shape
+INDEX_ATTRIBUTES = ('created_day', 'created_sort', 'user_key')
+
+def public_item(item):
+    """An item as the API returns it, without the index-only attributes"""
+    return {name: value for name, value in item.items() if name not in INDEX_ATTRIBUTES}
+
+def image_s3_key(user_id, image_id, extension):
+    return f"images/{user_id}/{image_id}{extension}"
+
+def build_image_item(image_id, user_id, filename, title, description, tags, file_size, image_info, timestamp,
+                     key_shards=0):
+    """
+    The metadata item for a newly stored image. Every ingest path (the upload
+    handler, bulk import) builds items here so they share one shape.
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    return {
+        'image_id': image_id,
+        'user_id': user_id,
+        's3_key': image_s3_key(user_id, image_id, extension),
+        'filename': filename,
+        'title': title,
+        'description': description,
+        'tags': tags,
+        'content_type': image_info['content_type'],
+        'file_size': file_size,
+        'width': image_info['width'],
+        'height': image_info['height'],
+        'format': image_info['format'],
+        'mode': image_info['mode'],
+        'frame_count': image_info['frame_count'],
+        'status': 'processing',
+        'created_at': timestamp,
+        'updated_at': timestamp,
+        **recency_keys(image_id, timestamp),
+        **user_key_attributes(user_id, image_id, key_shards)
+    }
+
+# Version 2 items leave out attributes that can be derived (see encode_item)
+ITEM_SCHEMA_VERSION = 2
+
+def derived_s3_key(item):
+    return image_s3_key(item['user_id'], item['image_id'], os.path.splitext(item['filename'])[1].lower())
+
+def encode_item(item):
+    """
+    Compact storage form of a metadata item. s3_key is dropped when it follows
+    from user_id/image_id/filename, updated_at while it equals created_at,
+    and tags are stored as a String Set (absent when there are none).
+    Sharded items drop user_id, which keeps them out of user-id-index.
+    """
+    stored = dict(item)
+    if stored.get('s3_key') == derived_s3_key(stored):
+        del stored['s3_key']
+    if 'user_key' in stored and stored['user_key'].rsplit('#', 1)[0] == stored.get('user_id'):
+        del stored['user_id']
+    if stored.get('updated_at') == stored.get('created_at'):
+        stored.pop('updated_at', None)
+    tags = stored.pop('tags', None)
+    if tags:
+        stored['tags'] = set(tags)
+    stored['v'] = ITEM_SCHEMA_VERSION
+    return stored
+
+def decode_item(stored):
+    """Full item, as the API returns it, from either the legacy or the compact form"""
+    item = public_item(stored)
+    item.pop('v', None)
+    if 'user_key' in stored and 'user_id' not in item:
+        item['user_id'] = stored['user_key'].rsplit('#', 1)[0]
+    if 'filename' in item and 's3_key' not in item:
+        item['s3_key'] = derived_s3_key(item)
+    if 'created_at' in item and 'updated_at' not in item:
+        item['updated_at'] = item['created_at']
+    tags = item.get('tags')
+    item['tags'] = sorted(tags) if isinstance(tags, set) else (tags or [])
+    return item
+
+def processing_job(item):
+    """SQS message body asking the post-upload worker to process an item"""
+    return {
+        'image_id': item['image_id'],
+        'user_id': item['user_id'],
+        's3_key': item['s3_key']
+    }
+
+USER_STATS_TABLE = os.environ.get('USER_STATS_TABLE', 'user-stats')
+# Per-user limits enforced at upload; 0 means unlimited
+USER_QUOTA_BYTES = int(os.environ.get('USER_QUOTA_BYTES', 0))
+USER_QUOTA_IMAGES = int(os.environ.get('USER_QUOTA_IMAGES', 0))
+
+def usage_delta(user_id, content_type, image_count, total_bytes):
+    """
+    TransactWriteItems entry that adds image_count images totalling
+    total_bytes to a user's usage counters, overall and for the content type.
+    """
+    return {
+        'Update': {
+            'TableName': USER_STATS_TABLE,
+            'Key': {'user_id': user_id},
+            'UpdateExpression': 'ADD image_count :count, total_bytes :bytes, #type_count :count, #type_bytes :bytes',
+            'ExpressionAttributeNames': {
+                '#type_count': f'count#{content_type}',
+                '#type_bytes': f'bytes#{content_type}'
+            },
+            'ExpressionAttributeValues': {
+                ':count': image_count,
+                ':bytes': total_bytes
+            }
+        }
+    }
+
+def usage_update(user_id, content_type, file_size, delta=1):
+    """usage_delta entry that moves the counters by `delta` images of `file_size` bytes"""
+    return usage_delta(user_id, content_type, delta, delta * int(file_size))
+
+def quota_limits(usage=None, key_shards=0):
+    """
+    (max images, max bytes) one usage item may reach, None where unlimited.
+    Each counter item of a sharded user gets an equal part of what the
+    counters in the user's own item (`usage`) leave, so the user may be
+    refused slightly before the quota once one shard's part is used up.
+    """
+    limits = (USER_QUOTA_IMAGES or None, USER_QUOTA_BYTES or None)
+    if not key_shards:
+        return limits
+    return tuple(
+        None if limit is None else max(0, (limit - int(usage.get(counter, 0))) // key_shards)
+        for limit, counter in zip(limits, ('image_count', 'total_bytes'))
+    )
+
+def quota_error(usage, file_size, limits=None):
+    """Return why adding file_size bytes to a usage item would exceed the quota, or None"""
+    max_images, max_bytes = limits or quota_limits()
+    if max_images is not None and usage.get('image_count', 0) + 1 > max_images:
+        return f'Image quota of {USER_QUOTA_IMAGES} images exceeded'
+    if max_bytes is not None and usage.get('total_bytes', 0) + file_size > max_bytes:
+        return f'Storage quota of {USER_QUOTA_BYTES} bytes exceeded'
+    return None
+
+def add_quota_condition(update, file_size, limits=None):
+    """Guard a usage_update so concurrent uploads cannot overshoot the quota"""
+    max_images, max_bytes = limits or quota_limits()
+    conditions = []
+    values = update['Update']['ExpressionAttributeValues']
+    if max_images is not None:
+        conditions.append('(attribute_not_exists(image_count) OR image_count <= :max_images)')
+        values[':max_images'] = max_images - 1
+    if max_bytes is not None:
+        conditions.append('(attribute_not_exists(total_bytes) OR total_bytes <= :max_bytes)')
+        values[':max_bytes'] = max_bytes - file_size
+    if conditions:
+        update['Update']['ConditionExpression'] = ' AND '.join(conditions)
+    return update
+
+# The newest RECENT_IMAGES images of each unsharded user are kept as compact
+# entries in their user-stats item, so the first page of a summary listing is
+# a single point read. Every change rewrites the whole list and bumps
+# recent_version; writes are conditional on the version they read, so
+# concurrent writers retry rather than drop each other's entries. The list
+# only ever holds a newest-first prefix of the user's images: a list that
+# is missing or shorter than the page is rebuilt from the indexes by the
+# listing. Sharded users upload too fast for one contended item and are
+# always listed from the indexes.
+RECENT_IMAGES = int(os.environ.get('RECENT_IMAGES', 50))
+RECENT_WRITE_ATTEMPTS = 4
+
+def thumbnail_s3_key(user_id, image_id):
+    return f"thumbnails/{user_id}/{image_id}.jpg"
+
+def recent_entry(item):
+    return {'i': item['image_id'], 't': item.get('title', ''), 'f': item['filename'], 'c': item['created_at']}
+
+def recent_summary(user_id, entry):
+    """The API shape of a recent-list entry; thumbnail_key exists once the image is processed"""
+    return {
+        'image_id': entry['i'],
+        'user_id': user_id,
+        'title': entry['t'],
+        'filename': entry['f'],
+        'thumbnail_key': thumbnail_s3_key(user_id, entry['i']),
+        'created_at': entry['c']
+    }
+
+def image_summary(item):
+    return recent_summary(item['user_id'], recent_entry(item))
+
+def recent_sort_key(entry):
+    return f"{entry['c']}#{entry['i']}"
+
+def insert_recent(recent, item):
+    """The recent list with item added in newest-first order, trimmed to RECENT_IMAGES"""
+    entries = [entry for entry in recent if entry['i'] != item['image_id']]
+    entries.append(recent_entry(item))
+    entries.sort(key=recent_sort_key, reverse=True)
+    return entries[:RECENT_IMAGES]
+
+def remove_recent(recent, image_id):
+    return [entry for entry in recent if entry['i'] != image_id]
+
+def set_recent(update, usage, recent):
+    """
+    Make a usage_delta entry also replace the user's recent list, conditional
+    on recent_version being what it was when `usage` was read. recent=None
+    drops the list instead, unconditionally; the next listing rebuilds it.
+    """
+    entry = update['Update']
+    values = entry['ExpressionAttributeValues']
+    values[':one'] = 1
+    action = 'REMOVE recent'
+    if recent is not None:
+        action = 'SET recent = :recent'
+        values[':recent'] = recent
+        version = usage.get('recent_version')
+        if version is None:
+            condition = 'attribute_not_exists(recent_version)'
+        else:
+            condition = 'recent_version = :version'
+            values[':version'] = version
+        if entry.get('ConditionExpression'):
+            condition = f"{entry['ConditionExpression']} AND {condition}"
+        entry['ConditionExpression'] = condition
+    entry['UpdateExpression'] = f"{action} {entry['UpdateExpression']}, recent_version :one"
+    return update
@@ -0,0 +1,126 @@
+import io
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+from boto3.dynamodb.conditions import Key
+from image_metadata import USER_KEY_INDEX, user_key
+
+# 64-bit DCT perceptual hash: the image is reduced to DCT_SIZE x DCT_SIZE
+# grayscale, and each of the lowest HASH_SIZE x HASH_SIZE frequencies is one
+# bit (above or below their median). Resizing and recompression move only a
+# few bits, so near-duplicates are hashes within a small Hamming distance.
+HASH_SIZE = 8
+DCT_SIZE = 32
+# Hamming distance at or below which an upload counts as a near-duplicate
+DUPLICATE_MAX_DISTANCE = int(os.environ.get('DUPLICATE_MAX_DISTANCE', 8))
+# A user's index is rebuilt from the table once it is this old, which picks
+# up images hashed or deleted through other containers
+SIMILARITY_INDEX_TTL = int(os.environ.get('SIMILARITY_INDEX_TTL', 60))
+SIMILARITY_CACHED_USERS = int(os.environ.get('SIMILARITY_CACHED_USERS', 64))
+
+def _dct_matrix(size):
+    """Orthonormal DCT-II basis; M @ X @ M.T is the 2-D DCT of X"""
+    k = np.arange(size)[:, None]
+    n = np.arange(size)[None, :]
+    matrix = np.sqrt(2.0 / size) * np.cos(np.pi * (2 * n + 1) * k / (2 * size))
+    matrix[0] /= np.sqrt(2.0)
+    return matrix
+
+_DCT = _dct_matrix(DCT_SIZE)
+
+def perceptual_hash(image_bytes):
+    from PIL import Image
+
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        # JPEGs are decoded at a reduced scale; other formats ignore the hint
+        image.draft('L', (DCT_SIZE * 2, DCT_SIZE * 2))
+        pixels = np.asarray(
+            image.convert('L').resize((DCT_SIZE, DCT_SIZE), Image.LANCZOS),
+            dtype=np.float64
+        )
+    low = (_DCT @ pixels @ _DCT.T)[:HASH_SIZE, :HASH_SIZE].ravel()
+    # The DC term is the mean brightness; it would skew the median
+    bits = low > np.median(low[1:])
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def format_hash(value):
+    """Hashes are stored as 16 hex digits: JSON clients cannot hold 64-bit integers"""
+    return f"{value:016x}"
+
+def parse_hash(text):
+    return int(text, 16)
+
+if hasattr(np, 'bitwise_count'):
+    def _popcount(values):
+        return np.bitwise_count(values)
+else:
+    # NumPy < 2.0: count bits per byte with a lookup table
+    _BYTE_BITS = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+    def _popcount(values):
+        return _BYTE_BITS[values.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.uint8)
+
+class SimilarityIndex:
+    """One user's image hashes, packed in a uint64 array and searched by Hamming distance"""
+
+    def __init__(self, image_ids=(), hashes=()):
+        self.image_ids = np.array([image_id.encode('ascii') for image_id in image_ids], dtype=bytes)
+        self.hashes = np.array(list(hashes), dtype=np.uint64)
+        self.built_at = time.monotonic()
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def add(self, image_id, value):
+        self.image_ids = np.append(self.image_ids, image_id.encode('ascii'))
+        self.hashes = np.append(self.hashes, np.uint64(value))
+
+    def search(self, value, max_distance, limit=None):
+        """(image_id, distance) pairs within max_distance, nearest first"""
+        distances = _popcount(self.hashes ^ np.uint64(value))
+        matches = np.flatnonzero(distances <= max_distance)
+        matches = matches[np.argsort(distances[matches], kind='stable')][:limit]
+        return [(self.image_ids[index].decode('ascii'), int(distances[index])) for index in matches]
+
+def _query_hashes(table, **kwargs):
+    kwargs.update(
+        ProjectionExpression='image_id, phash',
+        FilterExpression='attribute_exists(phash)'
+    )
+    while True:
+        response = table.query(**kwargs)
+        for item in response.get('Items', []):
+            yield item['image_id'], parse_hash(item['phash'])
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def load_user_index(table, user_id, key_shards=0):
+    """Build a user's index from user-id-index and, for sharded users, user-key-index"""
+    queries = [{'IndexName': 'user-id-index', 'KeyConditionExpression': Key('user_id').eq(user_id)}]
+    queries.extend(
+        {'IndexName': USER_KEY_INDEX, 'KeyConditionExpression': Key('user_key').eq(user_key(user_id, shard))}
+        for shard in range(key_shards)
+    )
+    image_ids, hashes = [], []
+    for query in queries:
+        for image_id, value in _query_hashes(table, **query):
+            image_ids.append(image_id)
+            hashes.append(value)
+    return SimilarityIndex(image_ids, hashes)
+
+# user_id -> SimilarityIndex, least recently used first
+_user_indexes = OrderedDict()
+
+def get_user_index(table, user_id, key_shards=0):
+    """The container's cached index for a user, rebuilt when missing or older than the TTL"""
+    index = _user_indexes.get(user_id)
+    if index is None or time.monotonic() - index.built_at > SIMILARITY_INDEX_TTL:
+        index = load_user_index(table, user_id, key_shards)
+        _user_indexes[user_id] = index
+    _user_indexes.move_to_end(user_id)
+    while len(_user_indexes) > SIMILARITY_CACHED_USERS:
+        _user_indexes.popitem(last=False)
+    return index
@@ -1,26 +1,330 @@
 import json
-import boto3
+import base64
+import heapq
 import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
 from decimal import Decimal
+from itertools import groupby, islice
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+from aws_clients import get_resource, prewarm
+from http_compression import compress_response
+from image_metadata import (
+    RECENCY_INDEX, RECENCY_SHARDS, RECENT_IMAGES, USER_KEY_INDEX, USER_STATS_TABLE,
+    decode_item, image_summary, recency_bucket, recent_entry, recent_sort_key, recent_summary, user_id_error,
+    user_key
+)
 
 DYNAMODB_TABLE = os.environ.get('DYNAMODB_TABLE', 'image-metadata')
-LOCALSTACK_ENDPOINT = os.environ.get('LOCALSTACK_ENDPOINT', 'http://localhost:4566')
+# Day buckets one unscoped listing walks; a page still short after that many
+# days is returned with a next_token that resumes at the next older day
+RECENCY_DAYS_PER_REQUEST = int(os.environ.get('RECENCY_DAYS_PER_REQUEST', 30))
+# Oldest day that can hold images (YYYY-MM-DD). Defaults to the day the table
+# was created; set it when a table is restored or loaded with older items.
+RECENCY_OLDEST_DAY = os.environ.get('RECENCY_OLDEST_DAY')
+# Shard queries whose first page is fetched concurrently
+QUERY_CONCURRENCY = 16
+
+_query_pool = None
+_oldest_day = None
 
 def get_dynamodb():
-    return boto3.resource(
-        'dynamodb',
-        endpoint_url=LOCALSTACK_ENDPOINT,
-        aws_access_key_id='test',
-        aws_secret_access_key='test',
-        region_name='us-east-1'
-    )
+    """Return the DynamoDB resource, shared with every other handler in the container"""
+    return get_resource('dynamodb')
 
 class DecimalEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, Decimal):
-            return float(obj)
+            return int(obj) if obj % 1 == 0 else float(obj)
+        if isinstance(obj, set):
+            return sorted(obj)
         return super(DecimalEncoder, self).default(obj)
 
+def encode_token(cursor):
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode('utf-8')).decode('utf-8')
+
+def int_param(query_params, name, default=None, minimum=0):
+    """A whole-number query parameter; ValueError (answered with a 400) when malformed"""
+    value = query_params.get(name)
+    if not value:
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        raise ValueError(f'{name} must be a whole number')
+    if number < minimum:
+        raise ValueError(f'{name} must be at least {minimum}')
+    return number
+
+DATE_FORMATS = 'YYYY, YYYY-MM or YYYY-MM-DD'
+
+def bound_day(value, name):
+    """
+    The first day a date bound can fall on: "2024" is 2024-01-01, "2024-05"
+    2024-05-01, and a full timestamp its own day. ValueError (answered with a
+    400) when the value does not start with a date.
+    """
+    prefix = value[:10]
+    if len(prefix) not in (4, 7, 10):
+        raise ValueError(f'{name} must start with a date ({DATE_FORMATS})')
+    try:
+        return date.fromisoformat(prefix + '-01-01'[len(prefix) - 4:])
+    except ValueError:
+        raise ValueError(f'{name} must start with a date ({DATE_FORMATS})')
+
+def decode_token(token):
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(token.encode('utf-8')))
+    except (ValueError, TypeError):
+        raise ValueError('Invalid next_token')
+    if not isinstance(cursor, dict):
+        raise ValueError('Invalid next_token')
+    return cursor
+
+def get_query_pool():
+    global _query_pool
+    if _query_pool is None:
+        _query_pool = ThreadPoolExecutor(max_workers=QUERY_CONCURRENCY)
+    return _query_pool
+
+def iter_query(table, first_response=None, **kwargs):
+    """
+    Yield items from a query, fetching further pages only when consumed.
+    Queries go through the resource's client, which (unlike the resource)
+    is safe to share between threads.
+    """
+    client = table.meta.client
+    response = first_response or client.query(TableName=table.name, **kwargs)
+    while True:
+        yield from response.get('Items', [])
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        response = client.query(TableName=table.name, **kwargs)
+
+def parallel_queries(table, queries):
+    """Lazy item iterators for several queries, with their first pages fetched concurrently"""
+    client = table.meta.client
+    first_responses = get_query_pool().map(lambda kwargs: client.query(TableName=table.name, **kwargs), queries)
+    return [iter_query(table, response, **kwargs) for kwargs, response in zip(queries, first_responses)]
+
+def sort_key(item):
+    """Newest-first order shared by every index: created_at, ties broken by image_id"""
+    return item.get('created_sort') or f"{item['created_at']}#{item['image_id']}"
+
+def in_sort_order(items):
+    """
+    Items of a user-id-index query in sort_key order. That index sorts by
+    created_at alone and returns images sharing a timestamp (a bulk-imported
+    batch) in no particular order, while pages are cut and resumed at
+    created_at#image_id; each run of equal timestamps is sorted here. The
+    cursor condition on created_at is inclusive, so a run is always read
+    whole.
+    """
+    for _, run in groupby(items, key=lambda item: item['created_at']):
+        yield from sorted(run, key=sort_key, reverse=True)
+
+def range_condition(name, lower, upper):
+    """Inclusive key condition on a sort key, or None when unbounded"""
+    if lower and upper:
+        return Key(name).between(lower, upper)
+    if lower:
+        return Key(name).gte(lower)
+    if upper:
+        return Key(name).lte(upper)
+    return None
+
+def iter_user_images(table, user_id, key_shards, page_size, cursor, date_from, date_to):
+    """
+    A user's images, newest first. Images of unsharded users (and those a
+    sharded user uploaded before sharding) are on user-id-index; a sharded
+    user's newer images are spread over key_shards partitions of
+    user-key-index. All of them are queried concurrently and k-way merged.
+    """
+    bounds = [bound for bound in (date_to, cursor) if bound]
+    upper = min(bounds) if bounds else None
+
+    key_condition = Key('user_id').eq(user_id)
+    created_range = range_condition('created_at', date_from, upper)
+    if created_range:
+        key_condition &= created_range
+    queries = [{
+        'IndexName': 'user-id-index',
+        'KeyConditionExpression': key_condition,
+        'ScanIndexForward': False,
+        'Limit': page_size
+    }]
+    for shard in range(key_shards):
+        key_condition = Key('user_key').eq(user_key(user_id, shard))
+        sort_range = range_condition('created_sort', date_from, upper)
+        if sort_range:
+            key_condition &= sort_range
+        queries.append({
+            'IndexName': USER_KEY_INDEX,
+            'KeyConditionExpression': key_condition,
+            'ScanIndexForward': False,
+            'Limit': page_size
+        })
+
+    streams = parallel_queries(table, queries)
+    streams[0] = in_sort_order(streams[0])
+    items = heapq.merge(*streams, key=sort_key, reverse=True) if len(streams) > 1 else streams[0]
+    if cursor:
+        # The range conditions are inclusive; drop the cursor item and anything
+        # newer that shares its timestamp
+        items = (item for item in items if sort_key(item) < cursor)
+    return items
+
+def oldest_day(table):
+    """The first day the recency walk has to reach, looked up once per container"""
+    global _oldest_day
+    if _oldest_day is None:
+        if RECENCY_OLDEST_DAY:
+            _oldest_day = date.fromisoformat(RECENCY_OLDEST_DAY)
+        else:
+            created = table.meta.client.describe_table(TableName=table.name)['Table']['CreationDateTime']
+            _oldest_day = created.astimezone(timezone.utc).date()
+    return _oldest_day
+
+def iter_recent_images(table, page_size, cursor, day_from, day_to, walk):
+    """
+    All images, newest first, from the recency-index GSI. Walks day buckets
+    from newest to oldest and k-way merges the shards of each day, so reads
+    stay proportional to the page size rather than the table size. day_from
+    and day_to (from bound_day) limit the days walked; the exact bounds are
+    applied by matches_filters. After RECENCY_DAYS_PER_REQUEST days with
+    older days left, walk['resume'] is set to the cursor the next request
+    continues from.
+    """
+    day = datetime.utcnow().date()
+    if day_to:
+        day = min(day, day_to)
+    if cursor:
+        day = min(day, date.fromisoformat(cursor[:10]))
+        if cursor <= day.isoformat():
+            # A day-boundary cursor: that day was walked completely
+            day -= timedelta(days=1)
+    oldest = oldest_day(table)
+    if day_from:
+        oldest = max(oldest, day_from)
+
+    walked = 0
+    while day >= oldest:
+        if walked == RECENCY_DAYS_PER_REQUEST:
+            walk['resume'] = (day + timedelta(days=1)).isoformat()
+            return
+        queries = []
+        for shard in range(RECENCY_SHARDS):
+            key_condition = Key('created_day').eq(recency_bucket(day.isoformat(), shard))
+            if cursor:
+                key_condition &= Key('created_sort').lt(cursor)
+            queries.append({
+                'IndexName': RECENCY_INDEX,
+                'KeyConditionExpression': key_condition,
+                'ScanIndexForward': False,
+                'Limit': page_size
+            })
+        yield from heapq.merge(*parallel_queries(table, queries), key=sort_key, reverse=True)
+        walked += 1
+        day -= timedelta(days=1)
+
+def cursor_position(cursor):
+    """The created_sort position a next_token resumes after"""
+    try:
+        if 'sort' in cursor:
+            position = cursor['sort']
+        else:
+            # Tokens issued before user listings were merged across shards
+            position = f"{cursor['key']['created_at']}#{cursor['key']['image_id']}"
+        # Every position starts with the day it is on
+        date.fromisoformat(position[:10])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('Invalid next_token')
+    return position
+
+def serve_recent(stats, limit):
+    """
+    The first page of a user's summary listing from their recent list, or
+    None when the list is missing or could be hiding older images the page
+    should include
+    """
+    recent = stats.get('recent')
+    if recent is None:
+        return None
+    image_count = int(stats.get('image_count', 0))
+    if len(recent) < limit and len(recent) < image_count:
+        return None
+    page = recent[:limit]
+    next_token = None
+    if page and image_count > len(page):
+        next_token = encode_token({'sort': recent_sort_key(page[-1])})
+    return page, next_token
+
+def store_recent(stats_table, user_id, stats, newest):
+    """
+    Rebuild a user's recent list from the newest images read off the
+    indexes. Entries already in the list were written transactionally with
+    their images and are kept, in case the indexes have not caught up yet.
+    Skipped if any upload or delete changed the list since `stats` was read.
+    """
+    entries = {entry['i']: entry for entry in stats.get('recent', [])}
+    entries.update((item['image_id'], recent_entry(item)) for item in newest)
+    recent = sorted(entries.values(), key=recent_sort_key, reverse=True)[:RECENT_IMAGES]
+    values = {':recent': recent, ':one': 1}
+    condition = 'attribute_exists(user_id) AND attribute_not_exists(recent_version)'
+    if 'recent_version' in stats:
+        condition = 'recent_version = :version'
+        values[':version'] = stats['recent_version']
+    try:
+        stats_table.update_item(
+            Key={'user_id': user_id},
+            UpdateExpression='SET recent = :recent ADD recent_version :one',
+            ConditionExpression=condition,
+            ExpressionAttributeValues=values
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+
+def matches_filters(item, filters):
+    include_item = True
+    if filters['user_id'] and include_item:
+        if item.get('user_id') != filters['user_id']:
+            include_item = False
+    if filters['tags'] and include_item:
+        search_tags = [tag.strip().lower() for tag in filters['tags'].split(',')]
+        item_tags = [tag.lower() for tag in item.get('tags', [])]
+        if not any(tag in item_tags for tag in search_tags):
+            include_item = False
+    if (filters['date_from'] or filters['date_to']) and include_item:
+        item_date = item.get('created_at', '')
+        if filters['date_from'] and item_date < filters['date_from']:
+            include_item = False
+        if filters['date_to'] and item_date > filters['date_to']:
+            include_item = False
+    if filters['title_search'] and include_item:
+        item_title = item.get('title', '').lower()
+        if filters['title_search'].lower() not in item_title:
+            include_item = False
+    if filters['format'] and include_item:
+        formats = {fmt.strip().upper() for fmt in filters['format'].split(',')}
+        if item.get('format') not in formats:
+            include_item = False
+    if include_item:
+        for name in ('min_width', 'max_width', 'min_height', 'max_height'):
+            bound = filters.get(name)
+            if bound is None:
+                continue
+            value = item.get(name[4:])
+            if value is None:
+                include_item = False
+            elif name.startswith('min_') and value < bound:
+                include_item = False
+            elif name.startswith('max_') and value > bound:
+                include_item = False
+    return include_item
+
 def lambda_handler(event, context):
     try:
         
@@ -32,64 +336,112 @@ def lambda_handler(event, context):
         date_from = query_params.get('date_from') 
         date_to = query_params.get('date_to') 
         title_search = query_params.get('title') 
-        limit = int(query_params.get('limit', 50))     
-        print(f"Query params: user_id={user_id}, tags={tags_filter}, limit={limit}")
-        
+        format_filter = query_params.get('format')
+        summary = query_params.get('summary', 'false').lower() == 'true'
+
         try:
-            response = table.scan(Limit=limit)
-            items = response.get('Items', [])
-            print(f"Found {len(items)} items in table")
-        except Exception as e:
-            print(f"Error scanning table: {e}")
-            items = []
-        
-        filtered_items = []
-        
-        for item in items:
-            include_item = True
-            if user_id and include_item:
-                if item.get('user_id') != user_id:
-                    include_item = False
-            if tags_filter and include_item:
-                search_tags = [tag.strip().lower() for tag in tags_filter.split(',')]
-                item_tags = [tag.lower() for tag in item.get('tags', [])]
-                if not any(tag in item_tags for tag in search_tags):
-                    include_item = False
-            if (date_from or date_to) and include_item:
-                item_date = item.get('created_at', '')
-                if date_from and item_date < date_from:
-                    include_item = False
-                if date_to and item_date > date_to:
-                    include_item = False
-            if title_search and include_item:
-                item_title = item.get('title', '').lower()
-                if title_search.lower() not in item_title:
-                    include_item = False
-            if include_item:
-                filtered_items.append(item)
-        filtered_items.sort(key=lambda x: x.get('created_at', ''), reverse=True)
+            dimension_filters = {
+                name: int_param(query_params, name)
+                for name in ('min_width', 'max_width', 'min_height', 'max_height')
+                if query_params.get(name)
+            }
+            if user_id and user_id_error(user_id):
+                raise ValueError(user_id_error(user_id))
+            limit = int_param(query_params, 'limit', 50, minimum=1)
+            day_from = bound_day(date_from, 'date_from') if date_from else None
+            day_to = bound_day(date_to, 'date_to') if date_to else None
+            cursor = None
+            if query_params.get('next_token'):
+                token = decode_token(query_params['next_token'])
+                if 'sort' not in token and not (user_id and 'key' in token):
+                    raise ValueError('next_token does not belong to this listing')
+                cursor = cursor_position(token)
+        except ValueError as e:
+            return {
+                'statusCode': 400,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': '*'
+                },
+                'body': json.dumps({
+                    'error': str(e)
+                })
+            }
+        print(f"Query params: user_id={user_id}, tags={tags_filter}, limit={limit}")
+        filters = {
+            'user_id': user_id,
+            'tags': tags_filter,
+            'date_from': date_from,
+            'date_to': date_to,
+            'title_search': title_search,
+            'format': format_filter,
+            **dimension_filters
+        }
+
+        recent_page = None
+        walk = {'resume': None}
+        if user_id:
+            # Unfiltered first pages of summary listings come from the recent
+            # list; other listings only need the user's shard count
+            recent_listing = (
+                summary and cursor is None and limit <= RECENT_IMAGES
+                and not any(value for name, value in filters.items() if name != 'user_id')
+            )
+            projection = 'key_shards, image_count, recent, recent_version' if recent_listing else 'key_shards'
+            stats_table = dynamodb.Table(USER_STATS_TABLE)
+            stats = stats_table.get_item(Key={'user_id': user_id}, ProjectionExpression=projection).get('Item', {})
+            key_shards = int(stats.get('key_shards', 0))
+            recent_listing = recent_listing and not key_shards
+            if recent_listing:
+                recent_page = serve_recent(stats, limit)
+            if recent_page is None:
+                items = map(decode_item, iter_user_images(
+                    table, user_id, key_shards, RECENT_IMAGES if recent_listing else limit,
+                    cursor, date_from, date_to
+                ))
+                if recent_listing:
+                    newest = list(islice(items, RECENT_IMAGES))
+                    store_recent(stats_table, user_id, stats, newest)
+                    items = iter(newest)
+        else:
+            items = map(decode_item, iter_recent_images(table, limit, cursor, day_from, day_to, walk))
+
+        if recent_page is not None:
+            entries, next_token = recent_page
+            filtered_items = [recent_summary(user_id, entry) for entry in entries]
+        else:
+            filtered_items = []
+            for item in items:
+                if matches_filters(item, filters):
+                    filtered_items.append(item)
+                    if len(filtered_items) == limit:
+                        break
+
+            next_token = None
+            if len(filtered_items) == limit:
+                next_token = encode_token({'sort': sort_key(filtered_items[-1])})
+            elif walk['resume']:
+                # Out of days to walk for this request, not out of images
+                next_token = encode_token({'sort': walk['resume']})
+            if summary:
+                filtered_items = [image_summary(item) for item in filtered_items]
         response_data = {
             'images': filtered_items,
             'count': len(filtered_items),
-            'filters_applied': {
-                'user_id': user_id,
-                'tags': tags_filter,
-                'date_from': date_from,
-                'date_to': date_to,
-                'title_search': title_search
-            }
+            'next_token': next_token,
+            'filters_applied': filters
         }
         
         print(f"Returning {len(filtered_items)} images")
         
-        return {
+        return compress_response(event, {
             'statusCode': 200,
             'headers': {
                 'Content-Type': 'application/json',
                 'Access-Control-Allow-Origin': '*'
             },
             'body': json.dumps(response_data, cls=DecimalEncoder)
-        }
+        })
         
     except Exception as e:
         print(f"Error listing images: {e}")
@@ -106,3 +458,5 @@ def lambda_handler(event, context):
                 'details': str(e)
             })
         }
+
+prewarm(get_dynamodb)
@@ -0,0 +1,55 @@
+import json
+import os
+import tracemalloc
+
+# tracemalloc slows every allocation down, so per-phase tracking is off
+# unless MEMORY_PROFILE=true. It traces the whole process: profile one
+# request at a time, not a threaded server under load.
+MEMORY_PROFILE = os.environ.get('MEMORY_PROFILE', 'false').lower() == 'true'
+# Bytes a request may allocate on top of its event. Defaults to half of the
+# function's memory (Lambda sets AWS_LAMBDA_FUNCTION_MEMORY_SIZE), leaving the
+# rest to the runtime, imported libraries and the event itself; 0 disables it.
+MEMORY_BUDGET_MB = int(os.environ.get(
+    'MEMORY_BUDGET_MB', int(os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', 0)) // 2
+))
+MEMORY_BUDGET_BYTES = MEMORY_BUDGET_MB * 1024 * 1024
+
+def budget_error(projected_bytes):
+    """Error message if a request's projected peak does not fit the budget, else None"""
+    if MEMORY_BUDGET_BYTES and projected_bytes > MEMORY_BUDGET_BYTES:
+        return (f'Request would need about {projected_bytes / 1024 / 1024:.0f} MB of memory, '
+                f'over the {MEMORY_BUDGET_MB} MB budget')
+    return None
+
+class PhaseTracker:
+    """
+    Peak memory allocated during each phase of a request, relative to what
+    was allocated when the request started. A no-op unless MEMORY_PROFILE is set.
+    """
+
+    def __init__(self, label):
+        self.label = label
+        self.phases = {}
+        if not MEMORY_PROFILE:
+            return
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        self.baseline = tracemalloc.get_traced_memory()[0]
+
+    def mark(self, phase):
+        """Close the phase that ran since the previous mark"""
+        if not MEMORY_PROFILE:
+            return
+        self.phases[phase] = max(0, tracemalloc.get_traced_memory()[1] - self.baseline)
+        tracemalloc.reset_peak()
+
+    def report(self):
+        """Log the phases as one JSON line; returns them for callers that want the numbers"""
+        if self.phases:
+            print(json.dumps({
+                'memory_profile': self.label,
+                'phases': self.phases,
+                'peak_bytes': max(self.phases.values())
+            }))
+        return self.phases
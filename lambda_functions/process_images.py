@@ -0,0 +1,144 @@
+import json
+import hashlib
+import io
+import os
+from botocore.exceptions import ClientError
+from aws_clients import get_client, get_resource, prewarm
+from image_metadata import decode_item, thumbnail_s3_key
+
+S3_BUCKET = os.environ.get('S3_BUCKET', 'image-storage-bucket')
+DYNAMODB_TABLE = os.environ.get('DYNAMODB_TABLE', 'image-metadata')
+# Must match the queue's redrive maxReceiveCount: the last attempt marks the
+# image as failed before SQS moves the message to the dead-letter queue
+MAX_RECEIVE_COUNT = int(os.environ.get('MAX_RECEIVE_COUNT', 3))
+THUMBNAIL_SIZE = (256, 256)
+
+def get_clients():
+    """Return AWS clients, shared with every other handler in the container"""
+    return get_client('s3'), get_resource('dynamodb')
+
+# Registered post-upload processors, run in registration order. Each takes
+# (metadata item, image bytes, s3 client) and returns attributes to set on
+# the item. Processors must be idempotent: a job can be delivered more than
+# once, and completed processors are recorded in the item's `processed` set
+# so retries only rerun what is missing.
+PROCESSORS = []
+
+def processor(name):
+    def register(func):
+        PROCESSORS.append((name, func))
+        return func
+    return register
+
+@processor('sha256')
+def compute_sha256(item, image_bytes, s3_client):
+    return {'sha256': hashlib.sha256(image_bytes).hexdigest()}
+
+@processor('thumbnail')
+def create_thumbnail(item, image_bytes, s3_client):
+    from PIL import Image
+
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image.draft('RGB', THUMBNAIL_SIZE)
+        image.thumbnail(THUMBNAIL_SIZE)
+        output = io.BytesIO()
+        image.convert('RGB').save(output, format='JPEG', quality=85)
+
+    thumbnail_key = thumbnail_s3_key(item['user_id'], item['image_id'])
+    s3_client.put_object(
+        Bucket=S3_BUCKET,
+        Key=thumbnail_key,
+        Body=output.getvalue(),
+        ContentType='image/jpeg'
+    )
+    return {'thumbnail_key': thumbnail_key}
+
+@processor('phash')
+def compute_phash(item, image_bytes, s3_client):
+    # Already computed at upload when the client asked for duplicate rejection
+    if 'phash' in item:
+        return {}
+    from image_similarity import format_hash, perceptual_hash
+
+    return {'phash': format_hash(perceptual_hash(image_bytes))}
+
+def process_job(job, s3_client, table):
+    """Run every pending processor for one image and mark it ready"""
+    response = table.get_item(Key={'image_id': job['image_id']})
+    if 'Item' not in response:
+        print(f"Image {job['image_id']} was deleted before processing; skipping")
+        return
+    item = decode_item(response['Item'])
+
+    done = set(item.get('processed', set()))
+    pending = [(name, func) for name, func in PROCESSORS if name not in done]
+    updates = {}
+    if pending:
+        s3_response = s3_client.get_object(Bucket=S3_BUCKET, Key=item['s3_key'])
+        image_bytes = s3_response['Body'].read()
+        for name, func in pending:
+            updates.update(func(item, image_bytes, s3_client))
+
+    update_expression = 'SET #status = :ready'
+    names = {'#status': 'status'}
+    values = {':ready': 'ready'}
+    for index, (attribute, value) in enumerate(updates.items()):
+        names[f'#a{index}'] = attribute
+        values[f':v{index}'] = value
+        update_expression += f', #a{index} = :v{index}'
+    if pending:
+        update_expression += ' ADD #processed :names'
+        names['#processed'] = 'processed'
+        values[':names'] = {name for name, _ in pending}
+
+    try:
+        table.update_item(
+            Key={'image_id': job['image_id']},
+            UpdateExpression=update_expression,
+            ConditionExpression='attribute_exists(image_id)',
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        print(f"Image {job['image_id']} was deleted during processing; skipping")
+        if updates.get('thumbnail_key'):
+            s3_client.delete_object(Bucket=S3_BUCKET, Key=updates['thumbnail_key'])
+
+def mark_failed(table, image_id, error):
+    try:
+        table.update_item(
+            Key={'image_id': image_id},
+            UpdateExpression='SET #status = :failed, processing_error = :error',
+            ConditionExpression='attribute_exists(image_id)',
+            ExpressionAttributeNames={'#status': 'status'},
+            ExpressionAttributeValues={':failed': 'failed', ':error': str(error)[:1000]}
+        )
+    except ClientError as e:
+        print(f"Warning: Failed to mark image {image_id} as failed: {e}")
+
+def lambda_handler(event, context):
+    """
+    SQS-triggered worker for post-upload processing. Failed records are
+    reported individually (ReportBatchItemFailures) so only they are retried.
+    """
+    s3_client, dynamodb = get_clients()
+    table = dynamodb.Table(DYNAMODB_TABLE)
+    failures = []
+
+    for record in event.get('Records', []):
+        job = None
+        try:
+            job = json.loads(record['body'])
+            process_job(job, s3_client, table)
+        except Exception as e:
+            print(f"Error processing message {record.get('messageId')}: {e}")
+            failures.append({'itemIdentifier': record['messageId']})
+            receive_count = int(record.get('attributes', {}).get('ApproximateReceiveCount', 1))
+            if receive_count >= MAX_RECEIVE_COUNT and isinstance(job, dict):
+                mark_failed(table, job['image_id'], e)
+
+    return {'batchItemFailures': failures}
+
+prewarm(get_clients)
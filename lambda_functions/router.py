@@ -0,0 +1,47 @@
+import json
+import os
+from functools import partial
+from importlib import import_module
+
+from aws_clients import prewarm
+
+# "METHOD /resource" -> "module.function", generated from API_ROUTES by
+# setup_infrastructure.py for the consolidated layout
+ROUTES = json.loads(os.environ.get('ROUTES', '{}'))
+
+_handlers = {}
+
+def get_handler(route):
+    """Import a route's handler on first use; later calls reuse the loaded module"""
+    if route not in _handlers:
+        module_name, function_name = ROUTES[route].rsplit('.', 1)
+        _handlers[route] = getattr(import_module(module_name), function_name)
+    return _handlers[route]
+
+def error_response(status_code, message, headers=None):
+    return {
+        'statusCode': status_code,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*',
+            **(headers or {})
+        },
+        'body': json.dumps({
+            'error': message
+        })
+    }
+
+def lambda_handler(event, context):
+    """Dispatch an API Gateway proxy event to the handler of its method and resource"""
+    resource = event.get('resource')
+    route = f"{event.get('httpMethod')} {resource}"
+    if route in ROUTES:
+        return get_handler(route)(event, context)
+
+    allowed = sorted(key.split(' ', 1)[0] for key in ROUTES if key.split(' ', 1)[1] == resource)
+    if allowed:
+        return error_response(405, 'Method not allowed', {'Allow': ', '.join(allowed)})
+    return error_response(404, 'Route not found')
+
+# Importing every handler also prewarms its clients, whichever route comes first
+prewarm(*[partial(get_handler, route) for route in ROUTES])
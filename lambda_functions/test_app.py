@@ -0,0 +1,65 @@
+import io
+import json
+
+import pytest
+
+from conftest import png_bytes, upload_event
+
+@pytest.fixture
+def client(aws):
+    import app
+
+    return app.app.test_client()
+
+def upload(client, user_id='alice', **fields):
+    data = {'user_id': user_id, 'image': (io.BytesIO(png_bytes()), 'photo.png'), **fields}
+    response = client.post('/images', data=data, content_type='multipart/form-data')
+    assert response.status_code == 201, response.get_data(as_text=True)
+    return response.get_json()
+
+def test_multipart_and_json_uploads_reach_the_handler(client):
+    body = upload(client, title='Sunset', tags='a,b')
+    assert (body['metadata']['title'], body['metadata']['tags']) == ('Sunset', ['a', 'b'])
+
+    event = upload_event('alice', color='blue')
+    response = client.post('/images', data=event['body'], headers=event['headers'])
+    assert response.status_code == 201
+    assert response.headers['Access-Control-Allow-Origin'] == '*'
+
+def test_list_view_stats_and_delete_routes(client):
+    image_id = upload(client)['image_id']
+
+    listed = client.get('/images', query_string={'user_id': 'alice'}).get_json()
+    assert [image['image_id'] for image in listed['images']] == [image_id]
+    metadata = client.get(f'/images/{image_id}', query_string={'metadata_only': 'true'}).get_json()
+    assert metadata['metadata']['filename'] == 'photo.png'
+    assert client.get('/users/alice/stats').get_json()['image_count'] == 1
+
+    assert client.delete(f'/images/{image_id}', json={'user_id': 'alice'}).status_code == 200
+    assert client.get(f'/images/{image_id}').status_code == 404
+
+def test_download_is_streamed_from_storage(client):
+    image_id = upload(client)['image_id']
+
+    response = client.get(f'/images/{image_id}', query_string={'download': 'true'})
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert response.get_data() == png_bytes()
+    assert response.headers['Content-Type'] == 'image/png'
+    assert response.headers['Content-Length'] == str(len(png_bytes()))
+    assert response.headers['Content-Disposition'] == 'attachment; filename="photo.png"'
+
+    assert client.get('/images/missing', query_string={'download': 'true'}).status_code == 404
+
+def test_unknown_routes_methods_and_oversized_bodies_get_json_errors(client, monkeypatch):
+    import app
+
+    response = client.get('/nowhere')
+    assert (response.status_code, response.get_json()) == (404, {'error': 'Not found'})
+    response = client.put('/images')
+    assert (response.status_code, response.get_json()) == (405, {'error': 'Method not allowed'})
+
+    monkeypatch.setitem(app.app.config, 'MAX_CONTENT_LENGTH', 1024)
+    response = client.post('/images', data=b'x' * 2048, content_type='image/png')
+    assert response.status_code == 413
+    assert response.get_json() == {'error': 'Request body too large'}
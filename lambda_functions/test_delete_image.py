@@ -0,0 +1,80 @@
+import json
+
+import pytest
+
+import delete_image
+import image_metadata
+import upload_image
+from conftest import upload_event
+from image_metadata import USER_STATS_TABLE
+
+@pytest.fixture(autouse=True)
+def no_sharded_cache(monkeypatch):
+    monkeypatch.setattr(upload_image, '_sharded_users', {})
+
+def upload(user_id, color='red'):
+    response = upload_image.lambda_handler(upload_event(user_id, color=color), None)
+    assert response['statusCode'] == 201
+    return json.loads(response['body'])['image_id']
+
+def delete(user_id, image_id):
+    event = {'pathParameters': {'image_id': image_id}, 'body': json.dumps({'user_id': user_id})}
+    return delete_image.lambda_handler(event, None)['statusCode']
+
+def stats(aws, user_id):
+    return aws.Table(USER_STATS_TABLE).get_item(Key={'user_id': user_id}).get('Item', {})
+
+def test_delete_checks_owner_and_decrements_counters(aws):
+    upload('alice')
+    deleted = upload('alice', color='blue')
+
+    assert delete('bob', deleted) == 403
+    assert delete('alice', deleted) == 200
+    assert delete('alice', deleted) == 404
+    item = stats(aws, 'alice')
+    assert item['image_count'] == 1
+    assert item['count#image/png'] == 1
+
+def test_delete_retries_when_recent_list_changes(aws, concurrent_write):
+    upload('alice')
+    deleted = upload('alice', color='blue')
+    other = {'i': 'other-image', 't': '', 'f': 'other.png', 'c': '2000-01-01T00:00:00'}
+
+    def other_upload():
+        aws.Table(USER_STATS_TABLE).update_item(
+            Key={'user_id': 'alice'},
+            UpdateExpression='SET recent = list_append(recent, :entry) ADD recent_version :one',
+            ExpressionAttributeValues={':entry': [other], ':one': 1}
+        )
+    concurrent_write(other_upload)
+
+    assert delete('alice', deleted) == 200
+    ids = [entry['i'] for entry in stats(aws, 'alice')['recent']]
+    assert deleted not in ids
+    assert 'other-image' in ids
+
+def test_delete_drops_recent_list_after_repeated_conflicts(aws, concurrent_write):
+    deleted = upload('alice')
+
+    def conflicting_write():
+        aws.Table(USER_STATS_TABLE).update_item(
+            Key={'user_id': 'alice'},
+            UpdateExpression='ADD recent_version :one',
+            ExpressionAttributeValues={':one': 1}
+        )
+    concurrent_write(conflicting_write, times=image_metadata.RECENT_WRITE_ATTEMPTS - 1)
+
+    assert delete('alice', deleted) == 200
+    item = stats(aws, 'alice')
+    assert item['image_count'] == 0
+    assert 'recent' not in item
+
+def test_delete_of_sharded_image_decrements_its_counter_item(aws):
+    aws.Table(USER_STATS_TABLE).put_item(Item={'user_id': 'hot', 'key_shards': 2})
+    image_id = upload('hot')
+    counter_key = image_metadata.user_key('hot', image_metadata.image_shard(image_id, 2))
+    assert stats(aws, counter_key)['image_count'] == 1
+
+    assert delete('hot', image_id) == 200
+    assert stats(aws, counter_key)['image_count'] == 0
+    assert 'image_count' not in stats(aws, 'hot')
@@ -0,0 +1,73 @@
+import base64
+import gzip
+import json
+from datetime import datetime
+
+import pytest
+
+import http_compression
+import list_images
+from http_compression import compress_response, negotiate_encoding
+
+@pytest.fixture
+def gzip_only(monkeypatch):
+    monkeypatch.setattr(http_compression, 'ENCODERS', {'gzip': http_compression._gzip})
+
+def json_response(size):
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json'},
+        'body': json.dumps({'images': ['x' * 10] * (size // 14)})
+    }
+
+def test_negotiation_honours_q_values(gzip_only):
+    assert negotiate_encoding({'Accept-Encoding': 'gzip'}) == 'gzip'
+    assert negotiate_encoding({'accept-encoding': 'deflate, GZIP;q=0.5'}) == 'gzip'
+    assert negotiate_encoding({'Accept-Encoding': '*'}) == 'gzip'
+    assert negotiate_encoding({'Accept-Encoding': 'gzip;q=0'}) is None
+    assert negotiate_encoding({'Accept-Encoding': '*, gzip;q=0'}) is None
+    assert negotiate_encoding({'Accept-Encoding': 'gzip;q=bogus'}) is None
+    assert negotiate_encoding({'Accept-Encoding': 'identity'}) is None
+    assert negotiate_encoding(None) is None
+
+def test_brotli_preferred_at_equal_q_value(monkeypatch):
+    monkeypatch.setattr(http_compression, 'ENCODERS', {'br': object(), 'gzip': object()})
+    assert negotiate_encoding({'Accept-Encoding': 'gzip, br'}) == 'br'
+    assert negotiate_encoding({'Accept-Encoding': 'gzip, br;q=0.8'}) == 'gzip'
+
+def test_large_json_body_is_gzipped(gzip_only):
+    response = json_response(4096)
+    body = response['body']
+
+    compressed = compress_response({'headers': {'Accept-Encoding': 'gzip'}}, response)
+    assert compressed['isBase64Encoded'] is True
+    assert compressed['headers']['Content-Encoding'] == 'gzip'
+    assert compressed['headers']['Vary'] == 'Accept-Encoding'
+    assert gzip.decompress(base64.b64decode(compressed['body'])).decode('utf-8') == body
+
+def test_small_refused_or_binary_bodies_are_left_alone(gzip_only):
+    small = json_response(http_compression.COMPRESSION_MIN_BYTES // 2)
+    body = small['body']
+    response = compress_response({'headers': {'Accept-Encoding': 'gzip'}}, small)
+    assert (response['body'], response['headers']['Vary']) == (body, 'Accept-Encoding')
+    assert 'Content-Encoding' not in response['headers']
+
+    refused = compress_response({'headers': {'Accept-Encoding': 'gzip;q=0'}}, json_response(4096))
+    assert 'Content-Encoding' not in refused['headers']
+    assert not refused.get('isBase64Encoded')
+
+    binary = {'statusCode': 200, 'body': base64.b64encode(b'\x00' * 4096).decode('ascii'), 'isBase64Encoded': True}
+    assert compress_response({'headers': {'Accept-Encoding': 'gzip'}}, dict(binary)) == binary
+
+def test_listing_is_compressed_for_accepting_clients(aws, gzip_only):
+    from test_list_images import put_image
+
+    for n in range(20):
+        put_image(aws, 'alice', datetime(2024, 5, 1, 10, n))
+    event = {'headers': {'Accept-Encoding': 'gzip'}, 'queryStringParameters': {'user_id': 'alice'}}
+
+    response = list_images.lambda_handler(event, None)
+    assert response['headers']['Content-Encoding'] == 'gzip'
+    listed = json.loads(gzip.decompress(base64.b64decode(response['body'])))
+    assert len(listed['images']) == 20
+    assert 'Content-Encoding' not in list_images.lambda_handler(dict(event, headers={}), None)['headers']
@@ -0,0 +1,105 @@
+import threading
+
+import pytest
+from werkzeug.serving import make_server
+
+from conftest import png_bytes
+from image_client import ImageClient, ImageServiceError
+
+class LocalServer:
+    """
+    WSGI middleware answering the first `failures` uploads with a 503. The
+    app runs one request at a time: moto restores a snapshot of every table
+    when a transaction is cancelled, undoing writes of concurrent requests.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.idempotency_keys = []
+
+    def __call__(self, environ, start_response):
+        if environ['REQUEST_METHOD'] == 'POST':
+            self.idempotency_keys.append(environ.get('HTTP_IDEMPOTENCY_KEY'))
+            if self.failures:
+                self.failures -= 1
+                environ['wsgi.input'].read(int(environ.get('CONTENT_LENGTH') or 0))
+                start_response('503 Service Unavailable', [('Content-Type', 'application/json')])
+                return [b'{"error": "Service unavailable"}']
+        with self.lock:
+            return self.app(environ, start_response)
+
+@pytest.fixture
+def server(aws):
+    """The Flask app on a local port, in a thread, backed by moto"""
+    import app
+
+    local_server = LocalServer(app.app)
+    http_server = make_server('127.0.0.1', 0, local_server, threaded=True)
+    thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+    local_server.url = f'http://127.0.0.1:{http_server.server_port}'
+    yield local_server
+    http_server.shutdown()
+    thread.join()
+
+@pytest.fixture
+def client(server):
+    with ImageClient(server.url, max_workers=4, backoff_factor=0) as client:
+        yield client
+
+def test_upload_list_download_and_delete(client, tmp_path):
+    image = client.upload(png_bytes(), 'alice', title='Sunset', tags=['a', 'b'], filename='sunset.png')
+    assert (image['metadata']['title'], image['metadata']['tags']) == ('Sunset', ['a', 'b'])
+    path = tmp_path / 'photo.png'
+    path.write_bytes(png_bytes('blue'))
+    other = client.upload(str(path), 'alice')
+    assert other['metadata']['filename'] == 'photo.png'
+
+    # Pages are followed until the listing ends
+    listed = [item['image_id'] for item in client.list(page_size=1, user_id='alice')]
+    assert sorted(listed) == sorted([image['image_id'], other['image_id']])
+    assert client.get(image['image_id'])['filename'] == 'sunset.png'
+    assert client.download_to(other['image_id'], tmp_path / 'copy.png') == len(png_bytes('blue'))
+    assert (tmp_path / 'copy.png').read_bytes() == png_bytes('blue')
+
+    client.delete(image['image_id'], 'alice')
+    with pytest.raises(ImageServiceError) as error:
+        client.get(image['image_id'])
+    assert error.value.status_code == 404
+
+def test_upload_requires_filename_for_bytes(client):
+    with pytest.raises(ValueError):
+        client.upload(png_bytes(), 'alice')
+
+def test_upload_retry_sends_the_same_idempotency_key(client, server):
+    server.failures = 2
+    image = client.upload(png_bytes(), 'alice', filename='photo.png')
+    assert len(server.idempotency_keys) == 3
+    assert len(set(server.idempotency_keys)) == 1
+    assert [item['image_id'] for item in client.list(user_id='alice')] == [image['image_id']]
+
+    server.failures = client.retries + 1
+    with pytest.raises(ImageServiceError) as error:
+        client.upload(png_bytes('blue'), 'alice', filename='photo.png')
+    assert error.value.status_code == 503
+
+def test_bulk_methods_keep_input_order_and_report_failures(client):
+    colors = ['red', 'green', 'blue', 'white', 'black']
+    uploads = [{'image': png_bytes(color), 'user_id': 'alice', 'filename': f'{color}.png'} for color in colors]
+    uploads.insert(2, {'image': png_bytes(), 'user_id': 'alice', 'filename': 'bad.gif'})
+    progress = []
+
+    results = client.upload_many(uploads, progress=lambda done, total, item, result: progress.append((done, total)))
+    assert [done for done, _ in progress] == list(range(1, 7))
+    assert {total for _, total in progress} == {6}
+    assert isinstance(results[2], ImageServiceError) and results[2].status_code == 400
+    uploaded = [result for result in results if not isinstance(result, Exception)]
+    assert [result['metadata']['filename'] for result in uploaded] == [f'{color}.png' for color in colors]
+
+    image_ids = [result['image_id'] for result in uploaded]
+    results = client.delete_many(image_ids + ['missing'], 'alice')
+    assert all(isinstance(result, dict) for result in results[:-1])
+    assert results[-1].status_code == 404
+    assert list(client.list(user_id='alice')) == []
@@ -0,0 +1,93 @@
+import base64
+import io
+import json
+
+import numpy as np
+import pytest
+
+import find_similar
+import image_similarity
+import process_images
+import upload_image
+from conftest import upload_event
+from image_similarity import DUPLICATE_MAX_DISTANCE, SimilarityIndex, perceptual_hash
+
+@pytest.fixture(autouse=True)
+def no_cached_indexes(monkeypatch):
+    monkeypatch.setattr(image_similarity, '_user_indexes', image_similarity.OrderedDict())
+
+def photo(seed, size=256, format='PNG', quality=None):
+    """Smooth random shapes; solid colours all hash alike"""
+    from PIL import Image
+
+    noise = np.random.default_rng(seed).random((8, 8)) * 255
+    image = Image.fromarray(noise.astype(np.uint8)).resize((size, size), Image.BICUBIC).convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, format=format, **({'quality': quality} if quality else {}))
+    return buffer.getvalue()
+
+def upload(user_id, image_bytes, filename='photo.png', reject_duplicates=True):
+    event = upload_event(user_id, filename=filename, image_data=base64.b64encode(image_bytes).decode('ascii'))
+    if reject_duplicates:
+        event['queryStringParameters'] = {'reject_duplicates': 'true'}
+    response = upload_image.lambda_handler(event, None)
+    return response['statusCode'], json.loads(response['body'])
+
+def distance(a, b):
+    return bin(perceptual_hash(a) ^ perceptual_hash(b)).count('1')
+
+def test_hash_survives_resizing_and_recompression():
+    original = photo(1)
+    assert distance(original, photo(1, size=128)) <= DUPLICATE_MAX_DISTANCE
+    assert distance(original, photo(1, format='JPEG', quality=60)) <= DUPLICATE_MAX_DISTANCE
+    assert distance(original, photo(2)) > DUPLICATE_MAX_DISTANCE
+
+def test_index_search_is_nearest_first_and_limited():
+    index = SimilarityIndex(['a', 'b', 'c'], [0b1111, 0b0001, 0b0000])
+    index.add('d', 0b0011)
+    assert len(index) == 4
+    assert index.search(0, 2) == [('c', 0), ('b', 1), ('d', 2)]
+    assert index.search(0, 4, limit=2) == [('c', 0), ('b', 1)]
+    assert index.search(2 ** 64 - 1, 0) == []
+
+def test_upload_rejects_near_duplicates_of_own_images(aws):
+    status, first = upload('alice', photo(1))
+    assert status == 201
+    assert first['metadata']['phash'] == image_similarity.format_hash(perceptual_hash(photo(1)))
+
+    status, body = upload('alice', photo(1, format='JPEG', quality=60), filename='copy.jpg')
+    assert status == 409
+    assert body['duplicates'][0]['image_id'] == first['image_id']
+
+    assert upload('alice', photo(2))[0] == 201
+    assert upload('bob', photo(1))[0] == 201
+    # Only checked when asked for
+    assert upload('alice', photo(1), reject_duplicates=False)[0] == 201
+
+def test_find_similar_lists_the_users_near_duplicates(aws):
+    image_id = upload('alice', photo(1))[1]['image_id']
+    resized = upload('alice', photo(1, size=128), reject_duplicates=False)[1]['image_id']
+    upload('alice', photo(2))
+    upload('bob', photo(1))
+    unhashed = upload('alice', photo(3), reject_duplicates=False)[1]['image_id']
+    # The worker hashes uploads that did not ask for the check
+    record = {'messageId': 'm1', 'body': json.dumps({'image_id': resized})}
+    assert process_images.lambda_handler({'Records': [record]}, None) == {'batchItemFailures': []}
+    image_similarity._user_indexes.clear()
+
+    def similar(image_id, **params):
+        event = {'pathParameters': {'image_id': image_id}, 'queryStringParameters': params or None}
+        response = find_similar.lambda_handler(event, None)
+        return response['statusCode'], json.loads(response['body'])
+
+    status, body = similar(image_id)
+    assert status == 200
+    assert [image['image_id'] for image in body['images']] == [resized]
+    assert body['images'][0]['distance'] <= DUPLICATE_MAX_DISTANCE
+    assert body['indexed_images'] == 3
+    assert similar(image_id, max_distance='64')[1]['count'] == 2
+
+    assert similar(unhashed)[0] == 409
+    assert similar('missing')[0] == 404
+    assert similar(image_id, max_distance='65')[0] == 400
+    assert similar(image_id, limit='many')[0] == 400
@@ -0,0 +1,142 @@
+import json
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+import list_images
+from image_metadata import USER_STATS_TABLE, build_image_item, encode_item
+
+IMAGE_INFO = {'content_type': 'image/png', 'width': 8, 'height': 8, 'format': 'PNG', 'mode': 'RGB', 'frame_count': 1}
+
+@pytest.fixture(autouse=True)
+def fresh_oldest_day(monkeypatch):
+    monkeypatch.setattr(list_images, '_oldest_day', None)
+
+def image_id(n):
+    """A fixed image id; consecutive numbers land on consecutive shards"""
+    return f'00000000-0000-4000-8000-{n:012x}'
+
+def put_image(aws, user_id, created_at, key_shards=0, image_id=None, **image_info):
+    image_id = image_id or str(uuid.uuid4())
+    item = build_image_item(
+        image_id, user_id, 'test.png', '', '', [], 100, dict(IMAGE_INFO, **image_info), created_at.isoformat(),
+        key_shards=key_shards
+    )
+    aws.Table(list_images.DYNAMODB_TABLE).put_item(Item=encode_item(item))
+    return item
+
+def newest_first(items):
+    return [item['image_id'] for item in sorted(items, key=list_images.sort_key, reverse=True)]
+
+def list_pages(**params):
+    """Image ids of every page of a listing, following next_token to the end"""
+    pages = []
+    token = None
+    while True:
+        query = {key: str(value) for key, value in params.items()}
+        if token:
+            query['next_token'] = token
+        response = list_images.lambda_handler({'queryStringParameters': query}, None)
+        assert response['statusCode'] == 200
+        body = json.loads(response['body'])
+        pages.append([image['image_id'] for image in body['images']])
+        token = body['next_token']
+        if token is None:
+            return pages
+
+def test_sharded_user_pages_merge_every_index(aws):
+    start = datetime(2024, 5, 1, 10)
+    # Images from before the user was sharded stay on user-id-index
+    items = [put_image(aws, 'hot', start + timedelta(minutes=n), image_id=image_id(n)) for n in range(3)]
+    aws.Table(USER_STATS_TABLE).put_item(Item={'user_id': 'hot', 'key_shards': 4})
+    items += [
+        put_image(aws, 'hot', start + timedelta(minutes=n), key_shards=4, image_id=image_id(n))
+        for n in range(3, 12)
+    ]
+    # Same-timestamp images on different shards are ordered by image_id
+    tied = start + timedelta(minutes=30)
+    items += [put_image(aws, 'hot', tied, key_shards=4, image_id=image_id(n)) for n in range(12, 15)]
+    put_image(aws, 'other', start)
+
+    pages = list_pages(user_id='hot', limit=4)
+    assert [len(page) for page in pages] == [4, 4, 4, 3]
+    assert sum(pages, []) == newest_first(items)
+
+def test_unscoped_listing_resumes_past_walked_days(aws, monkeypatch):
+    today = datetime.utcnow().replace(hour=12)
+    monkeypatch.setattr(list_images, 'RECENCY_DAYS_PER_REQUEST', 2)
+    monkeypatch.setattr(list_images, '_oldest_day', (today - timedelta(days=9)).date())
+    items = [put_image(aws, f'user{days}', today - timedelta(days=days)) for days in (0, 0, 3, 9)]
+
+    pages = list_pages(limit=10)
+    # Two days per request: 0-1, 2-3, 4-5, 6-7, 8-9, then the oldest day is reached
+    assert len(pages) == 5
+    assert sum(pages, []) == newest_first(items)
+
+def test_unscoped_listing_stops_at_oldest_day(aws, monkeypatch):
+    today = datetime.utcnow().replace(hour=12)
+    monkeypatch.setattr(list_images, '_oldest_day', (today - timedelta(days=1)).date())
+    items = [put_image(aws, 'alice', today - timedelta(days=days)) for days in (0, 1)]
+    put_image(aws, 'alice', today - timedelta(days=2))
+
+    assert list_pages(limit=10) == [newest_first(items)]
+
+def test_summary_listing_served_from_rebuilt_recent_list(aws):
+    start = datetime.utcnow() - timedelta(hours=1)
+    items = [put_image(aws, 'alice', start + timedelta(minutes=n)) for n in range(5)]
+    aws.Table(USER_STATS_TABLE).put_item(Item={'user_id': 'alice', 'image_count': 5})
+
+    # The first listing reads the index and stores the recent list ...
+    assert list_pages(user_id='alice', summary='true', limit=3) == [newest_first(items)[:3], newest_first(items)[3:]]
+    stats = aws.Table(USER_STATS_TABLE).get_item(Key={'user_id': 'alice'})['Item']
+    assert [entry['i'] for entry in stats['recent']] == newest_first(items)
+
+    # ... which later first pages are served from, without the index
+    aws.Table(list_images.DYNAMODB_TABLE).delete_item(Key={'image_id': items[-1]['image_id']})
+    assert list_pages(user_id='alice', summary='true', limit=3)[0] == newest_first(items)[:3]
+
+def test_dimension_filters(aws, monkeypatch):
+    start = datetime.utcnow() - timedelta(minutes=5)
+    monkeypatch.setattr(list_images, '_oldest_day', (start - timedelta(days=1)).date())
+    put_image(aws, 'alice', start)
+    large = put_image(aws, 'alice', start + timedelta(minutes=1), width=640, height=480)
+    put_image(aws, 'bob', start + timedelta(minutes=2), width=640, height=320)
+
+    assert list_pages(user_id='alice', min_width=100) == [[large['image_id']]]
+    assert list_pages(min_width=100, min_height=400) == [[large['image_id']]]
+
+    for params in ({'min_width': 'abc'}, {'max_height': '1.5'}, {'limit': 'ten'}, {'limit': '0'}):
+        response = list_images.lambda_handler({'queryStringParameters': params}, None)
+        assert response['statusCode'] == 400
+        assert list(params)[0] in json.loads(response['body'])['error']
+
+def test_unscoped_listing_accepts_prefix_date_bounds(aws, monkeypatch):
+    today = datetime.utcnow().replace(hour=12)
+    monkeypatch.setattr(list_images, '_oldest_day', (today - timedelta(days=40)).date())
+    items = [put_image(aws, 'alice', today - timedelta(days=days)) for days in (0, 35)]
+    year, month = items[1]['created_at'][:4], items[1]['created_at'][:7]
+
+    expected = newest_first([item for item in items if item['created_at'] >= year])
+    assert sum(list_pages(date_from=year, limit=10), []) == expected
+    # Like the filter, a month as upper bound sorts before that month's timestamps
+    assert sum(list_pages(date_to=month, limit=10), []) == [
+        item['image_id'] for item in items if item['created_at'] <= month
+    ]
+
+def test_malformed_date_bounds_and_tokens_are_400(aws):
+    for params in ({'date_from': 'garbage'}, {'date_to': '2024-13'}, {'date_to': '2024-1'},
+                   {'user_id': 'alice', 'date_from': 'soon'},
+                   {'next_token': list_images.encode_token({'sort': 'not-a-position'})}):
+        response = list_images.lambda_handler({'queryStringParameters': params}, None)
+        assert response['statusCode'] == 400, params
+
+def test_user_pages_with_tied_timestamps(aws):
+    # A bulk import gives a whole batch one created_at; user-id-index does
+    # not order such ties, and moto returns them in reverse insertion order
+    created_at = datetime(2024, 5, 1, 10)
+    items = [put_image(aws, 'alice', created_at, image_id=image_id(n)) for n in reversed(range(10))]
+
+    pages = list_pages(user_id='alice', limit=3)
+    assert [len(page) for page in pages] == [3, 3, 3, 1]
+    assert sum(pages, []) == newest_first(items)
@@ -0,0 +1,100 @@
+import base64
+import io
+import json
+import tracemalloc
+
+import pytest
+
+import memory_profile
+import upload_image
+import view_image
+from conftest import upload_event
+from memory_profile import PhaseTracker, budget_error
+
+MB = 1024 * 1024
+
+@pytest.fixture
+def budget(monkeypatch):
+    def set_budget(megabytes):
+        monkeypatch.setattr(memory_profile, 'MEMORY_BUDGET_MB', megabytes)
+        monkeypatch.setattr(memory_profile, 'MEMORY_BUDGET_BYTES', int(megabytes * MB))
+    return set_budget
+
+def large_png(size=1024):
+    """Few bytes on the wire, size x size RGB pixels once decoded"""
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new('RGB', (size, size), color='red').save(buffer, format='PNG')
+    return buffer.getvalue()
+
+def test_budget_error(budget):
+    budget(0)
+    assert budget_error(10 ** 12) is None
+    budget(2)
+    assert budget_error(2 * MB) is None
+    assert budget_error(3 * MB) == 'Request would need about 3 MB of memory, over the 2 MB budget'
+
+def test_upload_over_budget_is_413_before_parsing(aws, budget):
+    budget(1)
+    event = {'headers': {'Content-Type': 'image/png'}, 'queryStringParameters': {'user_id': 'alice'},
+             'body': 'x' * (2 * MB)}
+    response = upload_image.lambda_handler(event, None)
+    assert response['statusCode'] == 413
+    assert 'budget' in json.loads(response['body'])['error']
+
+    # JSON uploads are budgeted for the document and the decoded image
+    response = upload_image.lambda_handler(upload_event('alice', padding='x' * (MB // 2 + 1)), None)
+    assert response['statusCode'] == 413
+
+def test_duplicate_check_over_budget_is_413(aws, budget):
+    budget(1)
+    image_data = base64.b64encode(large_png()).decode('ascii')
+    event = upload_event('alice', image_data=image_data)
+    event['queryStringParameters'] = {'reject_duplicates': 'true'}
+    response = upload_image.lambda_handler(event, None)
+    assert response['statusCode'] == 413
+    assert 'retry without reject_duplicates' in json.loads(response['body'])['error']
+
+    # The upload itself fits
+    assert upload_image.lambda_handler(upload_event('alice', image_data=image_data), None)['statusCode'] == 201
+
+def test_view_budgets_the_encoded_and_compressed_image(aws, budget):
+    response = upload_image.lambda_handler(upload_event('alice'), None)
+    body = json.loads(response['body'])
+    file_size = body['metadata']['file_size']
+    budget(file_size * 6 / MB)
+
+    def view(accept_encoding=None, **params):
+        event = {'pathParameters': {'image_id': body['image_id']}, 'queryStringParameters': params or None,
+                 'headers': {'Accept-Encoding': accept_encoding} if accept_encoding else {}}
+        return view_image.lambda_handler(event, None)['statusCode']
+
+    assert view() == 200
+    assert view('gzip') == 413
+    assert view('gzip', metadata_only='true') == 200
+
+def test_phase_tracker_reports_peak_per_phase(monkeypatch, capsys):
+    monkeypatch.setattr(memory_profile, 'MEMORY_PROFILE', True)
+    was_tracing = tracemalloc.is_tracing()
+    try:
+        memory = PhaseTracker('test')
+        memory.mark('small')
+        data = bytearray(2 * MB)
+        memory.mark('large')
+        del data
+        phases = memory.report()
+    finally:
+        if not was_tracing:
+            tracemalloc.stop()
+
+    assert list(phases) == ['small', 'large']
+    assert phases['small'] < MB <= 2 * MB <= phases['large']
+    logged = json.loads(capsys.readouterr().out)
+    assert logged == {'memory_profile': 'test', 'phases': phases, 'peak_bytes': phases['large']}
+
+def test_phase_tracker_is_a_no_op_by_default(capsys):
+    memory = PhaseTracker('test')
+    memory.mark('phase')
+    assert memory.report() == {}
+    assert capsys.readouterr().out == ''
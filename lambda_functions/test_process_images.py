@@ -0,0 +1,92 @@
+import json
+
+import boto3
+import pytest
+
+import process_images
+import upload_image
+from conftest import upload_event
+from image_metadata import decode_item
+
+@pytest.fixture
+def sqs(aws):
+    return boto3.client('sqs', region_name='us-east-1')
+
+def uploaded_image(user_id='alice'):
+    response = upload_image.lambda_handler(upload_event(user_id), None)
+    assert response['statusCode'] == 201
+    return json.loads(response['body'])['image_id']
+
+def queued_records(sqs, receive_count=1):
+    """The processing queue's messages as the SQS event source delivers them"""
+    queue_url = sqs.get_queue_url(QueueName=upload_image.PROCESSING_QUEUE_NAME)['QueueUrl']
+    messages = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10).get('Messages', [])
+    return [
+        {
+            'messageId': message['MessageId'],
+            'body': message['Body'],
+            'attributes': {'ApproximateReceiveCount': str(receive_count)}
+        }
+        for message in messages
+    ]
+
+def stored_item(aws, image_id):
+    return decode_item(aws.Table(process_images.DYNAMODB_TABLE).get_item(Key={'image_id': image_id})['Item'])
+
+def test_queued_upload_is_processed_and_marked_ready(aws, sqs):
+    image_id = uploaded_image()
+    records = queued_records(sqs)
+    assert [json.loads(record['body'])['image_id'] for record in records] == [image_id]
+
+    assert process_images.lambda_handler({'Records': records}, None) == {'batchItemFailures': []}
+    item = stored_item(aws, image_id)
+    assert item['status'] == 'ready'
+    assert item['processed'] == {'sha256', 'thumbnail', 'phash'}
+    assert len(item['sha256']) == 64 and item['phash']
+    thumbnail = boto3.client('s3', region_name='us-east-1').get_object(
+        Bucket=process_images.S3_BUCKET, Key=item['thumbnail_key']
+    )
+    assert thumbnail['ContentType'] == 'image/jpeg'
+
+def test_redelivered_job_only_reruns_missing_processors(aws, sqs, monkeypatch):
+    image_id = uploaded_image()
+    records = queued_records(sqs)
+    assert process_images.lambda_handler({'Records': records}, None) == {'batchItemFailures': []}
+    calls = []
+
+    def counting(name):
+        def run(item, image_bytes, s3_client):
+            calls.append(name)
+            return {name: 'done'}
+        return name, run
+    monkeypatch.setattr(process_images, 'PROCESSORS', [counting('sha256'), counting('added')])
+
+    # A duplicate delivery after a processor was added runs just that one
+    assert process_images.lambda_handler({'Records': records}, None) == {'batchItemFailures': []}
+    item = stored_item(aws, image_id)
+    assert calls == ['added']
+    assert item['added'] == 'done' and item['sha256'] != 'done'
+    assert item['processed'] == {'sha256', 'thumbnail', 'phash', 'added'}
+
+def test_failed_batch_item_is_reported_and_marked_failed_on_last_attempt(aws, sqs):
+    good, bad = uploaded_image(), uploaded_image('bob')
+    bad_item = stored_item(aws, bad)
+    boto3.client('s3', region_name='us-east-1').delete_object(Bucket=process_images.S3_BUCKET, Key=bad_item['s3_key'])
+    records = queued_records(sqs)
+    bad_record = next(record for record in records if json.loads(record['body'])['image_id'] == bad)
+
+    failures = process_images.lambda_handler({'Records': records}, None)['batchItemFailures']
+    assert failures == [{'itemIdentifier': bad_record['messageId']}]
+    assert stored_item(aws, good)['status'] == 'ready'
+    assert stored_item(aws, bad)['status'] == 'processing'
+
+    last_attempt = dict(bad_record, attributes={'ApproximateReceiveCount': str(process_images.MAX_RECEIVE_COUNT)})
+    process_images.lambda_handler({'Records': [last_attempt]}, None)
+    item = stored_item(aws, bad)
+    assert item['status'] == 'failed'
+    assert 'NoSuchKey' in item['processing_error']
+
+def test_job_for_deleted_image_is_skipped(aws, sqs):
+    image_id = uploaded_image()
+    aws.Table(process_images.DYNAMODB_TABLE).delete_item(Key={'image_id': image_id})
+    assert process_images.lambda_handler({'Records': queued_records(sqs)}, None) == {'batchItemFailures': []}
@@ -0,0 +1,57 @@
+import json
+
+import pytest
+
+import router
+import setup_infrastructure as infra
+from conftest import upload_event
+
+@pytest.fixture(autouse=True)
+def consolidated_routes(monkeypatch):
+    """The ROUTES environment the consolidated function is deployed with"""
+    routes = json.loads(infra.consolidated_function()['environment']['ROUTES'])
+    monkeypatch.setattr(router, 'ROUTES', routes)
+    monkeypatch.setattr(router, '_handlers', {})
+
+def call(method, resource, **event):
+    response = router.lambda_handler(dict(event, httpMethod=method, resource=resource), None)
+    return response['statusCode'], json.loads(response['body']), response['headers']
+
+def test_every_api_route_has_a_handler():
+    assert set(router.ROUTES) == {infra.route_key(route) for route in infra.API_ROUTES}
+    package = infra.consolidated_function()
+    for route in router.ROUTES:
+        assert callable(router.get_handler(route))
+        module_name = router.ROUTES[route].split('.')[0]
+        assert f'lambda_functions/{module_name}.py' in [package['file']] + package['modules']
+
+def test_routes_dispatch_to_their_handlers(aws):
+    status, uploaded, _ = call('POST', '/images', **upload_event('alice'))
+    assert status == 201
+    image_id = uploaded['image_id']
+
+    status, body, _ = call('GET', '/images/{image_id}', pathParameters={'image_id': image_id},
+                           queryStringParameters={'metadata_only': 'true'})
+    assert (status, body['metadata']['image_id']) == (200, image_id)
+    status, body, _ = call('GET', '/users/{user_id}/stats', pathParameters={'user_id': 'alice'})
+    assert (status, body['image_count']) == (200, 1)
+    status, _, _ = call('DELETE', '/images/{image_id}', pathParameters={'image_id': image_id},
+                        body=json.dumps({'user_id': 'alice'}))
+    assert status == 200
+
+def test_handlers_are_imported_once():
+    handler = router.get_handler('GET /images')
+    assert router.get_handler('GET /images') is handler
+    assert list(router._handlers) == ['GET /images']
+
+def test_unknown_method_is_405_with_allow_header():
+    status, body, headers = call('PUT', '/images/{image_id}')
+    assert (status, body) == (405, {'error': 'Method not allowed'})
+    assert headers['Allow'] == 'DELETE, GET'
+    assert call('PATCH', '/images')[2]['Allow'] == 'GET, POST'
+
+def test_unknown_resource_is_404():
+    status, body, headers = call('GET', '/videos')
+    assert (status, body) == (404, {'error': 'Route not found'})
+    assert 'Allow' not in headers
+    assert router._handlers == {}
@@ -0,0 +1,252 @@
+import base64
+import json
+
+import pytest
+
+import image_metadata
+import upload_image
+from conftest import png_bytes, upload_event
+from idempotency import IDEMPOTENCY_TABLE, record_key
+from image_metadata import USER_STATS_TABLE
+
+@pytest.fixture(autouse=True)
+def no_sharded_cache(monkeypatch):
+    monkeypatch.setattr(upload_image, '_sharded_users', {})
+
+def upload(event):
+    response = upload_image.lambda_handler(event, None)
+    return response['statusCode'], json.loads(response['body']), response['headers']
+
+def image_count(aws):
+    return aws.Table(upload_image.DYNAMODB_TABLE).scan(Select='COUNT')['Count']
+
+def stored_objects(aws):
+    import boto3
+
+    s3 = boto3.client('s3', region_name='us-east-1')
+    return s3.list_objects_v2(Bucket=upload_image.S3_BUCKET).get('KeyCount', 0)
+
+def stats(aws, user_id):
+    return aws.Table(USER_STATS_TABLE).get_item(Key={'user_id': user_id}).get('Item', {})
+
+def test_retry_with_idempotency_key_replays_response(aws):
+    status, body, _ = upload(upload_event('alice', idempotency_key='k1'))
+    assert status == 201
+
+    status, replayed, headers = upload(upload_event('alice', idempotency_key='k1'))
+    assert status == 201
+    assert headers['Idempotent-Replayed'] == 'true'
+    assert replayed['image_id'] == body['image_id']
+    assert image_count(aws) == 1
+    assert stats(aws, 'alice')['image_count'] == 1
+
+def test_idempotency_key_reused_for_other_upload_is_422(aws):
+    assert upload(upload_event('alice', idempotency_key='k1'))[0] == 201
+
+    status, body, _ = upload(upload_event('alice', color='blue', idempotency_key='k1'))
+    assert status == 422
+    assert image_count(aws) == 1
+
+def test_idempotency_keys_are_scoped_per_user(aws):
+    assert upload(upload_event('alice', idempotency_key='k1'))[0] == 201
+    assert upload(upload_event('bob', idempotency_key='k1'))[0] == 201
+    assert image_count(aws) == 2
+
+def test_idempotency_key_in_progress_is_409(aws):
+    import time
+
+    assert upload(upload_event('alice', idempotency_key='k1'))[0] == 201
+    # The same request still running elsewhere: a fresh in-progress claim
+    aws.Table(IDEMPOTENCY_TABLE).update_item(
+        Key={'idempotency_key': record_key('alice', 'k1')},
+        UpdateExpression='SET #status = :in_progress, claimed_at = :now',
+        ExpressionAttributeNames={'#status': 'status'},
+        ExpressionAttributeValues={':in_progress': 'in_progress', ':now': int(time.time())}
+    )
+
+    status, _, headers = upload(upload_event('alice', idempotency_key='k1'))
+    assert status == 409
+    assert headers['Retry-After'] == '1'
+    assert image_count(aws) == 1
+
+def test_refused_upload_releases_idempotency_key(aws, monkeypatch):
+    monkeypatch.setattr(image_metadata, 'USER_QUOTA_IMAGES', 1)
+    assert upload(upload_event('alice'))[0] == 201
+    assert upload(upload_event('alice', color='blue', idempotency_key='k1'))[0] == 403
+
+    # Not replayed: once there is room, the retry runs again
+    monkeypatch.setattr(image_metadata, 'USER_QUOTA_IMAGES', 2)
+    assert upload(upload_event('alice', color='blue', idempotency_key='k1'))[0] == 201
+    assert image_count(aws) == 2
+
+def test_invalid_tags_rejected_before_storing(aws):
+    status, body, _ = upload(upload_event('alice', tags='not-a-list'))
+    assert status == 400
+    assert upload(upload_event('alice', tags=['ok', ' ']))[0] == 400
+    assert stored_objects(aws) == 0
+
+def test_recent_list_keeps_entry_of_concurrent_upload(aws, concurrent_write):
+    assert upload(upload_event('alice'))[0] == 201
+    other = {'i': 'other-image', 't': '', 'f': 'other.png', 'c': '2000-01-01T00:00:00'}
+
+    def other_upload():
+        aws.Table(USER_STATS_TABLE).update_item(
+            Key={'user_id': 'alice'},
+            UpdateExpression='SET recent = list_append(recent, :entry) ADD recent_version :one',
+            ExpressionAttributeValues={':entry': [other], ':one': 1}
+        )
+    concurrent_write(other_upload)
+
+    status, body, _ = upload(upload_event('alice', color='blue'))
+    assert status == 201
+    item = stats(aws, 'alice')
+    assert item['image_count'] == 2
+    ids = [entry['i'] for entry in item['recent']]
+    assert ids[0] == body['image_id']
+    assert 'other-image' in ids
+    assert item['recent_version'] == 3
+
+def test_recent_list_dropped_after_repeated_conflicts(aws, concurrent_write):
+    assert upload(upload_event('alice'))[0] == 201
+
+    def conflicting_write():
+        aws.Table(USER_STATS_TABLE).update_item(
+            Key={'user_id': 'alice'},
+            UpdateExpression='ADD recent_version :one',
+            ExpressionAttributeValues={':one': 1}
+        )
+    concurrent_write(conflicting_write, times=image_metadata.RECENT_WRITE_ATTEMPTS - 1)
+
+    # The upload still succeeds; the next listing rebuilds the list
+    assert upload(upload_event('alice', color='blue'))[0] == 201
+    item = stats(aws, 'alice')
+    assert item['image_count'] == 2
+    assert 'recent' not in item
+
+def test_concurrent_upload_filling_quota_is_403(aws, monkeypatch, concurrent_write):
+    monkeypatch.setattr(image_metadata, 'USER_QUOTA_IMAGES', 2)
+    assert upload(upload_event('alice'))[0] == 201
+
+    def other_upload():
+        aws.Table(USER_STATS_TABLE).update_item(
+            Key={'user_id': 'alice'},
+            UpdateExpression='ADD image_count :one, recent_version :one',
+            ExpressionAttributeValues={':one': 1}
+        )
+    concurrent_write(other_upload)
+
+    status, body, _ = upload(upload_event('alice', color='blue'))
+    assert status == 403
+    assert 'quota' in body['error']
+    assert image_count(aws) == 1
+    # The stored object is removed again
+    assert stored_objects(aws) == 1
+
+def test_sharded_user_quota_is_split_across_counter_items(aws, monkeypatch):
+    monkeypatch.setattr(image_metadata, 'USER_QUOTA_IMAGES', 5)
+    stats_table = aws.Table(USER_STATS_TABLE)
+    # One image from before sharding, in the user's own item
+    assert upload(upload_event('hot'))[0] == 201
+    stats_table.update_item(
+        Key={'user_id': 'hot'},
+        UpdateExpression='SET key_shards = :shards',
+        ExpressionAttributeValues={':shards': 2}
+    )
+
+    statuses = [upload(upload_event('hot', color=(n, 0, 0)))[0] for n in range(12)]
+    assert set(statuses) == {201, 403}
+    # Each shard may hold (5 - 1) // 2 images
+    for shard in range(2):
+        counters = stats(aws, f'hot#{shard}')
+        assert counters.get('image_count', 0) <= 2
+    assert image_count(aws) == 1 + statuses.count(201)
+    assert image_count(aws) <= 5
+
+def test_upload_records_sniffed_format_and_dimensions(aws):
+    status, body, _ = upload(upload_event('alice'))
+    assert status == 201
+    metadata = body['metadata']
+    assert (metadata['format'], metadata['width'], metadata['height']) == ('PNG', 8, 8)
+    assert metadata['content_type'] == 'image/png'
+
+def test_upload_rejects_content_not_matching_extension(aws):
+    status, body, _ = upload(upload_event('alice', filename='photo.jpg'))
+    assert status == 400
+    assert 'does not match' in body['error']
+    assert upload(upload_event('alice', image_data='bm90IGFuIGltYWdl'))[0] == 400
+    assert stored_objects(aws) == 0
+
+def test_responses_leave_out_index_attributes(aws):
+    import list_images
+    import view_image
+
+    aws.Table(USER_STATS_TABLE).put_item(Item={'user_id': 'hot', 'key_shards': 2})
+    status, body, _ = upload(upload_event('hot'))
+    assert status == 201
+    internal = {'created_day', 'created_sort', 'user_key', 'v'}
+    assert not internal & set(body['metadata'])
+
+    listed = json.loads(list_images.lambda_handler({'queryStringParameters': {'user_id': 'hot'}}, None)['body'])
+    assert listed['images'][0]['user_id'] == 'hot'
+    assert not internal & set(listed['images'][0])
+    viewed = view_image.lambda_handler(
+        {'pathParameters': {'image_id': body['image_id']}, 'queryStringParameters': {'metadata_only': 'true'}}, None
+    )
+    assert not internal & set(json.loads(viewed['body'])['metadata'])
+
+def multipart_event(fields, image, boundary='test-boundary'):
+    """A multipart/form-data upload, base64 encoded as API Gateway passes binary bodies"""
+    parts = [
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode('utf-8')
+        for name, value in fields
+    ]
+    if image is not None:
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="image"; filename="photo.png"\r\n'
+            'Content-Type: image/png\r\n\r\n'.encode('utf-8') + image + b'\r\n'
+        )
+    body = b''.join(parts) + f'--{boundary}--\r\n'.encode('utf-8')
+    return {
+        'headers': {'Content-Type': f'multipart/form-data; boundary={boundary}'},
+        'body': base64.b64encode(body).decode('utf-8'),
+        'isBase64Encoded': True
+    }
+
+def stored_image(body):
+    import boto3
+
+    s3 = boto3.client('s3', region_name='us-east-1')
+    return s3.get_object(Bucket=upload_image.S3_BUCKET, Key=body['metadata']['s3_key'])['Body'].read()
+
+def test_multipart_upload(aws):
+    image = png_bytes()
+    event = multipart_event([('user_id', 'alice'), ('title', 'Sunset'), ('tags', 'a, b'), ('tags', 'c')], image)
+    status, body, _ = upload(event)
+    assert status == 201
+    assert body['metadata']['title'] == 'Sunset'
+    assert body['metadata']['tags'] == ['a', 'b', 'c']
+    assert body['metadata']['filename'] == 'photo.png'
+    assert stored_image(body) == image
+
+def test_multipart_upload_without_file_or_boundary_is_400(aws):
+    assert upload(multipart_event([('user_id', 'alice')], None))[0] == 400
+    event = multipart_event([('user_id', 'alice')], png_bytes())
+    event['headers']['Content-Type'] = 'multipart/form-data'
+    status, body, _ = upload(event)
+    assert status == 400
+    assert 'boundary' in body['error']
+    assert stored_objects(aws) == 0
+
+def test_raw_upload_with_metadata_in_headers_and_query(aws):
+    image = png_bytes()
+    event = {
+        'headers': {'Content-Type': 'image/png', 'X-Title': 'Raw', 'X-Tags': 'x,y'},
+        'queryStringParameters': {'user_id': 'alice'},
+        'body': image.decode('latin-1')
+    }
+    status, body, _ = upload(event)
+    assert status == 201
+    assert (body['metadata']['title'], body['metadata']['tags']) == ('Raw', ['x', 'y'])
+    # Named after the content type when no filename is given
+    assert body['metadata']['filename'] == 'upload.png'
+    assert stored_image(body) == image
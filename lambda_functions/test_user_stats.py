@@ -0,0 +1,35 @@
+import json
+
+import upload_image
+import user_stats
+from conftest import upload_event
+from image_metadata import USER_STATS_TABLE
+
+def stats(user_id):
+    response = user_stats.lambda_handler({'pathParameters': {'user_id': user_id}}, None)
+    return response['statusCode'], json.loads(response['body'])
+
+def test_stats_sum_own_and_shard_counter_items(aws, monkeypatch):
+    monkeypatch.setattr(upload_image, '_sharded_users', {})
+    assert upload_image.lambda_handler(upload_event('hot'), None)['statusCode'] == 201
+    aws.Table(USER_STATS_TABLE).update_item(
+        Key={'user_id': 'hot'},
+        UpdateExpression='SET key_shards = :shards',
+        ExpressionAttributeValues={':shards': 4}
+    )
+    for n in range(6):
+        assert upload_image.lambda_handler(upload_event('hot', color=(n, 0, 0)), None)['statusCode'] == 201
+
+    status, body = stats('hot')
+    assert status == 200
+    assert body['image_count'] == 7
+    assert body['by_content_type']['image/png']['count'] == 7
+
+def test_user_ids_with_shard_separator_are_400(aws):
+    import list_images
+
+    assert stats('hot#0')[0] == 400
+    assert upload_image.lambda_handler(upload_event('hot#0'), None)['statusCode'] == 400
+    listing = list_images.lambda_handler({'queryStringParameters': {'user_id': 'hot#0'}}, None)
+    assert listing['statusCode'] == 400
+    assert not aws.Table(USER_STATS_TABLE).scan()['Items']
@@ -1,53 +1,353 @@
 import json
-import boto3
-import base64
-import uuid
+import binascii
 import os
-from datetime import datetime
+import time
 from botocore.exceptions import ClientError
-import mimetypes
+from aws_clients import get_client, get_resource, prewarm
+from idempotency import (
+    IDEMPOTENCY_TABLE, MAX_KEY_LENGTH, claim_key, complete_key, record_key, release_key, request_fingerprint
+)
+from image_inspect import inspect_image, ImageValidationError, FORMAT_EXTENSIONS
+from memory_profile import PhaseTracker, budget_error
+from image_metadata import (
+    USER_STATS_TABLE, RECENT_WRITE_ATTEMPTS, image_s3_key, image_shard, user_key, build_image_item, encode_item,
+    public_item, user_id_error, processing_job, usage_update, quota_limits, quota_error, add_quota_condition, insert_recent,
+    set_recent
+)
 
 S3_BUCKET = os.environ.get('S3_BUCKET', 'image-storage-bucket')
 DYNAMODB_TABLE = os.environ.get('DYNAMODB_TABLE', 'image-metadata')
-LOCALSTACK_ENDPOINT = os.environ.get('LOCALSTACK_ENDPOINT', 'http://localhost:4566')
+PROCESSING_QUEUE_NAME = os.environ.get('PROCESSING_QUEUE_NAME', 'image-processing-queue')
+MAX_FILE_SIZE = 10 * 1024 * 1024
+# Base64 characters decoded per step when streaming a body; a multiple of 4
+# so every chunk decodes on its own
+DECODE_CHUNK_SIZE = 256 * 1024
+
+# Extension -> content type for the formats we accept. Replaces
+# mimetypes.guess_type, which reads the system MIME tables on first use.
+CONTENT_TYPES = {
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+    '.gif': 'image/gif',
+    '.bmp': 'image/bmp',
+    '.webp': 'image/webp'
+}
 
 def get_clients():
-    s3_client = boto3.client(
-        's3',
-        endpoint_url=LOCALSTACK_ENDPOINT,
-        aws_access_key_id='test',
-        aws_secret_access_key='test',
-        region_name='us-east-1'
-    )
-    
-    dynamodb = boto3.resource(
-        'dynamodb',
-        endpoint_url=LOCALSTACK_ENDPOINT,
-        aws_access_key_id='test',
-        aws_secret_access_key='test',
-        region_name='us-east-1'
-    )
-    
-    return s3_client, dynamodb
+    """Return AWS clients, shared with every other handler in the container"""
+    return get_client('s3'), get_resource('dynamodb'), get_client('sqs')
+
+_queue_url = None
+
+def get_queue_url(sqs_client):
+    global _queue_url
+    if _queue_url is None:
+        _queue_url = sqs_client.get_queue_url(QueueName=PROCESSING_QUEUE_NAME)['QueueUrl']
+    return _queue_url
+
+def enqueue_processing(sqs_client, metadata_item):
+    """
+    Hand the image to the post-upload worker. A failure leaves the item in
+    'processing' rather than failing an upload that is already stored.
+    """
+    try:
+        sqs_client.send_message(
+            QueueUrl=get_queue_url(sqs_client),
+            MessageBody=json.dumps(processing_job(metadata_item))
+        )
+    except ClientError as e:
+        print(f"Warning: Failed to enqueue processing for {metadata_item['image_id']}: {e}")
+
+# A sharded user's own user-stats item is cached per container for this many
+# seconds, so their uploads do not all read that one item. key_shards only
+# grows and the counters there (images from before sharding) only shrink;
+# until a raised shard count is picked up, a user close to the quota can
+# overshoot it.
+SHARDED_USER_TTL = int(os.environ.get('SHARDED_USER_TTL', 60))
+# What uploads read from user-stats: the quota counters, the shard count and
+# the recent list, not the per-content-type counters
+USAGE_PROJECTION = 'key_shards, image_count, total_bytes, recent, recent_version'
+COUNTER_PROJECTION = 'image_count, total_bytes'
+
+_sharded_users = {}
+
+def read_usage(stats_table, user_id):
+    """The user's user-stats item and key_shards, from the container cache for sharded users"""
+    cached = _sharded_users.get(user_id)
+    if cached and cached[0] > time.monotonic():
+        return cached[1], int(cached[1]['key_shards'])
+    usage = stats_table.get_item(Key={'user_id': user_id}, ProjectionExpression=USAGE_PROJECTION).get('Item', {})
+    key_shards = int(usage.get('key_shards', 0))
+    if key_shards:
+        _sharded_users[user_id] = (time.monotonic() + SHARDED_USER_TTL, usage)
+    return usage, key_shards
+
+def get_header(event, name):
+    """Case-insensitive lookup in the API Gateway headers map"""
+    name = name.lower()
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+class UploadError(Exception):
+    """A malformed upload request, answered with a 400"""
+
+class MemoryBudgetError(UploadError):
+    """An upload too large to parse within the memory budget, answered with a 413"""
+
+def split_tags(values):
+    tags = []
+    for value in values:
+        tags.extend(tag.strip() for tag in value.split(',') if tag.strip())
+    return tags
+
+def iter_body_bytes(event):
+    """
+    Yield the raw request body in chunks. Base64 bodies are decoded chunk by
+    chunk so the full decoded body never has to exist next to the image.
+    """
+    body = event.get('body') or ''
+    if not event.get('isBase64Encoded', False):
+        yield body.encode('latin-1')
+        return
+    for start in range(0, len(body), DECODE_CHUNK_SIZE):
+        yield binascii.a2b_base64(body[start:start + DECODE_CHUNK_SIZE])
+
+def parse_json_body(event):
+    body = event.get('body') or ''
+    try:
+        if event.get('isBase64Encoded', False):
+            # Decoded to str up front so the bytes are freed before parsing;
+            # json.loads(bytes) would hold them, its own str copy and the result
+            body = binascii.a2b_base64(body).decode('utf-8')
+        body = json.loads(body)
+    except ValueError:
+        raise UploadError('Request body must be valid JSON')
+    if not isinstance(body, dict):
+        raise UploadError('Request body must be a JSON object')
+
+    tags = body.get('tags', [])
+    if not isinstance(tags, list) or not all(isinstance(tag, str) and tag.strip() for tag in tags):
+        raise UploadError('tags must be a list of non-empty strings')
+
+    image_data = body.pop('image_data', None)
+    fields = {
+        'user_id': body.get('user_id'),
+        'title': body.get('title', ''),
+        'description': body.get('description', ''),
+        'tags': [tag.strip() for tag in tags],
+        'filename': body.get('filename'),
+        'image_bytes': None
+    }
+    if image_data:
+        try:
+            # a2b_base64 reads an ASCII str in place; base64.b64decode would
+            # first copy it to bytes
+            fields['image_bytes'] = binascii.a2b_base64(image_data)
+        except (binascii.Error, ValueError):
+            raise UploadError('Invalid base64 image data')
+    return fields
+
+def parse_multipart_body(event, content_type):
+    """
+    Parse multipart/form-data with the streaming parser. Text parts become
+    metadata fields; the first part with a filename is the image, written
+    straight into one buffer as the body is decoded.
+    """
+    from multipart.multipart import MultipartParser, parse_options_header
+
+    _, options = parse_options_header(content_type)
+    boundary = options.get(b'boundary')
+    if not boundary:
+        raise UploadError('Missing multipart boundary')
+
+    text_fields = {}
+    image = bytearray()
+    state = {'header_field': b'', 'header_value': b'', 'name': None, 'filename': None,
+             'value': None, 'is_image': False, 'image_filename': None}
+
+    def on_part_begin():
+        state.update(name=None, filename=None, value=bytearray(), is_image=False)
+
+    def on_header_field(data, start, end):
+        state['header_field'] += data[start:end]
+
+    def on_header_value(data, start, end):
+        state['header_value'] += data[start:end]
+
+    def on_header_end():
+        if state['header_field'].lower() == b'content-disposition':
+            _, disposition = parse_options_header(state['header_value'])
+            state['name'] = disposition.get(b'name', b'').decode('utf-8')
+            if b'filename' in disposition:
+                state['filename'] = disposition[b'filename'].decode('utf-8')
+        state['header_field'] = b''
+        state['header_value'] = b''
+
+    def on_headers_finished():
+        if state['filename'] is not None and state['image_filename'] is None:
+            state['is_image'] = True
+            state['image_filename'] = state['filename']
+
+    def on_part_data(data, start, end):
+        if state['is_image']:
+            image.extend(data[start:end])
+            if len(image) > MAX_FILE_SIZE:
+                raise UploadError('File size exceeds 10MB limit')
+        elif state['filename'] is None:
+            state['value'].extend(data[start:end])
+
+    def on_part_end():
+        if not state['is_image'] and state['filename'] is None and state['name']:
+            text_fields.setdefault(state['name'], []).append(state['value'].decode('utf-8'))
+
+    parser = MultipartParser(boundary, callbacks={
+        'on_part_begin': on_part_begin,
+        'on_part_data': on_part_data,
+        'on_part_end': on_part_end,
+        'on_header_field': on_header_field,
+        'on_header_value': on_header_value,
+        'on_header_end': on_header_end,
+        'on_headers_finished': on_headers_finished
+    })
+    try:
+        for chunk in iter_body_bytes(event):
+            parser.write(chunk)
+        parser.finalize()
+    except (binascii.Error, ValueError) as e:
+        raise UploadError(f'Malformed multipart body: {e}')
+
+    def first(name, default=None):
+        return text_fields.get(name, [default])[0]
+
+    return {
+        'user_id': first('user_id'),
+        'title': first('title', ''),
+        'description': first('description', ''),
+        'tags': split_tags(text_fields.get('tags', [])),
+        'filename': first('filename') or state['image_filename'],
+        'image_bytes': image if state['image_filename'] is not None else None
+    }
+
+def parse_raw_body(event, content_type):
+    """Raw image body; metadata comes from X- headers or the query string"""
+    query_params = event.get('queryStringParameters') or {}
+
+    def field(name, default=None):
+        header_value = get_header(event, 'X-' + name.replace('_', '-'))
+        return header_value if header_value is not None else query_params.get(name, default)
+
+    body = event.get('body') or ''
+    decoded_size = len(body) * 3 // 4 if event.get('isBase64Encoded', False) else len(body)
+    if decoded_size > MAX_FILE_SIZE + 2:
+        raise UploadError('File size exceeds 10MB limit')
+    if event.get('isBase64Encoded', False):
+        try:
+            image_bytes = binascii.a2b_base64(body)
+        except (binascii.Error, ValueError):
+            raise UploadError('Invalid base64 image data')
+    else:
+        image_bytes = body.encode('latin-1')
+
+    filename = field('filename')
+    if not filename:
+        media_type = content_type.split(';')[0].strip().lower()
+        extension = next((ext for ext, ctype in CONTENT_TYPES.items() if ctype == media_type), '')
+        filename = f"upload{extension}"
+
+    tags = field('tags')
+    return {
+        'user_id': field('user_id'),
+        'title': field('title', ''),
+        'description': field('description', ''),
+        'tags': split_tags([tags]) if tags else [],
+        'filename': filename,
+        'image_bytes': image_bytes or None
+    }
+
+# Bytes per pixel of a decoded image by PIL mode (4 for anything else)
+MODE_BYTES = {'1': 1, 'L': 1, 'P': 1, 'LA': 2, 'PA': 2, 'I;16': 2, 'RGB': 3, 'YCbCr': 3, 'LAB': 3, 'HSV': 3}
+
+def projected_parse_peak(event, media_type):
+    """
+    Bytes parsing the body allocates at its peak, from the body length alone
+    (see `python tools/benchmark.py memory`)
+    """
+    size = len(event.get('body') or '')
+    if event.get('isBase64Encoded', False):
+        size = size * 3 // 4
+    if media_type == 'multipart/form-data':
+        # The image buffer, with bytearray over-allocation
+        return size * 9 // 8
+    if media_type.startswith('image/') or media_type == 'application/octet-stream':
+        return size
+    # The decoded JSON document, then the document and its image_data string
+    return size * 2
+
+def projected_hash_peak(image_size, image_info):
+    """Perceptual hashing holds the image, its decoded pixels and a grayscale copy"""
+    pixels = image_info['width'] * image_info['height']
+    return image_size + pixels * (MODE_BYTES.get(image_info['mode'], 4) + 1)
+
+def parse_upload(event):
+    """
+    Extract metadata and image bytes from any supported request format:
+    JSON with base64 image_data, multipart/form-data, or a raw image/* body.
+    """
+    content_type = (get_header(event, 'Content-Type') or 'application/json').strip()
+    media_type = content_type.split(';')[0].strip().lower()
+    memory_message = budget_error(projected_parse_peak(event, media_type))
+    if memory_message:
+        raise MemoryBudgetError(memory_message)
+    if media_type == 'multipart/form-data':
+        return parse_multipart_body(event, content_type)
+    if media_type.startswith('image/') or media_type == 'application/octet-stream':
+        return parse_raw_body(event, content_type)
+    return parse_json_body(event)
 
 def lambda_handler(event, context):
+    memory = PhaseTracker('upload')
+    claimed_key = None
     try:
-        s3_client, dynamodb = get_clients()
-        table = dynamodb.Table(DYNAMODB_TABLE)
+        s3_client, dynamodb, sqs_client = get_clients()
+        idempotency_key = get_header(event, 'Idempotency-Key')
+        if idempotency_key is not None and not 0 < len(idempotency_key) <= MAX_KEY_LENGTH:
+            return {
+                'statusCode': 400,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': '*'
+                },
+                'body': json.dumps({
+                    'error': f'Idempotency-Key must be 1-{MAX_KEY_LENGTH} characters'
+                })
+            }
         
-        if event.get('isBase64Encoded', False):
-            body = base64.b64decode(event['body'])
-        else:
-            body = json.loads(event['body'])
-
-        user_id = body.get('user_id')
-        title = body.get('title', '')
-        description = body.get('description', '')
-        tags = body.get('tags', [])
-        image_data = body.get('image_data') 
-        filename = body.get('filename')
+        try:
+            upload = parse_upload(event)
+            memory.mark('parse')
+        except UploadError as e:
+            return {
+                'statusCode': 413 if isinstance(e, MemoryBudgetError) else 400,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': '*'
+                },
+                'body': json.dumps({
+                    'error': str(e)
+                })
+            }
+
+        user_id = upload['user_id']
+        title = upload['title']
+        description = upload['description']
+        tags = upload['tags']
+        image_bytes = upload['image_bytes']
+        filename = upload['filename']
         
-        if not all([user_id, image_data, filename]):
+        if not all([user_id, image_bytes, filename]):
             return {
                 'statusCode': 400,
                 'headers': {
@@ -59,10 +359,21 @@ def lambda_handler(event, context):
                 })
             }
         
-        image_id = str(uuid.uuid4())
+        user_id_message = user_id_error(user_id)
+        if user_id_message:
+            return {
+                'statusCode': 400,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': '*'
+                },
+                'body': json.dumps({
+                    'error': user_id_message
+                })
+            }
+
         file_extension = os.path.splitext(filename)[1].lower()
-        content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
-        allowed_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp'}
+        allowed_extensions = set(CONTENT_TYPES)
         if file_extension not in allowed_extensions:
             return {
                 'statusCode': 400,
@@ -74,9 +385,22 @@ def lambda_handler(event, context):
                     'error': f'File type not allowed. Allowed types: {list(allowed_extensions)}'
                 })
             }
+        if len(image_bytes) > MAX_FILE_SIZE:
+            return {
+                'statusCode': 400,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': '*'
+                },
+                'body': json.dumps({
+                    'error': 'File size exceeds 10MB limit'
+                })
+            }
+        # Trust the bytes, not the filename: sniff the format and read the header
         try:
-            image_bytes = base64.b64decode(image_data)
-        except Exception as e:
+            image_info = inspect_image(image_bytes)
+            memory.mark('inspect')
+        except ImageValidationError as e:
             return {
                 'statusCode': 400,
                 'headers': {
@@ -84,10 +408,10 @@ def lambda_handler(event, context):
                     'Access-Control-Allow-Origin': '*'
                 },
                 'body': json.dumps({
-                    'error': 'Invalid base64 image data'
+                    'error': str(e)
                 })
             }
-        if len(image_bytes) > 10 * 1024 * 1024:
+        if file_extension not in FORMAT_EXTENSIONS[image_info['format']]:
             return {
                 'statusCode': 400,
                 'headers': {
@@ -95,10 +419,125 @@ def lambda_handler(event, context):
                     'Access-Control-Allow-Origin': '*'
                 },
                 'body': json.dumps({
-                    'error': 'File size exceeds 10MB limit'
+                    'error': f"File extension '{file_extension}' does not match image content ({image_info['format']})"
+                })
+            }
+        if idempotency_key is not None:
+            # Claimed before any S3 work: a retry of a stored upload is
+            # answered from the record, and one racing the original is refused
+            idempotency_table = dynamodb.Table(IDEMPOTENCY_TABLE)
+            key = record_key(user_id, idempotency_key)
+            fingerprint = request_fingerprint(upload)
+            existing = claim_key(idempotency_table, key, fingerprint)
+            if existing is not None and existing['fingerprint'] != fingerprint:
+                return {
+                    'statusCode': 422,
+                    'headers': {
+                        'Content-Type': 'application/json',
+                        'Access-Control-Allow-Origin': '*'
+                    },
+                    'body': json.dumps({
+                        'error': 'Idempotency-Key was already used for a different upload'
+                    })
+                }
+            if existing is not None and existing['status'] == 'completed':
+                return {
+                    'statusCode': int(existing['status_code']),
+                    'headers': {
+                        'Content-Type': 'application/json',
+                        'Access-Control-Allow-Origin': '*',
+                        'Idempotent-Replayed': 'true'
+                    },
+                    'body': existing['response_body']
+                }
+            if existing is not None:
+                return {
+                    'statusCode': 409,
+                    'headers': {
+                        'Content-Type': 'application/json',
+                        'Access-Control-Allow-Origin': '*',
+                        'Retry-After': '1'
+                    },
+                    'body': json.dumps({
+                        'error': 'An upload with this Idempotency-Key is still in progress'
+                    })
+                }
+            claimed_key = key
+        # Only needed once the request has been validated
+        import uuid
+
+        image_id = str(uuid.uuid4())
+        # Quota check, the user's key sharding and recent list: one point read before any S3 work
+        stats_table = dynamodb.Table(USER_STATS_TABLE)
+        usage, key_shards = read_usage(stats_table, user_id)
+        counter_key = user_id
+        limits = quota_limits()
+        if key_shards:
+            # A sharded user's counters are spread over one item per shard;
+            # this image counts towards the item of its own shard
+            counter_key = user_key(user_id, image_shard(image_id, key_shards))
+            limits = quota_limits(usage, key_shards)
+            usage = {}
+            if limits != (None, None):
+                usage = stats_table.get_item(
+                    Key={'user_id': counter_key}, ProjectionExpression=COUNTER_PROJECTION
+                ).get('Item', {})
+        quota_message = quota_error(usage, len(image_bytes), limits)
+        if quota_message:
+            return {
+                'statusCode': 403,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': '*'
+                },
+                'body': json.dumps({
+                    'error': quota_message
                 })
             }
-        s3_key = f"images/{user_id}/{image_id}{file_extension}"
+        query_params = event.get('queryStringParameters') or {}
+        phash = None
+        if query_params.get('reject_duplicates', 'false').lower() == 'true':
+            # Decodes the pixels, so only done when asked for; otherwise the
+            # worker hashes the image after the upload
+            from image_similarity import (
+                DUPLICATE_MAX_DISTANCE, format_hash, get_user_index, perceptual_hash
+            )
+
+            memory_message = budget_error(projected_hash_peak(len(image_bytes), image_info))
+            if memory_message:
+                return {
+                    'statusCode': 413,
+                    'headers': {
+                        'Content-Type': 'application/json',
+                        'Access-Control-Allow-Origin': '*'
+                    },
+                    'body': json.dumps({
+                        'error': f'{memory_message}; retry without reject_duplicates'
+                    })
+                }
+            phash = perceptual_hash(image_bytes)
+            user_index = get_user_index(dynamodb.Table(DYNAMODB_TABLE), user_id, key_shards)
+            duplicates = user_index.search(phash, DUPLICATE_MAX_DISTANCE, limit=10)
+            memory.mark('phash')
+            if duplicates:
+                return {
+                    'statusCode': 409,
+                    'headers': {
+                        'Content-Type': 'application/json',
+                        'Access-Control-Allow-Origin': '*'
+                    },
+                    'body': json.dumps({
+                        'error': 'Image is a near-duplicate of an existing image',
+                        'duplicates': [
+                            {'image_id': duplicate_id, 'distance': distance}
+                            for duplicate_id, distance in duplicates
+                        ]
+                    })
+                }
+        from datetime import datetime
+
+        content_type = image_info['content_type']
+        s3_key = image_s3_key(user_id, image_id, file_extension)
         s3_client.put_object(
             Bucket=S3_BUCKET,
             Key=s3_key,
@@ -110,25 +549,70 @@ def lambda_handler(event, context):
                 'description': description
             }
         )
+        memory.mark('store')
         timestamp = datetime.utcnow().isoformat()
         
-        metadata_item = {
-            'image_id': image_id,
-            'user_id': user_id,
-            's3_key': s3_key,
-            'filename': filename,
-            'title': title,
-            'description': description,
-            'tags': tags,
-            'content_type': content_type,
-            'file_size': len(image_bytes),
-            'created_at': timestamp,
-            'updated_at': timestamp
-        }
+        metadata_item = build_image_item(
+            image_id, user_id, filename, title, description, tags,
+            len(image_bytes), image_info, timestamp,
+            key_shards=key_shards
+        )
+        if phash is not None:
+            metadata_item['phash'] = format_hash(phash)
         
-        table.put_item(Item=metadata_item)
+        # The metadata item, the usage counters and the recent list change
+        # together or not at all
+        for attempt in range(RECENT_WRITE_ATTEMPTS):
+            stats_update = add_quota_condition(
+                usage_update(counter_key, content_type, len(image_bytes)), len(image_bytes), limits
+            )
+            if not key_shards:
+                # The last attempt drops the list rather than failing the upload
+                last_attempt = attempt == RECENT_WRITE_ATTEMPTS - 1
+                set_recent(stats_update, usage, None if last_attempt else insert_recent(usage.get('recent', []), metadata_item))
+            try:
+                dynamodb.meta.client.transact_write_items(TransactItems=[
+                    {
+                        'Put': {
+                            'TableName': DYNAMODB_TABLE,
+                            'Item': encode_item(metadata_item),
+                            'ConditionExpression': 'attribute_not_exists(image_id)'
+                        }
+                    },
+                    stats_update
+                ])
+                break
+            except dynamodb.meta.client.exceptions.TransactionCanceledException as e:
+                reasons = e.response.get('CancellationReasons', [])
+                if len(reasons) < 2 or reasons[1].get('Code') != 'ConditionalCheckFailed':
+                    s3_client.delete_object(Bucket=S3_BUCKET, Key=s3_key)
+                    raise
+                # Over quota, or another upload or delete changed the recent list
+                usage = stats_table.get_item(
+                    Key={'user_id': counter_key}, ConsistentRead=True,
+                    ProjectionExpression=COUNTER_PROJECTION if key_shards else USAGE_PROJECTION
+                ).get('Item', {})
+                quota_message = quota_error(usage, len(image_bytes), limits)
+                if quota_message or attempt == RECENT_WRITE_ATTEMPTS - 1:
+                    s3_client.delete_object(Bucket=S3_BUCKET, Key=s3_key)
+                    return {
+                        'statusCode': 403,
+                        'headers': {
+                            'Content-Type': 'application/json',
+                            'Access-Control-Allow-Origin': '*'
+                        },
+                        'body': json.dumps({
+                            'error': quota_message or 'Upload quota exceeded'
+                        })
+                    }
+        if phash is not None:
+            # Later uploads to this container see it before the index is rebuilt
+            user_index.add(image_id, phash)
+        # Hashing, thumbnails etc. run in the process-images worker
+        enqueue_processing(sqs_client, metadata_item)
+        memory.mark('metadata')
         
-        return {
+        response = {
             'statusCode': 201,
             'headers': {
                 'Content-Type': 'application/json',
@@ -137,9 +621,18 @@ def lambda_handler(event, context):
             'body': json.dumps({
                 'message': 'Image uploaded successfully',
                 'image_id': image_id,
-                'metadata': metadata_item
+                'metadata': public_item(metadata_item)
             })
         }
+        if claimed_key is not None:
+            try:
+                complete_key(idempotency_table, claimed_key, response)
+            except ClientError as e:
+                # The image is stored either way; without the record, retries
+                # get 409s until the claim counts as abandoned
+                print(f"Warning: Failed to record idempotent response for {image_id}: {e}")
+            claimed_key = None
+        return response
         
     except ClientError as e:
         print(f"AWS Client Error: {e}")
@@ -168,3 +661,14 @@ def lambda_handler(event, context):
                 'details': str(e)
             })
         }
+
+    finally:
+        if claimed_key is not None:
+            # Anything but a stored upload frees the key, so a retry runs again
+            try:
+                release_key(idempotency_table, claimed_key)
+            except ClientError as e:
+                print(f"Warning: Failed to release Idempotency-Key claim {claimed_key}: {e}")
+        memory.report()
+
+prewarm(get_clients)
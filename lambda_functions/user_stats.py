@@ -0,0 +1,103 @@
+import json
+import os
+from decimal import Decimal
+from aws_clients import get_resource, prewarm
+from image_metadata import USER_STATS_TABLE, USER_QUOTA_BYTES, USER_QUOTA_IMAGES, user_id_error, user_key
+
+
+def get_dynamodb():
+    """Return the DynamoDB resource, shared with every other handler in the container"""
+    return get_resource('dynamodb')
+
+def to_int(value):
+    return int(value) if isinstance(value, Decimal) else value
+
+def is_counter(attribute):
+    return attribute in ('image_count', 'total_bytes') or attribute.startswith(('count#', 'bytes#'))
+
+def read_usage(dynamodb, user_id):
+    """
+    The user's counters: their own user-stats item plus, for a sharded user,
+    the counter items of every shard (see image_metadata.usage_key)
+    """
+    table = dynamodb.Table(USER_STATS_TABLE)
+    usage = table.get_item(Key={'user_id': user_id}).get('Item', {})
+    keys = [{'user_id': user_key(user_id, shard)} for shard in range(int(usage.get('key_shards', 0)))]
+    for start in range(0, len(keys), 100):
+        request = {USER_STATS_TABLE: {'Keys': keys[start:start + 100]}}
+        while request:
+            response = dynamodb.batch_get_item(RequestItems=request)
+            for item in response['Responses'].get(USER_STATS_TABLE, []):
+                for attribute, value in item.items():
+                    if is_counter(attribute):
+                        usage[attribute] = usage.get(attribute, 0) + value
+            request = response.get('UnprocessedKeys')
+    return usage
+
+def summarize_usage(user_id, item):
+    """Turn the flat counter attributes of a user-stats item into the API shape"""
+    by_content_type = {}
+    for attribute, value in item.items():
+        kind, _, content_type = attribute.partition('#')
+        if kind in ('count', 'bytes') and content_type:
+            by_content_type.setdefault(content_type, {'count': 0, 'bytes': 0})[kind] = to_int(value)
+    return {
+        'user_id': user_id,
+        'image_count': to_int(item.get('image_count', 0)),
+        'total_bytes': to_int(item.get('total_bytes', 0)),
+        'by_content_type': {
+            content_type: counters
+            for content_type, counters in sorted(by_content_type.items())
+            if counters['count']
+        },
+        'quota': {
+            'max_bytes': USER_QUOTA_BYTES or None,
+            'max_images': USER_QUOTA_IMAGES or None
+        }
+    }
+
+def lambda_handler(event, context):
+    """Return a user's image count and storage usage from their counter items"""
+    try:
+        dynamodb = get_dynamodb()
+        user_id = event['pathParameters']['user_id']
+        user_id_message = user_id_error(user_id)
+        if user_id_message:
+            # Would read another user's shard counter item
+            return {
+                'statusCode': 400,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': '*'
+                },
+                'body': json.dumps({
+                    'error': user_id_message
+                })
+            }
+
+        usage = read_usage(dynamodb, user_id)
+        
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*'
+            },
+            'body': json.dumps(summarize_usage(user_id, usage))
+        }
+        
+    except Exception as e:
+        print(f"Error retrieving user stats: {e}")
+        return {
+            'statusCode': 500,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*'
+            },
+            'body': json.dumps({
+                'error': 'Failed to retrieve user stats',
+                'details': str(e)
+            })
+        }
+
+prewarm(get_dynamodb)
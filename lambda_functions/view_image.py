@@ -1,33 +1,28 @@
 import json
-import boto3
 import base64
 import os
+from decimal import Decimal
 from botocore.exceptions import ClientError
+from aws_clients import get_client, get_resource, prewarm
+from http_compression import compress_response, negotiate_encoding
+from image_metadata import decode_item
+from memory_profile import PhaseTracker, budget_error
 
 # Configuration
 S3_BUCKET = os.environ.get('S3_BUCKET', 'image-storage-bucket')
 DYNAMODB_TABLE = os.environ.get('DYNAMODB_TABLE', 'image-metadata')
-LOCALSTACK_ENDPOINT = os.environ.get('LOCALSTACK_ENDPOINT', 'http://localhost:4566')
 
 def get_clients():
-    """Initialize AWS clients"""
-    s3_client = boto3.client(
-        's3',
-        endpoint_url=LOCALSTACK_ENDPOINT,
-        aws_access_key_id='test',
-        aws_secret_access_key='test',
-        region_name='us-east-1'
-    )
-    
-    dynamodb = boto3.resource(
-        'dynamodb',
-        endpoint_url=LOCALSTACK_ENDPOINT,
-        aws_access_key_id='test',
-        aws_secret_access_key='test',
-        region_name='us-east-1'
-    )
-    
-    return s3_client, dynamodb
+    """Return AWS clients, shared with every other handler in the container"""
+    return get_client('s3'), get_resource('dynamodb')
+
+class DecimalEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, Decimal):
+            return int(obj) if obj % 1 == 0 else float(obj)
+        if isinstance(obj, set):
+            return sorted(obj)
+        return super(DecimalEncoder, self).default(obj)
 
 def lambda_handler(event, context):
     """
@@ -36,6 +31,7 @@ def lambda_handler(event, context):
     1. metadata_only=true - returns only metadata
     2. metadata_only=false/not provided - returns metadata + base64 encoded image
     """
+    memory = PhaseTracker('view')
     try:
         # Initialize clients
         s3_client, dynamodb = get_clients()
@@ -64,12 +60,13 @@ def lambda_handler(event, context):
                 })
             }
         
-        metadata = response['Item']
+        metadata = decode_item(response['Item'])
         s3_key = metadata['s3_key']
+        memory.mark('metadata')
         
         # If only metadata is requested
         if metadata_only:
-            return {
+            return compress_response(event, {
                 'statusCode': 200,
                 'headers': {
                     'Content-Type': 'application/json',
@@ -77,14 +74,34 @@ def lambda_handler(event, context):
                 },
                 'body': json.dumps({
                     'metadata': dict(metadata)
+                }, cls=DecimalEncoder)
+            })
+        
+        # Checked before the object is read. Encoding holds the raw bytes and
+        # their base64 bytes and str at once; compressing the document takes
+        # about as much again (see `python tools/benchmark.py memory`).
+        compressing = not download and negotiate_encoding(event.get('headers')) is not None
+        memory_message = budget_error(int(metadata['file_size']) * (8 if compressing else 4))
+        if memory_message:
+            return {
+                'statusCode': 413,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': '*'
+                },
+                'body': json.dumps({
+                    'error': memory_message
                 })
             }
-        
+
         # Get image from S3
         try:
             s3_response = s3_client.get_object(Bucket=S3_BUCKET, Key=s3_key)
-            image_data = s3_response['Body'].read()
             content_type = s3_response['ContentType']
+            # Encoded straight from the stream, so neither the raw bytes nor
+            # the base64 bytes outlive this line
+            image_base64 = base64.b64encode(s3_response['Body'].read()).decode('ascii')
+            memory.mark('read')
             
         except ClientError as e:
             if e.response['Error']['Code'] == 'NoSuchKey':
@@ -109,27 +126,32 @@ def lambda_handler(event, context):
                     'Content-Disposition': f'attachment; filename="{metadata["filename"]}"',
                     'Access-Control-Allow-Origin': '*'
                 },
-                'body': base64.b64encode(image_data).decode('utf-8'),
+                'body': image_base64,
                 'isBase64Encoded': True
             }
         
-        # Return metadata with base64 encoded image for viewing
-        image_base64 = base64.b64encode(image_data).decode('utf-8')
-        
-        response_data = {
+        # Return metadata with base64 encoded image for viewing. The image is
+        # spliced into the serialized metadata: json.dumps would scan it and
+        # copy it twice more.
+        metadata_json = json.dumps({
             'metadata': dict(metadata),
-            'image_data': image_base64,
             'content_type': content_type
-        }
-        
-        return {
+        }, cls=DecimalEncoder)
+        response = {
             'statusCode': 200,
             'headers': {
                 'Content-Type': 'application/json',
                 'Access-Control-Allow-Origin': '*'
             },
-            'body': json.dumps(response_data)
+            'body': f'{metadata_json[:-1]}, "image_data": "{image_base64}"}}'
         }
+        # Leave the response as the only holder of the document, so
+        # compression can release it
+        del image_base64
+        memory.mark('encode')
+        response = compress_response(event, response)
+        memory.mark('compress')
+        return response
         
     except Exception as e:
         print(f"Error retrieving image: {e}")
@@ -144,3 +166,8 @@ def lambda_handler(event, context):
                 'details': str(e)
             })
         }
+
+    finally:
+        memory.report()
+
+prewarm(get_clients)
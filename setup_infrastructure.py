@@ -1,43 +1,215 @@
 #!/usr/bin/env python3
 import boto3
+import base64
+import functools
+import hashlib
+import io
 import json
 import time
 import os
-import zipfile
 import shutil
+import subprocess
+import sys
+import tempfile
+import zipfile
+import py_compile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError
 
 LOCALSTACK_ENDPOINT = "http://localhost:4566"
 AWS_REGION = "us-east-1"
 S3_BUCKET_NAME = "image-storage-bucket"
 DYNAMODB_TABLE_NAME = "image-metadata"
+USER_STATS_TABLE_NAME = "user-stats"
+# Upload Idempotency-Key records, deleted by DynamoDB TTL once expired
+IDEMPOTENCY_TABLE_NAME = "idempotency-keys"
+IDEMPOTENCY_TTL_ATTRIBUTE = "expires_at"
+# Per-user upload limits; 0 means unlimited
+USER_QUOTA_BYTES = 0
+USER_QUOTA_IMAGES = 0
+PROCESSING_QUEUE_NAME = "image-processing-queue"
+PROCESSING_DLQ_NAME = "image-processing-dlq"
+# Deliveries per job before it is dead-lettered
+PROCESSING_MAX_RECEIVE_COUNT = 3
+# Partitions per day in the recency index; may be raised, never lowered
+RECENCY_SHARDS = 4
+LAMBDA_RUNTIME = "python3.9"
+LAMBDA_TIMEOUT = 30
+LAMBDA_MEMORY_SIZE = 512
+API_NAME = "image-service-api"
+# 'split' deploys one function per API route; 'consolidated' deploys a single
+# function that dispatches every route through router.py, so all routes share
+# its warm containers and AWS clients
+API_LAYOUTS = ('split', 'consolidated')
+API_LAYOUT = os.environ.get('API_LAYOUT', 'split')
+CONSOLIDATED_FUNCTION_NAME = "image-api"
+API_STAGE = "dev"
+# Request bodies of these types reach the handlers base64-encoded and unmangled
+# '*/*' lets handlers return compressed (base64, isBase64Encoded) JSON bodies;
+# as a side effect every request body reaches the handlers base64 encoded
+API_BINARY_MEDIA_TYPES = ['multipart/form-data', 'image/*', '*/*']
+BUILD_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.build')
+# Poll quickly: LocalStack resources usually settle in well under a second
+WAITER_CONFIG = {'Delay': 1, 'MaxAttempts': 60}
 LAMBDA_FUNCTIONS = [
     {
         'name': 'upload-image',
         'file': 'lambda_functions/upload_image.py',
         'handler': 'upload_image.lambda_handler',
-        'description': 'Upload image with metadata'
+        'description': 'Upload image with metadata',
+        'modules': [
+            'lambda_functions/aws_clients.py', 'lambda_functions/image_inspect.py',
+            'lambda_functions/idempotency.py', 'lambda_functions/image_metadata.py',
+            'lambda_functions/image_similarity.py', 'lambda_functions/memory_profile.py'
+        ],
+        'requirements': ['python-multipart==0.0.6', 'Pillow==10.4.0', 'numpy==2.0.2']
     },
     {
         'name': 'list-images',
         'file': 'lambda_functions/list_images.py',
         'handler': 'list_images.lambda_handler',
-        'description': 'List images with filtering'
+        'description': 'List images with filtering',
+        'modules': [
+            'lambda_functions/aws_clients.py', 'lambda_functions/http_compression.py',
+            'lambda_functions/image_metadata.py'
+        ]
     },
     {
         'name': 'view-image',
         'file': 'lambda_functions/view_image.py',
         'handler': 'view_image.lambda_handler',
-        'description': 'View/download image'
+        'description': 'View/download image',
+        'modules': [
+            'lambda_functions/aws_clients.py', 'lambda_functions/http_compression.py',
+            'lambda_functions/image_metadata.py', 'lambda_functions/memory_profile.py'
+        ]
     },
     {
         'name': 'delete-image',
         'file': 'lambda_functions/delete_image.py',
         'handler': 'delete_image.lambda_handler',
+        'description': 'Delete image',
+        'modules': ['lambda_functions/aws_clients.py', 'lambda_functions/image_metadata.py']
+    },
+    {
+        'name': 'user-stats',
+        'file': 'lambda_functions/user_stats.py',
+        'handler': 'user_stats.lambda_handler',
+        'description': 'Per-user usage counters',
+        'modules': ['lambda_functions/aws_clients.py', 'lambda_functions/image_metadata.py']
+    },
+    {
+        'name': 'find-similar',
+        'file': 'lambda_functions/find_similar.py',
+        'handler': 'find_similar.lambda_handler',
+        'description': 'Near-duplicate search by perceptual hash',
+        'modules': [
+            'lambda_functions/aws_clients.py', 'lambda_functions/http_compression.py',
+            'lambda_functions/image_metadata.py', 'lambda_functions/image_similarity.py'
+        ],
+        'requirements': ['numpy==2.0.2']
+    },
+    {
+        'name': 'process-images',
+        'file': 'lambda_functions/process_images.py',
+        'handler': 'process_images.lambda_handler',
+        'description': 'Post-upload processing worker',
+        'modules': [
+            'lambda_functions/aws_clients.py', 'lambda_functions/image_metadata.py',
+            'lambda_functions/image_similarity.py'
+        ],
+        'requirements': ['Pillow==10.4.0', 'numpy==2.0.2'],
+        'queue': PROCESSING_QUEUE_NAME
+    }
+]
+API_ROUTES = [
+    {
+        'path': '/images',
+        'method': 'POST',
+        'function_name': 'upload-image',
+        'description': 'Upload a new image'
+    },
+    {
+        'path': '/images',
+        'method': 'GET',
+        'function_name': 'list-images',
+        'description': 'List images with filtering'
+    },
+    {
+        'path': '/images/{image_id}',
+        'method': 'GET',
+        'function_name': 'view-image',
+        'description': 'View or download image'
+    },
+    {
+        'path': '/images/{image_id}',
+        'method': 'DELETE',
+        'function_name': 'delete-image',
         'description': 'Delete image'
+    },
+    {
+        'path': '/images/{image_id}/similar',
+        'method': 'GET',
+        'function_name': 'find-similar',
+        'description': 'Near-duplicates of an image'
+    },
+    {
+        'path': '/users/{user_id}/stats',
+        'method': 'GET',
+        'function_name': 'user-stats',
+        'description': 'Image count and storage usage for a user'
     }
 ]
 
+def route_key(route):
+    """The "METHOD /resource" key router.py dispatches on"""
+    return f"{route['method']} {route['path']}"
+
+def consolidated_function():
+    """Function config serving every API route from one package through router.py"""
+    functions = {func_config['name']: func_config for func_config in LAMBDA_FUNCTIONS}
+    modules, requirements = [], []
+    for name in dict.fromkeys(route['function_name'] for route in API_ROUTES):
+        func_config = functions[name]
+        for path in [func_config['file']] + func_config.get('modules', []):
+            if path not in modules:
+                modules.append(path)
+        for requirement in func_config.get('requirements', []):
+            if requirement not in requirements:
+                requirements.append(requirement)
+    routes = {route_key(route): functions[route['function_name']]['handler'] for route in API_ROUTES}
+    return {
+        'name': CONSOLIDATED_FUNCTION_NAME,
+        'file': 'lambda_functions/router.py',
+        'handler': 'router.lambda_handler',
+        'description': 'All API routes',
+        'modules': modules,
+        'requirements': requirements,
+        'environment': {'ROUTES': json.dumps(routes, sort_keys=True)}
+    }
+
+def deployed_functions():
+    """Function configs for API_LAYOUT; functions no route points at are deployed either way"""
+    if API_LAYOUT == 'split':
+        return LAMBDA_FUNCTIONS
+    routed = {route['function_name'] for route in API_ROUTES}
+    return [consolidated_function()] + [
+        func_config for func_config in LAMBDA_FUNCTIONS if func_config['name'] not in routed
+    ]
+
+def route_function_name(route):
+    """The deployed function behind an API route"""
+    return CONSOLIDATED_FUNCTION_NAME if API_LAYOUT == 'consolidated' else route['function_name']
+
+_log_lock = threading.Lock()
+
+def log(message=""):
+    """print() that keeps lines from concurrent provisioning steps intact"""
+    with _log_lock:
+        sys.stdout.write(f"{message}\n")
+        sys.stdout.flush()
+
 def get_clients():
     common_config = {
         'endpoint_url': LOCALSTACK_ENDPOINT,
@@ -51,13 +223,23 @@ def get_clients():
         'dynamodb': boto3.client('dynamodb', **common_config),
         'lambda': boto3.client('lambda', **common_config),
         'apigateway': boto3.client('apigateway', **common_config),
-        'iam': boto3.client('iam', **common_config)
+        'iam': boto3.client('iam', **common_config),
+        'sqs': boto3.client('sqs', **common_config)
     }
 
 def create_s3_bucket(s3_client):
     try:
-        print(f"Creating S3 bucket: {S3_BUCKET_NAME}")
+        s3_client.head_bucket(Bucket=S3_BUCKET_NAME)
+        log(f"✓ S3 bucket '{S3_BUCKET_NAME}' already exists")
+        return
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchBucket'):
+            raise
+
+    try:
+        log(f"Creating S3 bucket: {S3_BUCKET_NAME}")
         s3_client.create_bucket(Bucket=S3_BUCKET_NAME)
+        s3_client.get_waiter('bucket_exists').wait(Bucket=S3_BUCKET_NAME, WaiterConfig=WAITER_CONFIG)
         bucket_policy = {
             "Version": "2012-10-17",
             "Statement": [
@@ -76,17 +258,95 @@ def create_s3_bucket(s3_client):
             Policy=json.dumps(bucket_policy)
         )
         
-        print(f"✓ S3 bucket '{S3_BUCKET_NAME}' created successfully")
+        log(f"✓ S3 bucket '{S3_BUCKET_NAME}' created successfully")
         
     except ClientError as e:
-        if e.response['Error']['Code'] == 'BucketAlreadyExists':
-            print(f"✓ S3 bucket '{S3_BUCKET_NAME}' already exists")
+        if e.response['Error']['Code'] in ('BucketAlreadyExists', 'BucketAlreadyOwnedByYou'):
+            log(f"✓ S3 bucket '{S3_BUCKET_NAME}' already exists")
         else:
             raise
 
+def gsi_definition(index_name, hash_key, range_key):
+    return {
+        'IndexName': index_name,
+        'KeySchema': [
+            {
+                'AttributeName': hash_key,
+                'KeyType': 'HASH'
+            },
+            {
+                'AttributeName': range_key,
+                'KeyType': 'RANGE'
+            }
+        ],
+        'Projection': {
+            'ProjectionType': 'ALL'
+        },
+        'ProvisionedThroughput': {
+            'ReadCapacityUnits': 5,
+            'WriteCapacityUnits': 5
+        }
+    }
+
+TABLE_ATTRIBUTE_DEFINITIONS = [
+    {'AttributeName': 'image_id', 'AttributeType': 'S'},
+    {'AttributeName': 'user_id', 'AttributeType': 'S'},
+    {'AttributeName': 'created_at', 'AttributeType': 'S'},
+    {'AttributeName': 'created_day', 'AttributeType': 'S'},
+    {'AttributeName': 'created_sort', 'AttributeType': 'S'},
+    {'AttributeName': 'user_key', 'AttributeType': 'S'}
+]
+
+TABLE_GLOBAL_SECONDARY_INDEXES = [
+    gsi_definition('user-id-index', 'user_id', 'created_at'),
+    # Site-wide recency feed: created_day is "YYYY-MM-DD#shard",
+    # created_sort is "created_at#image_id"
+    gsi_definition('recency-index', 'created_day', 'created_sort'),
+    # Write-sharded users: user_key is "user_id#shard"; sparse, only items of
+    # users with key_shards set in user-stats carry it
+    gsi_definition('user-key-index', 'user_key', 'created_sort')
+]
+
+def wait_for_index(dynamodb_client, index_name):
+    """There is no boto3 waiter for GSI creation, so poll describe_table"""
+    for _ in range(WAITER_CONFIG['MaxAttempts'] * 10):
+        table = dynamodb_client.describe_table(TableName=DYNAMODB_TABLE_NAME)['Table']
+        statuses = {
+            index['IndexName']: index.get('IndexStatus', 'ACTIVE')
+            for index in table.get('GlobalSecondaryIndexes', [])
+        }
+        if statuses.get(index_name) == 'ACTIVE':
+            return
+        time.sleep(WAITER_CONFIG['Delay'])
+    raise TimeoutError(f"Index '{index_name}' did not become ACTIVE")
+
+def ensure_global_secondary_indexes(dynamodb_client, table_description):
+    """Add indexes introduced after the table was created, one at a time as DynamoDB requires"""
+    existing = {index['IndexName'] for index in table_description.get('GlobalSecondaryIndexes', [])}
+    for index in TABLE_GLOBAL_SECONDARY_INDEXES:
+        if index['IndexName'] in existing:
+            continue
+        log(f"Adding index '{index['IndexName']}' to '{DYNAMODB_TABLE_NAME}'")
+        dynamodb_client.update_table(
+            TableName=DYNAMODB_TABLE_NAME,
+            AttributeDefinitions=TABLE_ATTRIBUTE_DEFINITIONS,
+            GlobalSecondaryIndexUpdates=[{'Create': index}]
+        )
+        wait_for_index(dynamodb_client, index['IndexName'])
+        log(f"✓ Index '{index['IndexName']}' created")
+
 def create_dynamodb_table(dynamodb_client):
     try:
-        print(f"Creating DynamoDB table: {DYNAMODB_TABLE_NAME}")
+        table_description = dynamodb_client.describe_table(TableName=DYNAMODB_TABLE_NAME)['Table']
+        log(f"✓ DynamoDB table '{DYNAMODB_TABLE_NAME}' already exists")
+        ensure_global_secondary_indexes(dynamodb_client, table_description)
+        return
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ResourceNotFoundException':
+            raise
+
+    try:
+        log(f"Creating DynamoDB table: {DYNAMODB_TABLE_NAME}")
         
         table_definition = {
             'TableName': DYNAMODB_TABLE_NAME,
@@ -96,42 +356,8 @@ def create_dynamodb_table(dynamodb_client):
                     'KeyType': 'HASH'
                 }
             ],
-            'AttributeDefinitions': [
-                {
-                    'AttributeName': 'image_id',
-                    'AttributeType': 'S'
-                },
-                {
-                    'AttributeName': 'user_id',
-                    'AttributeType': 'S'
-                },
-                {
-                    'AttributeName': 'created_at',
-                    'AttributeType': 'S'
-                }
-            ],
-            'GlobalSecondaryIndexes': [
-                {
-                    'IndexName': 'user-id-index',
-                    'KeySchema': [
-                        {
-                            'AttributeName': 'user_id',
-                            'KeyType': 'HASH'
-                        },
-                        {
-                            'AttributeName': 'created_at',
-                            'KeyType': 'RANGE'
-                        }
-                    ],
-                    'Projection': {
-                        'ProjectionType': 'ALL'
-                    },
-                    'ProvisionedThroughput': {
-                        'ReadCapacityUnits': 5,
-                        'WriteCapacityUnits': 5
-                    }
-                }
-            ],
+            'AttributeDefinitions': TABLE_ATTRIBUTE_DEFINITIONS,
+            'GlobalSecondaryIndexes': TABLE_GLOBAL_SECONDARY_INDEXES,
             'BillingMode': 'PROVISIONED',
             'ProvisionedThroughput': {
                 'ReadCapacityUnits': 5,
@@ -140,19 +366,97 @@ def create_dynamodb_table(dynamodb_client):
         }
         
         dynamodb_client.create_table(**table_definition)
-        print(f"✓ DynamoDB table '{DYNAMODB_TABLE_NAME}' created successfully")
+        dynamodb_client.get_waiter('table_exists').wait(
+            TableName=DYNAMODB_TABLE_NAME,
+            WaiterConfig=WAITER_CONFIG
+        )
+        log(f"✓ DynamoDB table '{DYNAMODB_TABLE_NAME}' created successfully")
         
     except ClientError as e:
         if e.response['Error']['Code'] == 'ResourceInUseException':
-            print(f"✓ DynamoDB table '{DYNAMODB_TABLE_NAME}' already exists")
+            log(f"✓ DynamoDB table '{DYNAMODB_TABLE_NAME}' already exists")
         else:
             raise
 
+def create_key_value_table(dynamodb_client, table_name, hash_key):
+    """Create a single-key table if it does not exist"""
+    try:
+        dynamodb_client.describe_table(TableName=table_name)
+        log(f"✓ DynamoDB table '{table_name}' already exists")
+        return
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ResourceNotFoundException':
+            raise
+
+    log(f"Creating DynamoDB table: {table_name}")
+    try:
+        dynamodb_client.create_table(
+            TableName=table_name,
+            KeySchema=[{'AttributeName': hash_key, 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': hash_key, 'AttributeType': 'S'}],
+            BillingMode='PROVISIONED',
+            ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ResourceInUseException':
+            raise
+    dynamodb_client.get_waiter('table_exists').wait(TableName=table_name, WaiterConfig=WAITER_CONFIG)
+    log(f"✓ DynamoDB table '{table_name}' created successfully")
+
+def create_user_stats_table(dynamodb_client):
+    create_key_value_table(dynamodb_client, USER_STATS_TABLE_NAME, 'user_id')
+
+def create_idempotency_table(dynamodb_client):
+    create_key_value_table(dynamodb_client, IDEMPOTENCY_TABLE_NAME, 'idempotency_key')
+    ttl = dynamodb_client.describe_time_to_live(TableName=IDEMPOTENCY_TABLE_NAME)['TimeToLiveDescription']
+    if ttl.get('TimeToLiveStatus') in ('ENABLED', 'ENABLING'):
+        return
+    dynamodb_client.update_time_to_live(
+        TableName=IDEMPOTENCY_TABLE_NAME,
+        TimeToLiveSpecification={'Enabled': True, 'AttributeName': IDEMPOTENCY_TTL_ATTRIBUTE}
+    )
+    log(f"✓ TTL on '{IDEMPOTENCY_TTL_ATTRIBUTE}' enabled for '{IDEMPOTENCY_TABLE_NAME}'")
+
+def create_processing_queues(sqs_client):
+    """Create the processing queue and its dead-letter queue; returns the queue ARN"""
+    def queue_arn(queue_url):
+        attributes = sqs_client.get_queue_attributes(QueueUrl=queue_url, AttributeNames=['QueueArn'])
+        return attributes['Attributes']['QueueArn']
+
+    # create_queue is idempotent as long as the attributes match
+    dlq_url = sqs_client.create_queue(QueueName=PROCESSING_DLQ_NAME)['QueueUrl']
+    queue_attributes = {
+        # Six times the function timeout, as recommended for SQS event sources
+        'VisibilityTimeout': str(LAMBDA_TIMEOUT * 6),
+        'RedrivePolicy': json.dumps({
+            'deadLetterTargetArn': queue_arn(dlq_url),
+            'maxReceiveCount': str(PROCESSING_MAX_RECEIVE_COUNT)
+        })
+    }
+    try:
+        queue_url = sqs_client.create_queue(QueueName=PROCESSING_QUEUE_NAME, Attributes=queue_attributes)['QueueUrl']
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('QueueAlreadyExists', 'QueueNameExists'):
+            raise
+        queue_url = sqs_client.get_queue_url(QueueName=PROCESSING_QUEUE_NAME)['QueueUrl']
+        sqs_client.set_queue_attributes(QueueUrl=queue_url, Attributes=queue_attributes)
+    log(f"✓ SQS queues '{PROCESSING_QUEUE_NAME}' / '{PROCESSING_DLQ_NAME}' ready")
+    return {PROCESSING_QUEUE_NAME: queue_arn(queue_url)}
+
 def create_lambda_execution_role(iam_client):
-    """Create IAM role for Lambda execution"""
+    """Create IAM role for Lambda execution, or refresh the policy of an existing one"""
     role_name = "lambda-execution-role"
+    role_arn = f"arn:aws:iam::000000000000:role/{role_name}"
     
     try:
+        iam_client.get_role(RoleName=role_name)
+        role_exists = True
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchEntity':
+            raise
+        role_exists = False
+
+    if not role_exists:
         assume_role_policy = {
             "Version": "2012-10-17",
             "Statement": [
@@ -166,194 +470,383 @@ def create_lambda_execution_role(iam_client):
             ]
         }
         
-        print(f"Creating IAM role: {role_name}")
-        iam_client.create_role(
-            RoleName=role_name,
-            AssumeRolePolicyDocument=json.dumps(assume_role_policy),
-            Description="Execution role for Lambda functions"
-        )
+        log(f"Creating IAM role: {role_name}")
+        try:
+            iam_client.create_role(
+                RoleName=role_name,
+                AssumeRolePolicyDocument=json.dumps(assume_role_policy),
+                Description="Execution role for Lambda functions"
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'EntityAlreadyExists':
+                raise
+        iam_client.get_waiter('role_exists').wait(RoleName=role_name, WaiterConfig=WAITER_CONFIG)
         iam_client.attach_role_policy(
             RoleName=role_name,
             PolicyArn="arn:aws:iam::aws:policy/service-role/AWSLambdaBasicExecutionRole"
         )
-        custom_policy = {
-            "Version": "2012-10-17",
-            "Statement": [
-                {
-                    "Effect": "Allow",
-                    "Action": [
-                        "s3:GetObject",
-                        "s3:PutObject",
-                        "s3:DeleteObject"
-                    ],
-                    "Resource": f"arn:aws:s3:::{S3_BUCKET_NAME}/*"
-                },
-                {
-                    "Effect": "Allow",
-                    "Action": [
-                        "dynamodb:GetItem",
-                        "dynamodb:PutItem",
-                        "dynamodb:DeleteItem",
-                        "dynamodb:Query",
-                        "dynamodb:Scan"
-                    ],
-                    "Resource": [
-                        f"arn:aws:dynamodb:{AWS_REGION}:000000000000:table/{DYNAMODB_TABLE_NAME}",
-                        f"arn:aws:dynamodb:{AWS_REGION}:000000000000:table/{DYNAMODB_TABLE_NAME}/index/*"
-                    ]
-                }
-            ]
-        }
-        
-        iam_client.put_role_policy(
-            RoleName=role_name,
-            PolicyName="CustomLambdaPolicy",
-            PolicyDocument=json.dumps(custom_policy)
+
+    custom_policy = {
+        "Version": "2012-10-17",
+        "Statement": [
+            {
+                "Effect": "Allow",
+                "Action": [
+                    "s3:GetObject",
+                    "s3:PutObject",
+                    "s3:DeleteObject"
+                ],
+                "Resource": f"arn:aws:s3:::{S3_BUCKET_NAME}/*"
+            },
+            {
+                "Effect": "Allow",
+                "Action": [
+                    "dynamodb:GetItem",
+                    "dynamodb:BatchGetItem",
+                    "dynamodb:PutItem",
+                    "dynamodb:UpdateItem",
+                    "dynamodb:DeleteItem",
+                    "dynamodb:Query",
+                    "dynamodb:Scan",
+                    "dynamodb:DescribeTable"
+                ],
+                "Resource": [
+                    f"arn:aws:dynamodb:{AWS_REGION}:000000000000:table/{DYNAMODB_TABLE_NAME}",
+                    f"arn:aws:dynamodb:{AWS_REGION}:000000000000:table/{DYNAMODB_TABLE_NAME}/index/*",
+                    f"arn:aws:dynamodb:{AWS_REGION}:000000000000:table/{USER_STATS_TABLE_NAME}",
+                    f"arn:aws:dynamodb:{AWS_REGION}:000000000000:table/{IDEMPOTENCY_TABLE_NAME}"
+                ]
+            },
+            {
+                "Effect": "Allow",
+                "Action": [
+                    "sqs:SendMessage",
+                    "sqs:ReceiveMessage",
+                    "sqs:DeleteMessage",
+                    "sqs:GetQueueUrl",
+                    "sqs:GetQueueAttributes"
+                ],
+                "Resource": f"arn:aws:sqs:{AWS_REGION}:000000000000:{PROCESSING_QUEUE_NAME}"
+            }
+        ]
+    }
+    
+    # Always re-put the inline policy so permission changes reach existing roles
+    iam_client.put_role_policy(
+        RoleName=role_name,
+        PolicyName="CustomLambdaPolicy",
+        PolicyDocument=json.dumps(custom_policy)
+    )
+    if role_exists:
+        log(f"✓ IAM role '{role_name}' already exists (policy refreshed)")
+    else:
+        log(f"✓ IAM role '{role_name}' created successfully")
+    return role_arn
+
+@functools.lru_cache(maxsize=None)
+def warn_no_bytecode(local_version, runtime_version):
+    """Said once per run: packages then ship sources only"""
+    log(f"⚠ Python {local_version} does not match the {LAMBDA_RUNTIME} runtime; packages ship without "
+        f"precompiled bytecode. Deploy with Python {runtime_version} to include it.")
+
+def compile_module(source_path):
+    """
+    Return hash-based bytecode for source_path, or None (with a warning) when
+    the local Python does not match LAMBDA_RUNTIME. /var/task is read-only, so without shipped
+    .pyc files the runtime recompiles every module on every cold start.
+    Unchecked hash-based pycs carry no timestamps, which keeps packages
+    byte-for-byte reproducible.
+    """
+    runtime_version = LAMBDA_RUNTIME.replace('python', '')
+    local_version = f"{sys.version_info.major}.{sys.version_info.minor}"
+    if local_version != runtime_version:
+        warn_no_bytecode(local_version, runtime_version)
+        return None
+    with tempfile.TemporaryDirectory() as temp_dir:
+        cfile = os.path.join(temp_dir, 'module.pyc')
+        py_compile.compile(
+            source_path,
+            cfile=cfile,
+            doraise=True,
+            invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH
         )
-        print(f"✓ IAM role '{role_name}' created successfully")
-        return f"arn:aws:iam::000000000000:role/{role_name}"
+        with open(cfile, 'rb') as f:
+            return f.read()
+
+_requirements_locks = {}
+_requirements_locks_guard = threading.Lock()
+
+def install_requirements(requirements):
+    """
+    pip-install third-party requirements as wheels for the Lambda platform
+    into a build cache keyed by the requirement set, and return that directory.
+    """
+    runtime_version = LAMBDA_RUNTIME.replace('python', '')
+    key = hashlib.sha256('\n'.join([LAMBDA_RUNTIME] + sorted(requirements)).encode('utf-8')).hexdigest()[:16]
+    target = os.path.join(BUILD_CACHE_DIR, 'deps', key)
+    with _requirements_locks_guard:
+        lock = _requirements_locks.setdefault(key, threading.Lock())
+    with lock:
+        if not os.path.isdir(target):
+            log(f"  Installing {', '.join(requirements)} for {LAMBDA_RUNTIME}")
+            staging = f"{target}.tmp"
+            shutil.rmtree(staging, ignore_errors=True)
+            subprocess.run(
+                [sys.executable, '-m', 'pip', 'install', '--quiet', '--no-compile',
+                 '--target', staging,
+                 '--platform', 'manylinux2014_x86_64',
+                 '--implementation', 'cp',
+                 '--python-version', runtime_version,
+                 '--only-binary=:all:',
+                 *requirements],
+                check=True
+            )
+            os.rename(staging, target)
+    return target
+
+def collect_package_files(func_config):
+    """Return {arcname: bytes} for everything that goes into a function's package"""
+    sources = [
+        (os.path.basename(path), path)
+        for path in [func_config['file']] + func_config.get('modules', [])
+    ]
+    if func_config.get('requirements'):
+        deps_dir = install_requirements(func_config['requirements'])
+        for root, dirs, files in os.walk(deps_dir):
+            dirs[:] = [d for d in dirs if d not in ('__pycache__', 'bin')]
+            for file in files:
+                if file.endswith('.pyc'):
+                    continue
+                path = os.path.join(root, file)
+                sources.append((os.path.relpath(path, deps_dir).replace(os.sep, '/'), path))
+
+    files = {}
+    cache_tag = sys.implementation.cache_tag
+    for arcname, path in sources:
+        with open(path, 'rb') as f:
+            files[arcname] = f.read()
+        if arcname.endswith('.py'):
+            bytecode = compile_module(path)
+            if bytecode is not None:
+                package_dir, module_file = os.path.split(arcname)
+                pyc_name = f"__pycache__/{module_file[:-3]}.{cache_tag}.pyc"
+                files[f"{package_dir}/{pyc_name}" if package_dir else pyc_name] = bytecode
+    return files
+
+def create_lambda_deployment_package(func_config):
+    """
+    Build the deployment zip in memory. Entries are sorted and carry fixed
+    timestamps and permissions, so unchanged sources always produce the same
+    bytes and therefore the same CodeSha256.
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        for arcname, data in sorted(collect_package_files(func_config).items()):
+            info = zipfile.ZipInfo(arcname, date_time=(1980, 1, 1, 0, 0, 0))
+            info.external_attr = 0o644 << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            zipf.writestr(info, data)
+    return buffer.getvalue()
+
+def code_sha256(zip_content):
+    """Hash in the format Lambda reports as CodeSha256"""
+    return base64.b64encode(hashlib.sha256(zip_content).digest()).decode('utf-8')
+
+def lambda_environment(func_config):
+    return {
+        'Variables': {
+            **func_config.get('environment', {}),
+            'S3_BUCKET': S3_BUCKET_NAME,
+            'DYNAMODB_TABLE': DYNAMODB_TABLE_NAME,
+            'PROCESSING_QUEUE_NAME': PROCESSING_QUEUE_NAME,
+            'MAX_RECEIVE_COUNT': str(PROCESSING_MAX_RECEIVE_COUNT),
+            'RECENCY_SHARDS': str(RECENCY_SHARDS),
+            'USER_STATS_TABLE': USER_STATS_TABLE_NAME,
+            'IDEMPOTENCY_TABLE': IDEMPOTENCY_TABLE_NAME,
+            'USER_QUOTA_BYTES': str(USER_QUOTA_BYTES),
+            'USER_QUOTA_IMAGES': str(USER_QUOTA_IMAGES),
+            'LOCALSTACK_ENDPOINT': LOCALSTACK_ENDPOINT
+        }
+    }
+
+def deploy_lambda_function(lambda_client, role_arn, func_config):
+    """Create the function, update it if its code or configuration drifted, or leave it alone"""
+    name = func_config['name']
+    zip_content = create_lambda_deployment_package(func_config)
+    local_sha = code_sha256(zip_content)
+    desired_config = {
+        'Runtime': LAMBDA_RUNTIME,
+        'Role': role_arn,
+        'Handler': func_config['handler'],
+        'Description': func_config['description'],
+        'Timeout': LAMBDA_TIMEOUT,
+        'MemorySize': LAMBDA_MEMORY_SIZE,
+        'Environment': lambda_environment(func_config)
+    }
+
+    try:
+        current = lambda_client.get_function(FunctionName=name)['Configuration']
     except ClientError as e:
-        if e.response['Error']['Code'] == 'EntityAlreadyExists':
-            print(f"✓ IAM role '{role_name}' already exists")
-            return f"arn:aws:iam::000000000000:role/{role_name}"
-        else:
+        if e.response['Error']['Code'] != 'ResourceNotFoundException':
             raise
+        current = None
 
-def create_lambda_deployment_package(function_file):
-    temp_dir = "/tmp/lambda_package"
-    if os.path.exists(temp_dir):
-        shutil.rmtree(temp_dir)
-    os.makedirs(temp_dir)
-    shutil.copy(function_file, temp_dir)
-    zip_file = f"/tmp/{os.path.basename(function_file)}.zip"
-    with zipfile.ZipFile(zip_file, 'w') as zipf:
-        for root, dirs, files in os.walk(temp_dir):
-            for file in files:
-                file_path = os.path.join(root, file)
-                arcname = os.path.relpath(file_path, temp_dir)
-                zipf.write(file_path, arcname)
-    shutil.rmtree(temp_dir)
-    
-    return zip_file
+    if current is None:
+        log(f"Creating Lambda function: {name}")
+        for attempt in range(5):
+            try:
+                response = lambda_client.create_function(
+                    FunctionName=name,
+                    Code={'ZipFile': zip_content},
+                    **desired_config
+                )
+                break
+            except ClientError as e:
+                # A freshly created role can take a few seconds to become assumable
+                if e.response['Error']['Code'] != 'InvalidParameterValueException' or attempt == 4:
+                    raise
+                time.sleep(2 ** attempt)
+        lambda_client.get_waiter('function_active_v2').wait(FunctionName=name, WaiterConfig=WAITER_CONFIG)
+        log(f"✓ Lambda function '{name}' created successfully")
+        return response['FunctionArn']
+
+    changed = []
+    if current.get('CodeSha256') != local_sha:
+        lambda_client.update_function_code(FunctionName=name, ZipFile=zip_content)
+        lambda_client.get_waiter('function_updated_v2').wait(FunctionName=name, WaiterConfig=WAITER_CONFIG)
+        changed.append('code')
+
+    current_config = {key: current.get(key) for key in desired_config}
+    current_config['Environment'] = {'Variables': current.get('Environment', {}).get('Variables', {})}
+    if current_config != desired_config:
+        lambda_client.update_function_configuration(FunctionName=name, **desired_config)
+        lambda_client.get_waiter('function_updated_v2').wait(FunctionName=name, WaiterConfig=WAITER_CONFIG)
+        changed.append('configuration')
+
+    if changed:
+        log(f"✓ Lambda function '{name}' updated ({', '.join(changed)})")
+    else:
+        log(f"✓ Lambda function '{name}' is up to date")
+    return current['FunctionArn']
 
 def create_lambda_functions(lambda_client, role_arn):
-    """Create Lambda functions"""
-    function_arns = {}
-    
-    for func_config in LAMBDA_FUNCTIONS:
-        try:
-            print(f"Creating Lambda function: {func_config['name']}")
-            zip_file = create_lambda_deployment_package(func_config['file'])
-            with open(zip_file, 'rb') as f:
-                zip_content = f.read()
-            response = lambda_client.create_function(
-                FunctionName=func_config['name'],
-                Runtime='python3.9',
-                Role=role_arn,
-                Handler=func_config['handler'],
-                Code={'ZipFile': zip_content},
-                Description=func_config['description'],
-                Timeout=30,
-                MemorySize=512,
-                Environment={
-                    'Variables': {
-                        'S3_BUCKET': S3_BUCKET_NAME,
-                        'DYNAMODB_TABLE': DYNAMODB_TABLE_NAME,
-                        'LOCALSTACK_ENDPOINT': LOCALSTACK_ENDPOINT
-                    }
-                }
-            )
-            
-            function_arns[func_config['name']] = response['FunctionArn']
-            print(f"✓ Lambda function '{func_config['name']}' created successfully")
-            os.remove(zip_file)
-            
-        except ClientError as e:
-            if e.response['Error']['Code'] == 'ResourceConflictException':
-                print(f"✓ Lambda function '{func_config['name']}' already exists")
-                # Get existing function ARN
-                response = lambda_client.get_function(FunctionName=func_config['name'])
-                function_arns[func_config['name']] = response['Configuration']['FunctionArn']
-            else:
-                raise
-    
-    return function_arns
+    """Create or update the functions of the configured API layout concurrently"""
+    functions = deployed_functions()
+    with ThreadPoolExecutor(max_workers=len(functions)) as executor:
+        futures = {
+            func_config['name']: executor.submit(deploy_lambda_function, lambda_client, role_arn, func_config)
+            for func_config in functions
+        }
+    return {name: future.result() for name, future in futures.items()}
+
+def create_event_source_mappings(lambda_client, queue_arns):
+    """Subscribe queue-driven functions to their queues"""
+    for func_config in deployed_functions():
+        if not func_config.get('queue'):
+            continue
+        queue_arn = queue_arns[func_config['queue']]
+        existing = lambda_client.list_event_source_mappings(
+            FunctionName=func_config['name'],
+            EventSourceArn=queue_arn
+        )['EventSourceMappings']
+        if existing:
+            log(f"✓ Event source '{func_config['queue']}' -> '{func_config['name']}' already exists")
+            continue
+        lambda_client.create_event_source_mapping(
+            FunctionName=func_config['name'],
+            EventSourceArn=queue_arn,
+            BatchSize=10,
+            MaximumBatchingWindowInSeconds=1,
+            FunctionResponseTypes=['ReportBatchItemFailures']
+        )
+        log(f"✓ Event source '{func_config['queue']}' -> '{func_config['name']}' created")
+
+def find_rest_api(apigateway_client):
+    paginator = apigateway_client.get_paginator('get_rest_apis')
+    for page in paginator.paginate():
+        for api in page['items']:
+            if api['name'] == API_NAME:
+                return api
+    return None
+
+def ensure_api_resource(apigateway_client, api_id, resources_by_path, path):
+    """Return the resource for path, creating it and any missing parents"""
+    if path in resources_by_path:
+        return resources_by_path[path]
+    parent_path, path_part = path.rsplit('/', 1)
+    parent = ensure_api_resource(apigateway_client, api_id, resources_by_path, parent_path or '/')
+    resource = apigateway_client.create_resource(
+        restApiId=api_id,
+        parentId=parent['id'],
+        pathPart=path_part
+    )
+    resource.setdefault('resourceMethods', {})
+    resources_by_path[path] = resource
+    return resource
 
 def create_api_gateway(apigateway_client, lambda_client, function_arns):
-    """Create API Gateway with Lambda integrations"""
+    """Create API Gateway with Lambda integrations, reusing an existing API when present"""
     try:
-        print("Creating API Gateway")
-        api_response = apigateway_client.create_rest_api(
-            name='image-service-api',
-            description='Image upload and management service API'
-        )
-        api_id = api_response['id']
-        resources_response = apigateway_client.get_resources(restApiId=api_id)
-        root_resource_id = None
-        for resource in resources_response['items']:
-            if resource['path'] == '/':
-                root_resource_id = resource['id']
-                break
-        images_resource = apigateway_client.create_resource(
-            restApiId=api_id,
-            parentId=root_resource_id,
-            pathPart='images'
-        )
-        images_resource_id = images_resource['id']
-        image_id_resource = apigateway_client.create_resource(
-            restApiId=api_id,
-            parentId=images_resource_id,
-            pathPart='{image_id}'
-        )
-        image_id_resource_id = image_id_resource['id']
-        methods = [
-            {
-                'resource_id': images_resource_id,
-                'method': 'POST',
-                'function_name': 'upload-image',
-                'description': 'Upload a new image'
-            },
-            {
-                'resource_id': images_resource_id,
-                'method': 'GET',
-                'function_name': 'list-images',
-                'description': 'List images with filtering'
-            },
-            {
-                'resource_id': image_id_resource_id,
-                'method': 'GET',
-                'function_name': 'view-image',
-                'description': 'View or download image'
-            },
-            {
-                'resource_id': image_id_resource_id,
-                'method': 'DELETE',
-                'function_name': 'delete-image',
-                'description': 'Delete image'
-            }
-        ]
-        
-        for method_config in methods:
-            apigateway_client.put_method(
-                restApiId=api_id,
-                resourceId=method_config['resource_id'],
-                httpMethod=method_config['method'],
-                authorizationType='NONE'
+        changed = False
+        api = find_rest_api(apigateway_client)
+        if api:
+            log(f"✓ API Gateway '{API_NAME}' already exists")
+            api_id = api['id']
+            missing_types = [t for t in API_BINARY_MEDIA_TYPES if t not in api.get('binaryMediaTypes', [])]
+            if missing_types:
+                apigateway_client.update_rest_api(
+                    restApiId=api_id,
+                    patchOperations=[
+                        {'op': 'add', 'path': '/binaryMediaTypes/' + t.replace('/', '~1')}
+                        for t in missing_types
+                    ]
+                )
+                changed = True
+        else:
+            log("Creating API Gateway")
+            api_response = apigateway_client.create_rest_api(
+                name=API_NAME,
+                description='Image upload and management service API',
+                binaryMediaTypes=API_BINARY_MEDIA_TYPES
             )
-            function_arn = function_arns[method_config['function_name']]
-            integration_uri = f"arn:aws:apigateway:{AWS_REGION}:lambda:path/2015-03-31/functions/{function_arn}/invocations"         
+            api_id = api_response['id']
+
+        resources_by_path = {}
+        paginator = apigateway_client.get_paginator('get_resources')
+        for page in paginator.paginate(restApiId=api_id, embed=['methods']):
+            for resource in page['items']:
+                resource.setdefault('resourceMethods', {})
+                resources_by_path[resource['path']] = resource
+
+        for route in API_ROUTES:
+            resource = ensure_api_resource(apigateway_client, api_id, resources_by_path, route['path'])
+            function_name = route_function_name(route)
+            function_arn = function_arns[function_name]
+            integration_uri = f"arn:aws:apigateway:{AWS_REGION}:lambda:path/2015-03-31/functions/{function_arn}/invocations"
+            existing_method = resource['resourceMethods'].get(route['method'])
+            existing_uri = (existing_method or {}).get('methodIntegration', {}).get('uri')
+            if existing_uri == integration_uri:
+                continue
+
+            if existing_method is None:
+                apigateway_client.put_method(
+                    restApiId=api_id,
+                    resourceId=resource['id'],
+                    httpMethod=route['method'],
+                    authorizationType='NONE'
+                )
             apigateway_client.put_integration(
                 restApiId=api_id,
-                resourceId=method_config['resource_id'],
-                httpMethod=method_config['method'],
+                resourceId=resource['id'],
+                httpMethod=route['method'],
                 type='AWS_PROXY',
                 integrationHttpMethod='POST',
                 uri=integration_uri
             )
             try:
                 lambda_client.add_permission(
-                    FunctionName=method_config['function_name'],
-                    StatementId=f"api-gateway-{method_config['method']}-{method_config['resource_id']}",
+                    FunctionName=function_name,
+                    StatementId=f"api-gateway-{route['method']}-{resource['id']}",
                     Action='lambda:InvokeFunction',
                     Principal='apigateway.amazonaws.com',
                     SourceArn=f"arn:aws:execute-api:{AWS_REGION}:000000000000:{api_id}/*/*"
@@ -361,51 +854,73 @@ def create_api_gateway(apigateway_client, lambda_client, function_arns):
             except ClientError as e:
                 if e.response['Error']['Code'] != 'ResourceConflictException':
                     raise
-        deployment = apigateway_client.create_deployment(
-            restApiId=api_id,
-            stageName='dev',
-            description='Development stage'
-        )
+            changed = True
+
+        if changed:
+            apigateway_client.create_deployment(
+                restApiId=api_id,
+                stageName=API_STAGE,
+                description='Development stage'
+            )
+            log("✓ API Gateway deployed")
+        else:
+            log("✓ API Gateway routes are up to date")
         
-        api_url = f"{LOCALSTACK_ENDPOINT}/restapis/{api_id}/dev/_user_request_"
-        print(f"✓ API Gateway created successfully")
-        print(f"API URL: {api_url}")
+        api_url = f"{LOCALSTACK_ENDPOINT}/restapis/{api_id}/{API_STAGE}/_user_request_"
+        log(f"API URL: {api_url}")
         
         return api_id, api_url
         
     except ClientError as e:
-        print(f"Error creating API Gateway: {e}")
+        log(f"Error creating API Gateway: {e}")
         raise
 
 def main():
     """Main setup function"""
-    print("Setting up AWS infrastructure in LocalStack...")
-    print("=" * 50)
+    if API_LAYOUT not in API_LAYOUTS:
+        raise ValueError(f"API_LAYOUT must be one of {', '.join(API_LAYOUTS)}, not '{API_LAYOUT}'")
+    log("Setting up AWS infrastructure in LocalStack...")
+    log(f"API layout: {API_LAYOUT}")
+    log("=" * 50)
+    started = time.monotonic()
     clients = get_clients()
     
     try:
-        create_s3_bucket(clients['s3'])
-        create_dynamodb_table(clients['dynamodb'])
-        time.sleep(2)
-        role_arn = create_lambda_execution_role(clients['iam'])
-        time.sleep(2)
+        # Storage, queues and the execution role are independent of each other
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            bucket_future = executor.submit(create_s3_bucket, clients['s3'])
+            table_future = executor.submit(create_dynamodb_table, clients['dynamodb'])
+            stats_table_future = executor.submit(create_user_stats_table, clients['dynamodb'])
+            idempotency_table_future = executor.submit(create_idempotency_table, clients['dynamodb'])
+            queue_future = executor.submit(create_processing_queues, clients['sqs'])
+            role_future = executor.submit(create_lambda_execution_role, clients['iam'])
+        bucket_future.result()
+        table_future.result()
+        stats_table_future.result()
+        idempotency_table_future.result()
+        queue_arns = queue_future.result()
+        role_arn = role_future.result()
         function_arns = create_lambda_functions(clients['lambda'], role_arn)
+        create_event_source_mappings(clients['lambda'], queue_arns)
         api_id, api_url = create_api_gateway(clients['apigateway'], clients['lambda'], function_arns)
-        print("\n" + "=" * 50)
-        print("✓ Setup completed successfully!")
-        print("\nAPI Endpoints:")
-        print(f"POST   {api_url}/images          - Upload image")
-        print(f"GET    {api_url}/images          - List images")
-        print(f"GET    {api_url}/images/{{id}}     - View/download image")
-        print(f"DELETE {api_url}/images/{{id}}     - Delete image")
-        print("\nResources created:")
-        print(f"- S3 Bucket: {S3_BUCKET_NAME}")
-        print(f"- DynamoDB Table: {DYNAMODB_TABLE_NAME}")
-        print(f"- Lambda Functions: {', '.join(function_arns.keys())}")
-        print(f"- API Gateway: {api_id}")
+        log("\n" + "=" * 50)
+        log(f"✓ Setup completed successfully in {time.monotonic() - started:.1f}s!")
+        log("\nAPI Endpoints:")
+        log(f"POST   {api_url}/images          - Upload image")
+        log(f"GET    {api_url}/images          - List images")
+        log(f"GET    {api_url}/images/{{id}}     - View/download image")
+        log(f"DELETE {api_url}/images/{{id}}     - Delete image")
+        log(f"GET    {api_url}/images/{{id}}/similar - Near-duplicate images")
+        log(f"GET    {api_url}/users/{{id}}/stats - User usage stats")
+        log("\nResources created:")
+        log(f"- S3 Bucket: {S3_BUCKET_NAME}")
+        log(f"- DynamoDB Tables: {DYNAMODB_TABLE_NAME}, {USER_STATS_TABLE_NAME}, {IDEMPOTENCY_TABLE_NAME}")
+        log(f"- SQS Queues: {PROCESSING_QUEUE_NAME}, {PROCESSING_DLQ_NAME}")
+        log(f"- Lambda Functions: {', '.join(function_arns.keys())}")
+        log(f"- API Gateway: {api_id}")
         
     except Exception as e:
-        print(f"\n❌ Setup failed: {e}")
+        log(f"\n❌ Setup failed: {e}")
         raise
 
 if __name__ == "__main__":
@@ -2,6 +2,7 @@
 """
 Test script for the Image Service API
 """
+import argparse
 import requests
 import base64
 import json
@@ -117,11 +118,18 @@ def get_api_id():
         return None
 
 def main():
+    parser = argparse.ArgumentParser(description='Image Service API tests')
+    parser.add_argument('--base-url', help='Test this server (e.g. http://localhost:8000) '
+                                           'instead of the LocalStack API Gateway')
+    args = parser.parse_args()
 
-    api_id = get_api_id()
-    if not api_id:
-        return
-    api_url = API_BASE_URL.format(api_id=api_id)
+    if args.base_url:
+        api_url = args.base_url.rstrip('/')
+    else:
+        api_id = get_api_id()
+        if not api_id:
+            return
+        api_url = API_BASE_URL.format(api_id=api_id)
 
     time.sleep(1)
     
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Backfill the recency-index attributes (created_day, created_sort) on items
+written before the index existed. Safe to re-run: items that already have
+the attributes are skipped, and writes are conditional.
+
+    python tools/backfill_recency_index.py [--segments 8] [--dry-run]
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.exceptions import ClientError
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, 'lambda_functions'))
+
+import setup_infrastructure as infra
+
+# Use the shard count the functions are deployed with
+os.environ.setdefault('RECENCY_SHARDS', str(infra.RECENCY_SHARDS))
+from image_metadata import recency_keys
+
+def get_table():
+    dynamodb = boto3.resource(
+        'dynamodb',
+        endpoint_url=infra.LOCALSTACK_ENDPOINT,
+        aws_access_key_id='test',
+        aws_secret_access_key='test',
+        region_name=infra.AWS_REGION
+    )
+    return dynamodb.Table(infra.DYNAMODB_TABLE_NAME)
+
+def backfill_segment(segment, total_segments, dry_run):
+    # boto3 resources are not thread-safe, so each segment gets its own
+    table = get_table()
+    scanned = updated = 0
+    scan_kwargs = {
+        'Segment': segment,
+        'TotalSegments': total_segments,
+        'ProjectionExpression': 'image_id, created_at, created_day',
+        'FilterExpression': 'attribute_not_exists(created_day) AND attribute_exists(created_at)'
+    }
+    while True:
+        response = table.scan(**scan_kwargs)
+        scanned += response.get('ScannedCount', 0)
+        for item in response.get('Items', []):
+            keys = recency_keys(item['image_id'], item['created_at'])
+            if dry_run:
+                updated += 1
+                continue
+            try:
+                table.update_item(
+                    Key={'image_id': item['image_id']},
+                    UpdateExpression='SET created_day = :day, created_sort = :sort',
+                    ConditionExpression='attribute_exists(image_id) AND attribute_not_exists(created_day)',
+                    ExpressionAttributeValues={':day': keys['created_day'], ':sort': keys['created_sort']}
+                )
+                updated += 1
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+        if 'LastEvaluatedKey' not in response:
+            return scanned, updated
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def main():
+    parser = argparse.ArgumentParser(description='Backfill the recency index')
+    parser.add_argument('--segments', type=int, default=8, help='Parallel scan segments')
+    parser.add_argument('--dry-run', action='store_true', help='Count items without writing')
+    args = parser.parse_args()
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.segments) as executor:
+        results = list(executor.map(
+            lambda segment: backfill_segment(segment, args.segments, args.dry_run),
+            range(args.segments)
+        ))
+    scanned = sum(result[0] for result in results)
+    updated = sum(result[1] for result in results)
+    action = 'would update' if args.dry_run else 'updated'
+    print(f"✓ Scanned {scanned} items, {action} {updated} in {time.monotonic() - started:.1f}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,848 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite for the Image Service.
+
+Each benchmark is a subcommand:
+
+    python tools/benchmark.py importtime [--baseline benchmarks/importtime.json]
+    python tools/benchmark.py throughput [--base-url http://localhost:8000]
+    python tools/benchmark.py shards [--shard-counts 1,2,4,8,16]
+    python tools/benchmark.py compression [--link-mbps 2]
+    python tools/benchmark.py similarity [--hashes 1000000]
+    python tools/benchmark.py recent [--images 500]
+    python tools/benchmark.py layouts [--rates 0.01,0.1,1,10]
+    python tools/benchmark.py memory [--size-mb 8]
+"""
+import argparse
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAMBDA_DIR = os.path.join(REPO_ROOT, 'lambda_functions')
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, LAMBDA_DIR)
+
+from setup_infrastructure import LAMBDA_FUNCTIONS
+
+# Import times are compared as multiples of this import, measured in the same
+# run, so a baseline recorded on one machine holds on a slower or busier one
+REFERENCE_MODULE = 'boto3'
+
+def parse_importtime(stderr):
+    """Parse `-X importtime` output into (module, self_us, cumulative_us) rows"""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        rows.append((name.strip(), int(self_us), int(cumulative_us)))
+    return rows
+
+def measure_import(module_name, runs=5):
+    """Import module_name in a fresh interpreter `runs` times and keep the fastest run"""
+    return measure_imports([module_name], runs)
+
+def measure_imports(module_names, runs=5):
+    """
+    Import several modules one after another in a fresh interpreter, as a
+    container loading all of them would; dependencies they share count once
+    """
+    best = None
+    for _ in range(runs):
+        env = dict(os.environ, PYTHONPATH=LAMBDA_DIR)
+        # Never create clients while profiling imports
+        env.pop('AWS_LAMBDA_FUNCTION_NAME', None)
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', f"import {', '.join(module_names)}"],
+            capture_output=True,
+            text=True,
+            env=env,
+            cwd=LAMBDA_DIR
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f"Importing {', '.join(module_names)} failed:\n{result.stderr}")
+        rows = parse_importtime(result.stderr)
+        total = sum(cumulative for name, _, cumulative in rows if name in module_names)
+        if best is None or total < best['total_us']:
+            best = {'total_us': total, 'rows': rows}
+    return best
+
+def init_modules(func_config):
+    """
+    Modules a container of the function imports during init: its handler's,
+    and for the consolidated function the router's and every routed handler's
+    """
+    modules = [func_config['handler'].split('.')[0]]
+    routes = json.loads(func_config.get('environment', {}).get('ROUTES', '{}'))
+    modules += [handler.split('.')[0] for handler in dict.fromkeys(routes.values())]
+    return modules
+
+def measure_relative(module_names, runs=5):
+    """
+    The fastest import of several modules, and the median of its ratio to
+    REFERENCE_MODULE imported right before it in each run, so both imports
+    of a pair see the same machine load
+    """
+    best = None
+    ratios = []
+    for _ in range(runs):
+        reference = measure_imports([REFERENCE_MODULE], 1)
+        measurement = measure_imports(module_names, 1)
+        ratios.append(measurement['total_us'] / reference['total_us'])
+        if best is None or measurement['total_us'] < best['total_us']:
+            best = measurement
+    return best, sorted(ratios)[len(ratios) // 2]
+
+def run_importtime(args):
+    import setup_infrastructure as infra
+
+    baseline = {}
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    report = {}
+    regressions = []
+    missing = []
+    print(f"Import-time report (Python {sys.version_info.major}.{sys.version_info.minor}, "
+          f"best of {args.runs} runs, relative to importing {REFERENCE_MODULE})")
+    print("=" * 60)
+    # Every function of either API layout, so a function added later is covered
+    for func_config in LAMBDA_FUNCTIONS + [infra.consolidated_function()]:
+        modules = init_modules(func_config)
+        measurement, relative = measure_relative(modules, args.runs)
+        total_ms = measurement['total_us'] / 1000
+        top = sorted(measurement['rows'], key=lambda row: row[1], reverse=True)[:args.top]
+        report[func_config['name']] = {
+            'module': ', '.join(modules),
+            'total_ms': round(total_ms, 2),
+            'relative': round(relative, 3),
+            'top_self_ms': {name: round(self_us / 1000, 2) for name, self_us, _ in top}
+        }
+
+        line = f"{func_config['name']:<16} {total_ms:8.1f} ms {relative:6.2f}x"
+        previous = baseline.get(func_config['name'], {}).get('relative')
+        if previous:
+            change = (relative - previous) / previous * 100
+            line += f"  ({change:+.0f}% vs baseline {previous:.2f}x)"
+            if change > args.threshold:
+                regressions.append(func_config['name'])
+        elif baseline:
+            line += "  (not in baseline)"
+            missing.append(func_config['name'])
+        print(line)
+        for name, self_us, _ in top:
+            print(f"    {self_us / 1000:7.2f} ms  {name}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"\nReport written to {args.output}")
+
+    if missing and not args.output:
+        print(f"\n❌ No baseline for: {', '.join(missing)}; refresh it with --output")
+    if regressions:
+        print(f"\n❌ Import-time regressions over {args.threshold}%: {', '.join(regressions)}")
+    return 1 if regressions or (missing and not args.output) else 0
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def run_flow(session, api_url, payload, user_id):
+    """One pass of the test_api.py flow; returns [(operation, seconds, ok)]"""
+    timings = []
+
+    def timed(operation, method, url, **kwargs):
+        started = time.perf_counter()
+        response = session.request(method, url, **kwargs)
+        timings.append((operation, time.perf_counter() - started, response.ok))
+        return response
+
+    response = timed('upload', 'POST', f"{api_url}/images", json=payload)
+    if not response.ok:
+        return timings
+    image_id = response.json()['image_id']
+    timed('list', 'GET', f"{api_url}/images", params={'user_id': user_id, 'limit': 20})
+    timed('metadata', 'GET', f"{api_url}/images/{image_id}", params={'metadata_only': 'true'})
+    timed('download', 'GET', f"{api_url}/images/{image_id}", params={'download': 'true'})
+    timed('delete', 'DELETE', f"{api_url}/images/{image_id}", json={'user_id': user_id})
+    return timings
+
+def run_throughput(args):
+    import requests
+    import test_api
+
+    api_url = args.base_url
+    if not api_url:
+        api_id = test_api.get_api_id()
+        if not api_id:
+            print("❌ API Gateway not found; pass --base-url or run setup first")
+            return 1
+        api_url = test_api.API_BASE_URL.format(api_id=api_id)
+    api_url = api_url.rstrip('/')
+
+    payload = {
+        'user_id': test_api.TEST_USER_ID,
+        'title': 'Benchmark Image',
+        'tags': ['benchmark'],
+        'image_data': test_api.create_test_image(),
+        'filename': 'benchmark.png'
+    }
+
+    def worker(_):
+        timings = []
+        with requests.Session() as session:
+            for _ in range(args.iterations):
+                timings.extend(run_flow(session, api_url, payload, test_api.TEST_USER_ID))
+        return timings
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        timings = [timing for result in executor.map(worker, range(args.concurrency)) for timing in result]
+    elapsed = time.perf_counter() - started
+
+    print(f"Throughput against {api_url} ({args.concurrency} clients x {args.iterations} flows)")
+    print("=" * 60)
+    for operation in ('upload', 'list', 'metadata', 'download', 'delete'):
+        durations = [duration for name, duration, _ in timings if name == operation]
+        if not durations:
+            continue
+        errors = sum(1 for name, _, ok in timings if name == operation and not ok)
+        print(f"{operation:<10} n={len(durations):<5} p50 {percentile(durations, 0.5) * 1000:7.1f} ms"
+              f"  p95 {percentile(durations, 0.95) * 1000:7.1f} ms  errors {errors}")
+    failed = sum(1 for _, _, ok in timings if not ok)
+    print(f"\n{len(timings)} requests in {elapsed:.1f}s = {len(timings) / elapsed:.1f} req/s ({failed} failed)")
+    return 1 if failed else 0
+
+# DynamoDB's ceilings for a single partition key value (also per GSI key):
+# write units and read units per second
+PARTITION_WCU_PER_SECOND = 1000
+PARTITION_RCU_PER_SECOND = 3000
+
+def partition_load(calls, stats_sizes, infra):
+    """
+    Write and read units each partition key took over the recorded upload
+    calls, as {(table or index, key): [WCU, RCU]}. Writes inside a
+    transaction cost twice a plain write; every GSI an item lands in costs
+    a plain write of the whole item (the indexes project ALL). user-stats
+    items are charged at their final size.
+    """
+    from collections import defaultdict
+    from image_metadata import RECENCY_INDEX, USER_KEY_INDEX
+    from migrate_items import item_size
+
+    indexes = (('user-id-index', 'user_id'), (RECENCY_INDEX, 'created_day'), (USER_KEY_INDEX, 'user_key'))
+    load = defaultdict(lambda: [0.0, 0.0])
+
+    def write(table_name, key, item_bytes, factor):
+        load[(table_name, key)][0] += factor * math.ceil(item_bytes / 1024)
+
+    for operation, params in calls:
+        if operation == 'TransactWriteItems':
+            entries = [(kind, entry) for item in params['TransactItems'] for kind, entry in item.items()]
+            factor = 2
+        elif operation in ('PutItem', 'UpdateItem'):
+            entries = [('Put' if operation == 'PutItem' else 'Update', params)]
+            factor = 1
+        elif operation == 'GetItem' and params['TableName'] == infra.USER_STATS_TABLE_NAME:
+            key = params['Key']['user_id']
+            units = max(1, math.ceil(stats_sizes.get(key, 0) / 4096))
+            load[(params['TableName'], key)][1] += units if params.get('ConsistentRead') else units / 2
+            continue
+        else:
+            continue
+        for kind, entry in entries:
+            if kind == 'Put' and entry['TableName'] == infra.DYNAMODB_TABLE_NAME:
+                item = entry['Item']
+                size = item_size(item)
+                write(entry['TableName'], item['image_id'], size, factor)
+                for index_name, attribute in indexes:
+                    if attribute in item:
+                        write(index_name, item[attribute], size, 1)
+            elif kind == 'Update' and entry['TableName'] == infra.USER_STATS_TABLE_NAME:
+                key = entry['Key']['user_id']
+                write(entry['TableName'], key, stats_sizes.get(key, 0), factor)
+    return load
+
+def run_shards(args):
+    """
+    Load-test the upload handler for one hot user at several shard counts,
+    in moto with S3 and SQS mocked as well.
+
+    moto has no partitions, so its raw rate says nothing about throttling.
+    What the run records for real is every DynamoDB key the uploads read
+    and write: the metadata item, its user-id-index, user-key-index and
+    recency-index keys, and the user-stats items holding the counters. The
+    sustained ceiling is then modelled per key: each may take
+    PARTITION_WCU_PER_SECOND write and PARTITION_RCU_PER_SECOND read units a
+    second, and the key closest to its limit caps the upload rate.
+    """
+    import base64
+    import io
+    import boto3
+    from moto import mock_dynamodb, mock_s3, mock_sqs
+    from PIL import Image
+    import setup_infrastructure as infra
+    import aws_clients
+    import image_metadata
+    import upload_image
+
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'test')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'test')
+    image_metadata.RECENCY_SHARDS = args.recency_shards
+    shard_counts = [int(count) for count in args.shard_counts.split(',')]
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 48), (200, 120, 40)).save(buffer, 'JPEG')
+    body = json.dumps({
+        'user_id': 'hot-tenant', 'filename': 'IMG_0001.jpg', 'title': 'Camera upload', 'tags': ['camera'],
+        'image_data': base64.b64encode(buffer.getvalue()).decode('ascii')
+    })
+    categories = {
+        infra.USER_STATS_TABLE_NAME: 'user-stats',
+        'user-id-index': 'user index',
+        image_metadata.USER_KEY_INDEX: 'user index',
+        image_metadata.RECENCY_INDEX: 'recency-index',
+        infra.DYNAMODB_TABLE_NAME: 'image-metadata'
+    }
+    columns = ['user-stats', 'user index', 'recency-index']
+
+    print(f"Hot-user upload load test: {args.items} uploads through upload_image per run, "
+          f"{args.recency_shards} recency shards (moto)")
+    print("=" * 86)
+    print(f"{'shards':>6} {'moto uploads/s':>15} " + ' '.join(f"{column:>13}" for column in columns)
+          + f" {'ceiling/s':>10}  limited by")
+    for key_shards in shard_counts:
+        with mock_s3(), mock_dynamodb(), mock_sqs():
+            stdout, sys.stdout = sys.stdout, io.StringIO()
+            try:
+                infra.create_s3_bucket(boto3.client('s3', region_name=infra.AWS_REGION))
+                dynamodb_client = boto3.client('dynamodb', region_name=infra.AWS_REGION)
+                infra.create_dynamodb_table(dynamodb_client)
+                infra.create_user_stats_table(dynamodb_client)
+                infra.create_processing_queues(boto3.client('sqs', region_name=infra.AWS_REGION))
+            finally:
+                sys.stdout = stdout
+            # 1 shard means unsharded: everything lands on user-id-index under user_id
+            if key_shards > 1:
+                dynamodb_client.put_item(TableName=infra.USER_STATS_TABLE_NAME, Item={
+                    'user_id': {'S': 'hot-tenant'}, 'key_shards': {'N': str(key_shards)}
+                })
+            aws_clients.LOCALSTACK_ENDPOINT = None
+            aws_clients._services.clear()
+            upload_image._queue_url = None
+            upload_image._sharded_users.clear()
+            calls = []
+            upload_image.get_clients()[1].meta.client.meta.events.register_first(
+                'before-parameter-build.dynamodb',
+                lambda params, model, **kwargs: calls.append((model.name, json.loads(json.dumps(
+                    params, default=lambda value: sorted(value) if isinstance(value, set) else str(value)
+                ))))
+            )
+
+            stdout, sys.stdout = sys.stdout, io.StringIO()
+            started = time.perf_counter()
+            try:
+                # One at a time: moto's transactions are not thread-safe
+                statuses = [upload_image.lambda_handler({'body': body}, None)['statusCode'] for _ in range(args.items)]
+            finally:
+                sys.stdout = stdout
+            elapsed = time.perf_counter() - started
+            stats_items = boto3.resource('dynamodb', region_name=infra.AWS_REGION).Table(
+                infra.USER_STATS_TABLE_NAME).scan()['Items']
+
+        from migrate_items import item_size
+        uploads = statuses.count(201)
+        load = partition_load(calls, {item['user_id']: item_size(item) for item in stats_items}, infra)
+        ceilings = {}
+        for (table_name, key), (wcu, rcu) in load.items():
+            ceiling = min(PARTITION_WCU_PER_SECOND / (wcu / uploads) if wcu else math.inf,
+                          PARTITION_RCU_PER_SECOND / (rcu / uploads) if rcu else math.inf)
+            category = categories[table_name]
+            if ceiling < ceilings.get(category, (math.inf,))[0]:
+                ceilings[category] = (ceiling, f"{table_name} {key}")
+        ceiling, limit = min(ceilings.values())
+        print(f"{key_shards:>6} {uploads / elapsed:>15.0f} "
+              + ' '.join(f"{ceilings.get(column, (math.inf,))[0]:>13.0f}" for column in columns)
+              + f" {ceiling:>10.0f}  {limit}")
+    print("\nCeilings are modelled per key from the recorded calls; moto itself does not throttle. "
+          "Raise RECENCY_SHARDS (--recency-shards) once recency-index is the limit.")
+    return 0
+
+def sample_bodies():
+    """A default-sized list page and a view_image JSON body, as the handlers build them"""
+    import base64
+    import io
+    import random
+    from datetime import datetime, timedelta
+    from PIL import Image, ImageFilter
+    from image_metadata import build_image_item, decode_item, encode_item
+
+    rng = random.Random(7)
+    started = datetime(2024, 5, 1, 9, 30)
+    images = []
+    for index in range(50):
+        image_id = str(uuid.UUID(int=rng.getrandbits(128)))
+        tags = rng.sample(['travel', 'family', 'beach', 'work', 'sunset', 'pets', 'food', 'city'], 3)
+        width, height = rng.choice([(4032, 3024), (1920, 1080), (3024, 4032)])
+        item = build_image_item(
+            image_id, f'user-{index % 4}', f'IMG_{20240501 + index}_{rng.randint(0, 999999):06d}.jpg',
+            f'Photo {index}', 'Uploaded from the mobile app', tags, rng.randint(800_000, 6_000_000),
+            {'content_type': 'image/jpeg', 'width': width, 'height': height,
+             'format': 'JPEG', 'mode': 'RGB', 'frame_count': 1},
+            (started + timedelta(minutes=17 * index)).isoformat()
+        )
+        item.update(status='ready', sha256='%064x' % rng.getrandbits(256),
+                    thumbnail_key=f'thumbnails/{image_id}.jpg', processed={'sha256', 'thumbnail'})
+        images.append(decode_item(encode_item(item)))
+    list_body = json.dumps({
+        'images': images, 'count': len(images), 'next_token': 'x' * 80, 'filters_applied': {}
+    }, default=lambda value: sorted(value) if isinstance(value, set) else str(value))
+
+    picture = Image.effect_mandelbrot((800, 600), (-2.0, -1.2, 1.0, 1.2), 60).convert('RGB')
+    picture = picture.filter(ImageFilter.GaussianBlur(1))
+    buffer = io.BytesIO()
+    picture.save(buffer, 'JPEG', quality=85)
+    view_body = json.dumps({
+        'metadata': images[0],
+        'image_data': base64.b64encode(buffer.getvalue()).decode('utf-8'),
+        'content_type': 'image/jpeg'
+    }, default=str)
+    return {'list page': list_body.encode('utf-8'), 'view JSON': view_body.encode('utf-8')}
+
+def run_compression(args):
+    """
+    CPU time against bytes saved for each gzip level and brotli quality on
+    representative bodies. "total" adds the compression time to the time the
+    body takes over a --link-mbps link, which is what a slow client waits for.
+    """
+    import gzip
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+
+    bodies = sample_bodies()
+    codecs = [(f'gzip {level}', lambda data, level=level: gzip.compress(data, compresslevel=level, mtime=0))
+              for level in range(1, 10)]
+    if brotli is not None:
+        codecs += [(f'br {quality}', lambda data, quality=quality: brotli.compress(
+            data, quality=quality, mode=brotli.MODE_TEXT)) for quality in range(0, 12)]
+    else:
+        print("brotli is not installed; only gzip is measured")
+    link_bytes_per_ms = args.link_mbps * 1_000_000 / 8 / 1000
+
+    for name, data in bodies.items():
+        print(f"\n{name}: {len(data) / 1024:.1f} KB, {len(data) / link_bytes_per_ms:.0f} ms "
+              f"uncompressed at {args.link_mbps:g} Mbit/s")
+        print("=" * 70)
+        print(f"{'coding':<10} {'size KB':>9} {'ratio':>7} {'cpu ms':>8} {'KB saved/cpu ms':>16} {'total ms':>9}")
+        for codec_name, compress in codecs:
+            timings = []
+            for _ in range(args.runs):
+                started = time.perf_counter()
+                compressed = compress(data)
+                timings.append((time.perf_counter() - started) * 1000)
+            cpu_ms = min(timings)
+            saved_kb = (len(data) - len(compressed)) / 1024
+            total_ms = cpu_ms + len(compressed) / link_bytes_per_ms
+            print(f"{codec_name:<10} {len(compressed) / 1024:>9.1f} {len(data) / len(compressed):>6.1f}x "
+                  f"{cpu_ms:>8.2f} {saved_kb / max(cpu_ms, 0.001):>16.0f} {total_ms:>9.0f}")
+    return 0
+
+def run_similarity(args):
+    """
+    Perceptual hash cost and robustness on a camera-sized JPEG, and search
+    latency of a SimilarityIndex holding --hashes random hashes
+    """
+    import io
+    import random
+    import numpy as np
+    from PIL import Image
+    from image_similarity import SimilarityIndex, perceptual_hash
+
+    original = Image.effect_mandelbrot((4032, 3024), (-2.0, -1.2, 1.0, 1.2), 100).convert('RGB')
+    def encode(image, quality=90):
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=quality)
+        return buffer.getvalue()
+    original_bytes = encode(original)
+    timings = []
+    for _ in range(args.runs):
+        started = time.perf_counter()
+        original_hash = perceptual_hash(original_bytes)
+        timings.append((time.perf_counter() - started) * 1000)
+    print(f"Hashing a 4032x3024 JPEG ({len(original_bytes) / 1024:.0f} KB): {min(timings):.1f} ms")
+
+    variants = {
+        'resized to 1024px': encode(original.resize((1024, 768))),
+        'recompressed q=40': encode(original, 40),
+        'thumbnail 256px': encode(original.resize((256, 192))),
+        'cropped 5%': encode(original.crop((100, 75, 3932, 2949))),
+        'different image': encode(Image.effect_mandelbrot((1024, 768), (-0.8, 0.0, -0.6, 0.2), 100).convert('RGB'))
+    }
+    for name, data in variants.items():
+        print(f"  {name:<20} distance {bin(original_hash ^ perceptual_hash(data)).count('1'):>2} bits")
+
+    rng = random.Random(11)
+    index = SimilarityIndex(
+        (str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(args.hashes)),
+        np.frombuffer(rng.randbytes(8 * args.hashes), dtype=np.uint64)
+    )
+    index.add('original', original_hash)
+    latencies = []
+    for _ in range(args.queries):
+        query = rng.getrandbits(64)
+        started = time.perf_counter()
+        index.search(query, 8, 20)
+        latencies.append((time.perf_counter() - started) * 1000)
+    started = time.perf_counter()
+    matches = index.search(perceptual_hash(variants['resized to 1024px']), 8, 20)
+    lookup_ms = (time.perf_counter() - started) * 1000
+    print(f"\nSearch over {len(index):,} hashes ({index.hashes.nbytes / 1e6:.0f} MB packed): "
+          f"p50 {percentile(latencies, 0.5):.2f} ms, p99 {percentile(latencies, 0.99):.2f} ms")
+    print(f"Resized copy lookup: {matches[:1]} in {lookup_ms:.2f} ms")
+    return 0
+
+def run_recent(args):
+    """
+    First page of a user listing: summary pages served from the recent list
+    in user-stats against the index query path, in moto. Reports DynamoDB
+    calls and modelled read units per request, which carry over to AWS;
+    moto's latencies only show the relative amount of work.
+    """
+    import boto3
+    from datetime import datetime, timedelta
+    from moto import mock_dynamodb
+    import setup_infrastructure as infra
+    import aws_clients
+    import list_images
+    from image_metadata import build_image_item, encode_item, insert_recent, recency_keys
+    from migrate_items import item_size, modelled_units
+
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'test')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'test')
+    image_info = {'content_type': 'image/jpeg', 'width': 4032, 'height': 3024,
+                  'format': 'JPEG', 'mode': 'RGB', 'frame_count': 1}
+    with mock_dynamodb():
+        dynamodb = boto3.resource('dynamodb', region_name=infra.AWS_REGION)
+        for create in (infra.create_dynamodb_table, infra.create_user_stats_table):
+            create(dynamodb.meta.client)
+        table = dynamodb.Table(infra.DYNAMODB_TABLE_NAME)
+        started = datetime.utcnow() - timedelta(days=1)
+        recent = []
+        with table.batch_writer() as writer:
+            for index in range(args.images):
+                item = build_image_item(
+                    str(uuid.uuid4()), 'bench-user', f'IMG_{index:05d}.jpg', f'Holiday photo {index}',
+                    'Uploaded from the mobile app', ['travel', 'family'], 2_500_000, image_info,
+                    (started + timedelta(seconds=index)).isoformat()
+                )
+                writer.put_item(Item=encode_item(item))
+                recent = insert_recent(recent, item)
+        stats_item = {'user_id': 'bench-user', 'image_count': args.images, 'total_bytes': args.images * 2_500_000,
+                      'recent': recent, 'recent_version': args.images}
+        dynamodb.Table(infra.USER_STATS_TABLE_NAME).put_item(Item=stats_item)
+
+        aws_clients.LOCALSTACK_ENDPOINT = None
+        aws_clients._services.clear()
+        calls = []
+        list_images.get_dynamodb().meta.client.meta.events.register(
+            'before-call.dynamodb', lambda model, **kwargs: calls.append(model.name)
+        )
+        print(f"First page of {args.page_size} for a user with {args.images} images (moto)")
+        print("=" * 72)
+        print(f"{'path':<26} {'p50 ms':>8} {'calls':>6} {'modelled RCU':>13} {'images':>7}")
+        for label, params in (('index query (full items)', {}), ('recent list (summaries)', {'summary': 'true'})):
+            event = {'queryStringParameters': dict(params, user_id='bench-user', limit=str(args.page_size))}
+            latencies = []
+            for _ in range(args.runs):
+                calls.clear()
+                request_started = time.perf_counter()
+                with open(os.devnull, 'w') as devnull:
+                    stdout, sys.stdout = sys.stdout, devnull
+                    try:
+                        response = list_images.lambda_handler(event, None)
+                    finally:
+                        sys.stdout = stdout
+                latencies.append((time.perf_counter() - request_started) * 1000)
+            body = json.loads(response['body'])
+            # The stats point read is the same on both paths; the index path adds the page it queries
+            units = math.ceil(item_size(stats_item) / 4096) * 0.5
+            if not params:
+                units += modelled_units([
+                    encode_item(dict(image, **recency_keys(image['image_id'], image['created_at'])))
+                    for image in body['images']
+                ])
+            print(f"{label:<26} {percentile(latencies, 0.5):>8.1f} {len(calls):>6} {units:>13.1f} "
+                  f"{body['count']:>7}")
+    return 0
+
+# Mixed API load for the layouts simulation: route -> (share of requests, warm
+# median ms). The warm path runs the same handler code in either layout.
+LAYOUT_ROUTE_MIX = {
+    'GET /images': (0.35, 45),
+    'GET /images/{image_id}': (0.30, 35),
+    'POST /images': (0.15, 140),
+    'GET /users/{user_id}/stats': (0.08, 15),
+    'GET /images/{image_id}/similar': (0.07, 60),
+    'DELETE /images/{image_id}': (0.05, 50)
+}
+
+def simulate_layout(requests, function_by_route, init_ms, keep_alive):
+    """
+    Replay (arrival s, route, warm ms) requests against per-function container
+    pools. A request takes the most recently freed idle container of its
+    function; with none, a new one pays the function's init time. Idle
+    containers are reclaimed after keep_alive seconds.
+    Returns ([(route, latency ms, cold)], peak containers alive at once).
+    """
+    pools = {}
+    results = []
+    peak = 0
+    for arrival, route, service_ms in requests:
+        pool = pools.setdefault(function_by_route[route], [])
+        # A container is [busy until]; drop the ones idle for longer than keep_alive
+        pool[:] = [container for container in pool if arrival - container[0] <= keep_alive]
+        idle = [container for container in pool if container[0] <= arrival]
+        cold = not idle
+        if cold:
+            container = [arrival]
+            pool.append(container)
+            latency = init_ms[function_by_route[route]] + service_ms
+        else:
+            container = max(idle, key=lambda container: container[0])
+            latency = service_ms
+        container[0] = arrival + latency / 1000
+        results.append((route, latency, cold))
+        peak = max(peak, sum(len(pool) for pool in pools.values()))
+    return results, peak
+
+def run_layouts(args):
+    """
+    Compare the split (one function per route) and consolidated (router.py)
+    layouts under the same mixed load. This is a simulation: init times are
+    the runtime start-up plus import times measured here, warm times come
+    from LAYOUT_ROUTE_MIX, and containers are reclaimed after a fixed idle
+    keep-alive. LocalStack does not reproduce Lambda's container lifecycle.
+    """
+    import random
+    import setup_infrastructure as infra
+
+    functions = {func_config['name']: func_config for func_config in LAMBDA_FUNCTIONS}
+    routes = {infra.route_key(route): route['function_name'] for route in infra.API_ROUTES}
+    mix = {route: LAYOUT_ROUTE_MIX[route] for route in routes}
+    consolidated = infra.consolidated_function()
+    modules = {name: functions[name]['handler'].split('.')[0] for name in dict.fromkeys(routes.values())}
+    init_ms = {
+        name: args.runtime_init_ms + measure_import(module, args.runs)['total_us'] / 1000
+        for name, module in modules.items()
+    }
+    init_ms[consolidated['name']] = (
+        args.runtime_init_ms + measure_imports(init_modules(consolidated), args.runs)['total_us'] / 1000
+    )
+    layouts = {
+        'split': routes,
+        'consolidated': {route: consolidated['name'] for route in routes}
+    }
+
+    print(f"Split vs. consolidated API functions: {args.requests} mixed requests per rate, "
+          f"{args.keep_alive:.0f}s idle keep-alive (simulated)")
+    print("Init ms (runtime + imports): " + ', '.join(f"{name} {ms:.0f}" for name, ms in init_ms.items()))
+    print("=" * 72)
+    print(f"{'req/s':>7} {'layout':<13} {'cold starts':>12} {'cold %':>7} {'p50 ms':>8} {'p99 ms':>8} "
+          f"{'containers':>11}")
+    route_names = list(mix)
+    weights = [share for share, _ in mix.values()]
+    for rate in [float(rate) for rate in args.rates.split(',')]:
+        rng = random.Random(args.seed)
+        requests, arrival = [], 0.0
+        for _ in range(args.requests):
+            arrival += rng.expovariate(rate)
+            route = rng.choices(route_names, weights)[0]
+            requests.append((arrival, route, rng.lognormvariate(math.log(mix[route][1]), args.sigma)))
+        for layout, function_by_route in layouts.items():
+            results, peak = simulate_layout(requests, function_by_route, init_ms, args.keep_alive)
+            latencies = [latency for _, latency, _ in results]
+            cold = sum(1 for _, _, is_cold in results if is_cold)
+            print(f"{rate:>7g} {layout:<13} {cold:>12} {cold / len(results):>7.2%} "
+                  f"{percentile(latencies, 0.5):>8.0f} {percentile(latencies, 0.99):>8.0f} "
+                  f"{peak:>11}")
+    print("\nInit and warm times are model inputs; see run_layouts for what is measured.")
+    return 0
+
+def upload_events(image_bytes):
+    """The same PNG as a JSON, multipart and raw upload, each base64 encoded as API Gateway passes it"""
+    import base64
+
+    image_base64 = base64.b64encode(image_bytes).decode('ascii')
+    document = json.dumps({'user_id': 'bench-user', 'filename': 'noise.png', 'image_data': image_base64})
+    boundary = 'benchmark-boundary'
+    multipart = (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="user_id"\r\n\r\nbench-user\r\n'
+        f'--{boundary}\r\nContent-Disposition: form-data; name="image"; filename="noise.png"\r\n'
+        f'Content-Type: image/png\r\n\r\n'
+    ).encode('ascii') + image_bytes + f'\r\n--{boundary}--\r\n'.encode('ascii')
+    return {
+        'json': ('application/json', base64.b64encode(document.encode('ascii')).decode('ascii'), {}),
+        'multipart': (f'multipart/form-data; boundary={boundary}', base64.b64encode(multipart).decode('ascii'), {}),
+        'raw': ('image/png', image_base64, {'X-User-Id': 'bench-user'})
+    }
+
+def run_memory(args):
+    """
+    Peak memory per phase of upload_image and view_image for one noise PNG
+    of about --size-mb, as logged by memory_profile with MEMORY_PROFILE on,
+    next to the peak the handlers project for admission control. Runs in
+    moto, whose in-process S3 copies every object it stores: the upload
+    store phase is inflated by that, so it is left out of the peak. PIL
+    allocates pixel buffers outside Python's allocator, so tracemalloc does
+    not see them.
+    """
+    import io
+    import boto3
+    from moto import mock_dynamodb, mock_s3, mock_sqs
+    from PIL import Image
+    import setup_infrastructure as infra
+    import aws_clients
+    import memory_profile
+    import upload_image
+    import view_image
+
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'test')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'test')
+    memory_profile.MEMORY_PROFILE = True
+    side = int(math.sqrt(args.size_mb * 1024 * 1024 / 3))
+    buffer = io.BytesIO()
+    Image.frombytes('RGB', (side, side), os.urandom(side * side * 3)).save(buffer, 'PNG', compress_level=1)
+    image_bytes = buffer.getvalue()
+    image_info = {'width': side, 'height': side, 'mode': 'RGB'}
+
+    def profile(handler, event):
+        """Call a handler twice (the first call pays one-off imports) and parse the logged profile"""
+        for _ in range(2):
+            output = io.StringIO()
+            stdout, sys.stdout = sys.stdout, output
+            try:
+                response = handler(event, None)
+            finally:
+                sys.stdout = stdout
+        if response['statusCode'] >= 300:
+            raise RuntimeError(f"{handler.__module__} returned {response['statusCode']}: {response['body']}")
+        line = next(line for line in output.getvalue().splitlines() if line.startswith('{"memory_profile"'))
+        return response, json.loads(line)['phases']
+
+    with mock_s3(), mock_dynamodb(), mock_sqs():
+        stdout, sys.stdout = sys.stdout, io.StringIO()
+        try:
+            infra.create_s3_bucket(boto3.client('s3', region_name=infra.AWS_REGION))
+            dynamodb_client = boto3.client('dynamodb', region_name=infra.AWS_REGION)
+            infra.create_dynamodb_table(dynamodb_client)
+            infra.create_user_stats_table(dynamodb_client)
+            infra.create_processing_queues(boto3.client('sqs', region_name=infra.AWS_REGION))
+        finally:
+            sys.stdout = stdout
+        aws_clients.LOCALSTACK_ENDPOINT = None
+        aws_clients._services.clear()
+
+        cases = []
+        for name, (content_type, body, headers) in upload_events(image_bytes).items():
+            event = {'headers': dict(headers, **{'Content-Type': content_type}), 'body': body, 'isBase64Encoded': True}
+            projected = upload_image.projected_parse_peak(event, content_type.split(';')[0])
+            response, phases = profile(upload_image.lambda_handler, event)
+            cases.append((f'upload {name}', phases, projected))
+            if name == 'json':
+                image_id = json.loads(response['body'])['image_id']
+        for name, params, headers, factor in (
+            ('view json', {}, {}, 4),
+            ('view json gzip', {}, {'Accept-Encoding': 'gzip'}, 8),
+            ('view download', {'download': 'true'}, {}, 4)
+        ):
+            event = {'pathParameters': {'image_id': image_id}, 'queryStringParameters': params, 'headers': headers}
+            _, phases = profile(view_image.lambda_handler, event)
+            cases.append((name, phases, len(image_bytes) * factor))
+
+    mb = 1024 * 1024
+    print(f"Peak memory per phase, {len(image_bytes) / mb:.1f} MB PNG (tracemalloc, moto)")
+    print(f"Hashing it for reject_duplicates is projected at "
+          f"{upload_image.projected_hash_peak(len(image_bytes), image_info) / mb:.0f} MB, "
+          f"mostly pixel buffers tracemalloc cannot see")
+    print("=" * 78)
+    print(f"{'request':<18} {'peak MB':>8} {'projected MB':>13}  phases (MB)")
+    for name, phases, projected in cases:
+        peak = max(size for phase, size in phases.items() if phase != 'store')
+        detail = ', '.join(f"{phase} {size / mb:.1f}" for phase, size in phases.items())
+        print(f"{name:<18} {peak / mb:>8.1f} {projected / mb:>13.1f}  {detail}")
+    budget = f"{memory_profile.MEMORY_BUDGET_MB} MB" if memory_profile.MEMORY_BUDGET_MB else "off"
+    print(f"\nPeaks leave out the upload store phase, which holds moto's copy of the object. "
+          f"Budget here: {budget} (MEMORY_BUDGET_MB).")
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description='Image Service benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    importtime = subparsers.add_parser('importtime', help='Per-function import-time report')
+    importtime.add_argument('--runs', type=int, default=5)
+    importtime.add_argument('--top', type=int, default=8, help='Modules to list per function')
+    importtime.add_argument('--baseline', help='JSON report to compare against')
+    importtime.add_argument('--threshold', type=float, default=25.0,
+                            help=f'Percent slowdown relative to {REFERENCE_MODULE} that counts as a regression')
+    importtime.add_argument('--output', help='Write the JSON report here')
+    importtime.set_defaults(func=run_importtime)
+
+    throughput = subparsers.add_parser('throughput', help='Concurrent test_api.py flows against a running API')
+    throughput.add_argument('--base-url', help='Server to test; defaults to the LocalStack API Gateway')
+    throughput.add_argument('--concurrency', type=int, default=8, help='Parallel clients')
+    throughput.add_argument('--iterations', type=int, default=20, help='Flows per client')
+    throughput.set_defaults(func=run_throughput)
+
+    shards = subparsers.add_parser('shards', help='Hot-user upload load test across user key shard counts')
+    shards.add_argument('--shard-counts', default='1,2,4,8,16', help='Comma-separated shard counts')
+    shards.add_argument('--recency-shards', type=int, default=4, help='RECENCY_SHARDS for the run')
+    shards.add_argument('--items', type=int, default=400, help='Uploads per shard count')
+    shards.set_defaults(func=run_shards)
+
+    compression = subparsers.add_parser('compression', help='Compression level vs. CPU cost report')
+    compression.add_argument('--link-mbps', type=float, default=2, help='Client link speed for the total column')
+    compression.add_argument('--runs', type=int, default=5, help='Timed runs per level (fastest is reported)')
+    compression.set_defaults(func=run_compression)
+
+    similarity = subparsers.add_parser('similarity', help='Perceptual hash and similarity search report')
+    similarity.add_argument('--hashes', type=int, default=1_000_000, help='Hashes in the searched index')
+    similarity.add_argument('--queries', type=int, default=200, help='Timed searches')
+    similarity.add_argument('--runs', type=int, default=3, help='Timed hash computations (fastest is reported)')
+    similarity.set_defaults(func=run_similarity)
+
+    recent = subparsers.add_parser('recent', help='First-page listing cost with and without the recent list')
+    recent.add_argument('--images', type=int, default=500, help="Images of the benchmarked user")
+    recent.add_argument('--page-size', type=int, default=50)
+    recent.add_argument('--runs', type=int, default=20)
+    recent.set_defaults(func=run_recent)
+
+    layouts = subparsers.add_parser('layouts', help='Cold-start rate and p99 of split vs. consolidated functions')
+    layouts.add_argument('--rates', default='0.01,0.1,1,10', help='Comma-separated request rates per second')
+    layouts.add_argument('--requests', type=int, default=20000, help='Simulated requests per rate')
+    layouts.add_argument('--keep-alive', type=float, default=420, help='Seconds an idle container is kept')
+    layouts.add_argument('--runtime-init-ms', type=float, default=150, help='Runtime start-up before imports')
+    layouts.add_argument('--sigma', type=float, default=0.5, help='Log-normal spread of warm times')
+    layouts.add_argument('--runs', type=int, default=5, help='Timed imports per function (fastest is used)')
+    layouts.add_argument('--seed', type=int, default=7)
+    layouts.set_defaults(func=run_layouts)
+
+    memory = subparsers.add_parser('memory', help='Peak memory per phase of uploads and views')
+    memory.add_argument('--size-mb', type=float, default=8, help='Approximate size of the test image')
+    memory.set_defaults(func=run_memory)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
+
+if __name__ == "__main__":
+    main()
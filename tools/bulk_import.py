@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+"""
+Bulk-import an existing image archive without going through POST /images.
+
+Files are hashed, sniffed and validated on a process pool (the same checks
+as the upload handler), copied straight to S3 with concurrent multipart
+transfers, and their metadata is written with BatchWriteItem in the item
+shape the handlers use. Usage counters are bumped per user and processing
+jobs are enqueued for thumbnails, as for a normal upload.
+
+Image IDs are derived from the user and source path, and a SQLite
+checkpoint records finished files, so an interrupted run can be restarted
+with the same arguments and will not create duplicates. If a run is killed
+mid-batch, that batch's usage counters may be added twice; run
+tools/recount_usage.py afterwards. Quotas are not enforced.
+
+    python tools/bulk_import.py --source /archive --user-id user123
+    python tools/bulk_import.py --source /archive            # first directory = user_id
+    python tools/bulk_import.py --manifest images.csv        # path,user_id,title,description,tags
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, 'lambda_functions'))
+
+import setup_infrastructure as infra
+
+# Use the settings the functions are deployed with
+os.environ.setdefault('RECENCY_SHARDS', str(infra.RECENCY_SHARDS))
+os.environ.setdefault('USER_STATS_TABLE', infra.USER_STATS_TABLE_NAME)
+from image_inspect import FORMAT_EXTENSIONS, ImageValidationError, inspect_image
+from image_metadata import (
+    build_image_item, encode_item, image_s3_key, processing_job, set_recent, usage_delta, usage_key,
+    user_id_error
+)
+from upload_image import MAX_FILE_SIZE
+
+IMAGE_EXTENSIONS = set().union(*FORMAT_EXTENSIONS.values())
+# Namespace for deterministic image IDs: uuid5(namespace, "user_id/source")
+IMPORT_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, 'image-service/bulk-import')
+# Per-file multipart settings; files above the threshold are sent in parallel parts
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=4
+)
+SQS_BATCH_SIZE = 10
+
+def image_id_for(user_id, source):
+    return str(uuid.uuid5(IMPORT_NAMESPACE, f"{user_id}/{source}"))
+
+def iter_directory(root, user_id):
+    """Yield import entries for every image file under root, in a stable order"""
+    for directory, subdirectories, filenames in os.walk(root):
+        subdirectories.sort()
+        for filename in sorted(filenames):
+            if os.path.splitext(filename)[1].lower() not in IMAGE_EXTENSIONS:
+                continue
+            path = os.path.join(directory, filename)
+            source = os.path.relpath(path, root).replace(os.sep, '/')
+            owner = user_id or source.split('/')[0]
+            if owner == source:
+                # Top-level files have no user directory
+                continue
+            yield {'path': path, 'source': source, 'user_id': owner,
+                   'title': '', 'description': '', 'tags': []}
+
+def iter_manifest(manifest_path):
+    """Yield import entries from a CSV manifest; paths are relative to the manifest"""
+    base = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path, newline='') as f:
+        for row in csv.DictReader(f):
+            yield {
+                'path': os.path.join(base, row['path']),
+                'source': row['path'],
+                'user_id': row['user_id'],
+                'title': row.get('title') or '',
+                'description': row.get('description') or '',
+                'tags': [tag.strip() for tag in (row.get('tags') or '').split(',') if tag.strip()]
+            }
+
+def iter_batches(entries, batch_size):
+    batch = []
+    for entry in entries:
+        batch.append(entry)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def inspect_file(path):
+    """Runs in a pool process: size check, SHA-256 and header validation"""
+    try:
+        size = os.path.getsize(path)
+        if size > MAX_FILE_SIZE:
+            return {'error': 'File size exceeds 10MB limit'}
+        with open(path, 'rb') as f:
+            data = f.read()
+        image_info = inspect_image(data)
+    except (OSError, ImageValidationError) as e:
+        return {'error': str(e)}
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in FORMAT_EXTENSIONS[image_info['format']]:
+        return {'error': f"File extension '{extension}' does not match image content ({image_info['format']})"}
+    return {'size': size, 'sha256': hashlib.sha256(data).hexdigest(), 'image_info': image_info}
+
+class Checkpoint:
+    """
+    SQLite record of every file the import has finished with. 'done' and
+    'invalid' files are skipped on resume; 'failed' ones are retried.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS imports ('
+            'image_id TEXT PRIMARY KEY, source TEXT, state TEXT, error TEXT, bytes INTEGER)'
+        )
+        self.db.commit()
+
+    def finished(self, image_ids):
+        placeholders = ','.join('?' * len(image_ids))
+        rows = self.db.execute(
+            f"SELECT image_id FROM imports WHERE state IN ('done', 'invalid') AND image_id IN ({placeholders})",
+            image_ids
+        )
+        return {row[0] for row in rows}
+
+    def record(self, rows):
+        """rows: (image_id, source, state, error, bytes); committed together"""
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO imports VALUES (?, ?, ?, ?, ?)', rows)
+
+    def close(self):
+        self.db.close()
+
+class Importer:
+    def __init__(self, args):
+        self.args = args
+        session = boto3.session.Session(
+            aws_access_key_id='test',
+            aws_secret_access_key='test',
+            region_name=infra.AWS_REGION
+        )
+        pool_size = args.upload_workers * TRANSFER_CONFIG.max_concurrency
+        self.s3_client = session.client(
+            's3', endpoint_url=infra.LOCALSTACK_ENDPOINT,
+            config=Config(max_pool_connections=pool_size)
+        )
+        dynamodb = session.resource('dynamodb', endpoint_url=infra.LOCALSTACK_ENDPOINT)
+        self.table = dynamodb.Table(infra.DYNAMODB_TABLE_NAME)
+        self.dynamodb_client = dynamodb.meta.client
+        self.stats_table = dynamodb.Table(infra.USER_STATS_TABLE_NAME)
+        self.key_shards = {}
+        self.sqs_client = session.client('sqs', endpoint_url=infra.LOCALSTACK_ENDPOINT)
+        self.queue_url = self.sqs_client.get_queue_url(QueueName=infra.PROCESSING_QUEUE_NAME)['QueueUrl']
+        self.checkpoint = Checkpoint(args.checkpoint)
+        self.stats = defaultdict(int)
+        self.timings = defaultdict(float)
+
+    def pending(self, batch):
+        """Drop entries a previous run already finished and attach their image IDs"""
+        for entry in batch:
+            entry['image_id'] = image_id_for(entry['user_id'], entry['source'])
+        finished = self.checkpoint.finished([entry['image_id'] for entry in batch])
+        self.stats['skipped'] += len(finished)
+        return [entry for entry in batch if entry['image_id'] not in finished]
+
+    def key_shards_for(self, user_id):
+        """The user's write-sharding setting, read once per run"""
+        if user_id not in self.key_shards:
+            stats = self.stats_table.get_item(
+                Key={'user_id': user_id},
+                ProjectionExpression='key_shards'
+            ).get('Item', {})
+            self.key_shards[user_id] = int(stats.get('key_shards', 0))
+        return self.key_shards[user_id]
+
+    def upload(self, entry):
+        extension = os.path.splitext(entry['path'])[1].lower()
+        self.s3_client.upload_file(
+            entry['path'],
+            infra.S3_BUCKET_NAME,
+            image_s3_key(entry['user_id'], entry['image_id'], extension),
+            ExtraArgs={
+                'ContentType': entry['image_info']['content_type'],
+                'Metadata': {
+                    'user_id': entry['user_id'],
+                    'title': entry['title'],
+                    'description': entry['description']
+                }
+            },
+            Config=TRANSFER_CONFIG
+        )
+
+    def enqueue(self, items):
+        for start in range(0, len(items), SQS_BATCH_SIZE):
+            chunk = items[start:start + SQS_BATCH_SIZE]
+            response = self.sqs_client.send_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[
+                    {'Id': str(index), 'MessageBody': json.dumps(processing_job(item))}
+                    for index, item in enumerate(chunk)
+                ]
+            )
+            for failure in response.get('Failed', []):
+                item = chunk[int(failure['Id'])]
+                print(f"Warning: Failed to enqueue processing for {item['image_id']}: {failure.get('Message')}")
+
+    def import_batch(self, entries, results, upload_pool):
+        checkpoint_rows = []
+        valid = []
+        for entry, result in zip(entries, results):
+            error = result.get('error') or user_id_error(entry['user_id'])
+            if error:
+                checkpoint_rows.append((entry['image_id'], entry['source'], 'invalid', error, 0))
+                self.stats['invalid'] += 1
+                continue
+            entry.update(result)
+            valid.append(entry)
+
+        started = time.monotonic()
+        uploaded = []
+        for entry, error in zip(valid, upload_pool.map(self.try_upload, valid)):
+            if error:
+                checkpoint_rows.append((entry['image_id'], entry['source'], 'failed', error, 0))
+                self.stats['failed'] += 1
+            else:
+                uploaded.append(entry)
+        self.timings['upload'] += time.monotonic() - started
+
+        started = time.monotonic()
+        timestamp = datetime.utcnow().isoformat()
+        items = []
+        usage = defaultdict(lambda: [0, 0])
+        for entry in uploaded:
+            item = build_image_item(
+                entry['image_id'], entry['user_id'], os.path.basename(entry['path']),
+                entry['title'], entry['description'], entry['tags'],
+                entry['size'], entry['image_info'], timestamp,
+                key_shards=self.key_shards_for(entry['user_id'])
+            )
+            # Hashing already happened on the pool, so the worker can skip it
+            item['sha256'] = entry['sha256']
+            item['processed'] = {'sha256'}
+            items.append(item)
+            user_usage = usage[(entry['user_id'], usage_key(item), item['content_type'])]
+            user_usage[0] += 1
+            user_usage[1] += entry['size']
+        # batch_writer groups puts into BatchWriteItem calls of 25 and resends unprocessed items
+        with self.table.batch_writer(overwrite_by_pkeys=['image_id']) as writer:
+            for item in items:
+                writer.put_item(Item=encode_item(item))
+        for (user_id, counter_key, content_type), (count, size) in usage.items():
+            update = usage_delta(counter_key, content_type, count, size)
+            if counter_key == user_id:
+                # Imported images are the user's newest; drop their recent list for the listing to rebuild
+                update = set_recent(update, {}, None)
+            self.dynamodb_client.update_item(**update['Update'])
+        self.timings['write'] += time.monotonic() - started
+
+        started = time.monotonic()
+        self.enqueue(items)
+        self.timings['enqueue'] += time.monotonic() - started
+
+        checkpoint_rows.extend(
+            (entry['image_id'], entry['source'], 'done', None, entry['size']) for entry in uploaded
+        )
+        self.checkpoint.record(checkpoint_rows)
+        self.stats['imported'] += len(uploaded)
+        self.stats['bytes'] += sum(entry['size'] for entry in uploaded)
+
+    def try_upload(self, entry):
+        try:
+            self.upload(entry)
+            return None
+        except (BotoCoreError, ClientError, OSError) as e:
+            return str(e)
+
+    def run(self, entries):
+        started = time.monotonic()
+        with ProcessPoolExecutor(max_workers=self.args.processes) as process_pool, \
+                ThreadPoolExecutor(max_workers=self.args.upload_workers) as upload_pool:
+
+            def submit(batch):
+                batch = self.pending(batch)
+                paths = [entry['path'] for entry in batch]
+                return batch, process_pool.map(inspect_file, paths, chunksize=8)
+
+            batches = iter_batches(entries, self.args.batch_size)
+            batch = next(batches, None)
+            in_flight = submit(batch) if batch else None
+            while in_flight:
+                entries_batch, results = in_flight
+                # Inspect the next batch on the pool while this one is uploaded
+                batch = next(batches, None)
+                in_flight = submit(batch) if batch else None
+
+                inspect_started = time.monotonic()
+                results = list(results)
+                self.timings['inspect (waiting)'] += time.monotonic() - inspect_started
+                if entries_batch:
+                    self.import_batch(entries_batch, results, upload_pool)
+
+                elapsed = time.monotonic() - started
+                print(f"  {self.stats['imported']} imported, {self.stats['skipped']} skipped, "
+                      f"{self.stats['invalid']} invalid, {self.stats['failed']} failed "
+                      f"({self.stats['imported'] / elapsed:.1f} files/s)")
+        self.checkpoint.close()
+        return time.monotonic() - started
+
+    def report(self, elapsed):
+        megabytes = self.stats['bytes'] / (1024 * 1024)
+        print("\nImport report")
+        print("=" * 60)
+        print(f"Imported:   {self.stats['imported']} files, {megabytes:.1f} MB")
+        print(f"Skipped:    {self.stats['skipped']} (finished in an earlier run)")
+        print(f"Invalid:    {self.stats['invalid']} (see the checkpoint for reasons)")
+        print(f"Failed:     {self.stats['failed']} (retried on the next run)")
+        print(f"Elapsed:    {elapsed:.1f}s")
+        if elapsed:
+            print(f"Throughput: {self.stats['imported'] / elapsed:.1f} files/s, {megabytes / elapsed:.2f} MB/s")
+        for stage, seconds in self.timings.items():
+            print(f"  {stage:<18} {seconds:7.1f}s")
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk-import an image archive')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--source', help='Directory tree to import')
+    source.add_argument('--manifest', help='CSV with path,user_id[,title,description,tags]')
+    parser.add_argument('--user-id', help='Owner for every file under --source '
+                                          '(default: the first directory of each path)')
+    parser.add_argument('--checkpoint', default='bulk_import.sqlite', help='Resume state file')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help='Inspection processes')
+    parser.add_argument('--upload-workers', type=int, default=16, help='Concurrent S3 transfers')
+    parser.add_argument('--batch-size', type=int, default=500, help='Files per checkpointed batch')
+    args = parser.parse_args()
+
+    if args.source:
+        entries = iter_directory(args.source, args.user_id)
+    else:
+        entries = iter_manifest(args.manifest)
+
+    importer = Importer(args)
+    elapsed = importer.run(entries)
+    importer.report(elapsed)
+    return 1 if importer.stats['failed'] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
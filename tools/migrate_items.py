@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+Rewrite legacy metadata items into the compact version 2 form
+(image_metadata.encode_item) while the service keeps running.
+
+Each item is changed with a conditional update_item that only removes the
+redundant attributes and converts tags. The condition checks the values it
+rewrites, so an item that changed after it was scanned is skipped rather
+than overwritten, and attributes set concurrently by the worker are kept.
+Writes are throttled to --rate per second across all segments. Scan
+progress is saved to --checkpoint after every page so an interrupted run
+resumes where it stopped.
+
+The table is measured before and after: average item size, and the
+capacity consumed by a full scan and by per-user index queries.
+
+    python tools/migrate_items.py [--segments 4] [--rate 50] [--dry-run]
+"""
+import argparse
+import json
+import math
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import boto3
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, 'lambda_functions'))
+
+import setup_infrastructure as infra
+
+from image_metadata import ITEM_SCHEMA_VERSION, USER_KEY_INDEX, decode_item, encode_item
+
+# Users sampled for the query side of the capacity report
+QUERY_SAMPLE_USERS = 20
+
+def get_table():
+    dynamodb = boto3.resource(
+        'dynamodb',
+        endpoint_url=infra.LOCALSTACK_ENDPOINT,
+        aws_access_key_id='test',
+        aws_secret_access_key='test',
+        region_name=infra.AWS_REGION
+    )
+    return dynamodb.Table(infra.DYNAMODB_TABLE_NAME)
+
+def attribute_size(value):
+    """DynamoDB's billed size of an attribute value"""
+    if isinstance(value, str):
+        return len(value.encode('utf-8'))
+    if isinstance(value, bool) or value is None:
+        return 1
+    if isinstance(value, (int, Decimal)):
+        digits = len(str(abs(value)).replace('.', '').lstrip('0')) or 1
+        return (digits + 1) // 2 + 1
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, (set, frozenset)):
+        return sum(attribute_size(element) for element in value)
+    if isinstance(value, list):
+        return 3 + sum(1 + attribute_size(element) for element in value)
+    if isinstance(value, dict):
+        return 3 + sum(1 + len(key.encode('utf-8')) + attribute_size(element) for key, element in value.items())
+    raise TypeError(f"Unsupported attribute value {value!r}")
+
+def item_size(item):
+    return sum(len(name.encode('utf-8')) + attribute_size(value) for name, value in item.items())
+
+class RateLimiter:
+    """Token bucket shared by the segment threads"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+class ScanCheckpoint:
+    """Per-segment LastEvaluatedKey, persisted as JSON after every page"""
+
+    def __init__(self, path, total_segments):
+        self.path = path
+        self.lock = threading.Lock()
+        self.state = {'segments': total_segments, 'positions': {}}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            if saved.get('segments') != total_segments:
+                raise SystemExit(f"{path} was written with --segments {saved.get('segments')}")
+            self.state = saved
+
+    def position(self, segment):
+        return self.state['positions'].get(str(segment))
+
+    def save(self, segment, last_key):
+        with self.lock:
+            self.state['positions'][str(segment)] = last_key or 'done'
+            if self.path:
+                with open(self.path + '.tmp', 'w') as f:
+                    json.dump(self.state, f)
+                os.replace(self.path + '.tmp', self.path)
+
+def compact_update(item):
+    """
+    update_item arguments that turn a legacy item into encode_item(item),
+    or None when there is nothing to change
+    """
+    if item.get('v') == ITEM_SCHEMA_VERSION:
+        return None
+    compact = encode_item(item)
+    names = {'#v': 'v'}
+    values = {':v': ITEM_SCHEMA_VERSION}
+    conditions = ['attribute_not_exists(#v)']
+    sets = ['#v = :v']
+    removes = []
+    for index, attribute in enumerate(('s3_key', 'updated_at', 'tags')):
+        if attribute not in item:
+            continue
+        names[f'#a{index}'] = attribute
+        values[f':old{index}'] = item[attribute]
+        conditions.append(f'#a{index} = :old{index}')
+        if attribute in compact:
+            if compact[attribute] != item[attribute]:
+                values[f':new{index}'] = compact[attribute]
+                sets.append(f'#a{index} = :new{index}')
+        else:
+            removes.append(f'#a{index}')
+    expression = 'SET ' + ', '.join(sets)
+    if removes:
+        expression += ' REMOVE ' + ', '.join(removes)
+    return {
+        'Key': {'image_id': item['image_id']},
+        'UpdateExpression': expression,
+        'ConditionExpression': ' AND '.join(conditions),
+        'ExpressionAttributeNames': names,
+        'ExpressionAttributeValues': values
+    }
+
+def migrate_segment(segment, total_segments, limiter, checkpoint, dry_run):
+    # boto3 resources are not thread-safe, so each segment gets its own
+    table = get_table()
+    counts = {'scanned': 0, 'migrated': 0, 'skipped': 0}
+    position = checkpoint.position(segment)
+    if position == 'done':
+        return counts
+    scan_kwargs = {'Segment': segment, 'TotalSegments': total_segments}
+    if position:
+        scan_kwargs['ExclusiveStartKey'] = position
+    while True:
+        response = table.scan(**scan_kwargs)
+        for item in response.get('Items', []):
+            counts['scanned'] += 1
+            update = compact_update(item)
+            if update is None:
+                continue
+            if dry_run:
+                counts['migrated'] += 1
+                continue
+            limiter.wait()
+            try:
+                table.update_item(**update)
+                counts['migrated'] += 1
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+                # Changed, deleted or migrated since the scan read it
+                counts['skipped'] += 1
+        if not dry_run:
+            checkpoint.save(segment, response.get('LastEvaluatedKey'))
+        if 'LastEvaluatedKey' not in response:
+            return counts
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def modelled_units(items):
+    """
+    Read units for one eventually consistent scan or query page: DynamoDB sums
+    the item sizes in the page and charges 0.5 RCU per started 4 KB
+    """
+    return math.ceil(sum(item_size(item) for item in items) / 4096) * 0.5
+
+def query_units(table, report, **query_kwargs):
+    """Add the reported and modelled capacity of a full query to the report"""
+    query_kwargs['ReturnConsumedCapacity'] = 'TOTAL'
+    while True:
+        response = table.query(**query_kwargs)
+        report['query_units'] += response.get('ConsumedCapacity', {}).get('CapacityUnits', 0)
+        report['query_modelled'] += modelled_units(response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            return
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def measure(table):
+    """
+    Average item size, and the capacity of a full scan and of per-user
+    queries: as reported by DynamoDB, and as modelled from the item sizes
+    (LocalStack and other emulators report a flat figure per call). A
+    sampled user's queries cover user-id-index and, for a sharded user,
+    each of their user-key-index shards.
+    """
+    sizes = []
+    # Sampled user -> the user_key shards their items were seen under
+    users = {}
+    report = {'scan_units': 0.0, 'scan_modelled': 0.0, 'query_units': 0.0, 'query_modelled': 0.0}
+    scan_kwargs = {'ReturnConsumedCapacity': 'TOTAL'}
+    while True:
+        response = table.scan(**scan_kwargs)
+        items = response.get('Items', [])
+        report['scan_units'] += response.get('ConsumedCapacity', {}).get('CapacityUnits', 0)
+        report['scan_modelled'] += modelled_units(items)
+        for item in items:
+            sizes.append(item_size(item))
+            # Sharded items store user_key instead of user_id
+            user_id = decode_item(item)['user_id']
+            if len(users) < QUERY_SAMPLE_USERS and user_id not in users:
+                users[user_id] = set()
+            if user_id in users and 'user_key' in item:
+                users[user_id].add(item['user_key'])
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    for user_id, user_keys in users.items():
+        query_units(table, report, IndexName='user-id-index', KeyConditionExpression=Key('user_id').eq(user_id))
+        for user_key in sorted(user_keys):
+            query_units(table, report, IndexName=USER_KEY_INDEX, KeyConditionExpression=Key('user_key').eq(user_key))
+
+    report.update(
+        items=len(sizes),
+        average_size=sum(sizes) / len(sizes) if sizes else 0,
+        query_users=len(users)
+    )
+    return report
+
+def print_report(before, after):
+    def line(label, key, unit):
+        old, new = before[key], after[key]
+        change = f" ({(new - old) / old * 100:+.0f}%)" if old else ''
+        print(f"{label:<32} {old:10.1f} -> {new:10.1f} {unit}{change}")
+
+    print("\nSize and capacity report")
+    print("=" * 72)
+    print(f"{'Items':<32} {before['items']:10d} -> {after['items']:10d}")
+    line('Average item size', 'average_size', 'B')
+    line('Full scan, reported', 'scan_units', 'RCU')
+    line('Full scan, modelled', 'scan_modelled', 'RCU')
+    line(f"Queries ({after['query_users']} users), reported", 'query_units', 'RCU')
+    line(f"Queries ({after['query_users']} users), modelled", 'query_modelled', 'RCU')
+
+def main():
+    parser = argparse.ArgumentParser(description='Migrate metadata items to the compact schema')
+    parser.add_argument('--segments', type=int, default=4, help='Parallel scan segments')
+    parser.add_argument('--rate', type=float, default=50, help='Maximum item writes per second')
+    parser.add_argument('--checkpoint', default='migrate_items.json', help='Resume state file')
+    parser.add_argument('--dry-run', action='store_true', help='Count items without writing')
+    parser.add_argument('--skip-report', action='store_true', help='Do not measure before and after')
+    args = parser.parse_args()
+
+    before = None if args.skip_report else measure(get_table())
+
+    started = time.monotonic()
+    checkpoint = ScanCheckpoint(None if args.dry_run else args.checkpoint, args.segments)
+    limiter = RateLimiter(args.rate)
+    with ThreadPoolExecutor(max_workers=args.segments) as executor:
+        results = list(executor.map(
+            lambda segment: migrate_segment(segment, args.segments, limiter, checkpoint, args.dry_run),
+            range(args.segments)
+        ))
+    totals = {key: sum(result[key] for result in results) for key in results[0]}
+    action = 'would migrate' if args.dry_run else 'migrated'
+    print(f"✓ Scanned {totals['scanned']} items, {action} {totals['migrated']}, "
+          f"skipped {totals['skipped']} changed concurrently (re-run to retry), in {time.monotonic() - started:.1f}s")
+
+    if before is not None and not args.dry_run:
+        print_report(before, measure(get_table()))
+    if not args.dry_run and os.path.exists(args.checkpoint):
+        # Finished: a later run starts a fresh scan
+        os.remove(args.checkpoint)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Rebuild the per-user usage counters in the user-stats table from a parallel
+scan of the metadata table. A sharded user's images are counted in the
+counter item of their user_key (image_metadata.usage_key). Counters for
+content types (or users) that no longer have images are reset to zero.
+Uploads and deletes that land while the scan runs can make the result drift
+slightly, so run it in a quiet period.
+
+    python tools/recount_usage.py [--segments 8] [--dry-run]
+"""
+import argparse
+import os
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, 'lambda_functions'))
+
+import setup_infrastructure as infra
+
+from image_metadata import usage_key
+
+def get_dynamodb():
+    return boto3.resource(
+        'dynamodb',
+        endpoint_url=infra.LOCALSTACK_ENDPOINT,
+        aws_access_key_id='test',
+        aws_secret_access_key='test',
+        region_name=infra.AWS_REGION
+    )
+
+def new_usage():
+    return {'image_count': 0, 'total_bytes': 0, 'by_content_type': defaultdict(lambda: [0, 0])}
+
+def scan_segment(segment, total_segments):
+    """Aggregate usage per user for one scan segment"""
+    table = get_dynamodb().Table(infra.DYNAMODB_TABLE_NAME)
+    usage = defaultdict(new_usage)
+    scan_kwargs = {
+        'Segment': segment,
+        'TotalSegments': total_segments,
+        'ProjectionExpression': 'user_id, user_key, file_size, content_type'
+    }
+    while True:
+        response = table.scan(**scan_kwargs)
+        for item in response.get('Items', []):
+            size = int(item.get('file_size', 0))
+            user_usage = usage[usage_key(item)]
+            user_usage['image_count'] += 1
+            user_usage['total_bytes'] += size
+            type_usage = user_usage['by_content_type'][item.get('content_type', 'application/octet-stream')]
+            type_usage[0] += 1
+            type_usage[1] += size
+        if 'LastEvaluatedKey' not in response:
+            return usage
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def merge_usage(results):
+    merged = defaultdict(new_usage)
+    for usage in results:
+        for user_id, user_usage in usage.items():
+            target = merged[user_id]
+            target['image_count'] += user_usage['image_count']
+            target['total_bytes'] += user_usage['total_bytes']
+            for content_type, (count, size) in user_usage['by_content_type'].items():
+                target['by_content_type'][content_type][0] += count
+                target['by_content_type'][content_type][1] += size
+    return merged
+
+def write_usage(stats_table, user_id, user_usage, existing_item):
+    """SET the recounted values, zeroing stale per-type counters; other attributes are kept"""
+    values = {
+        'image_count': user_usage['image_count'],
+        'total_bytes': user_usage['total_bytes']
+    }
+    for attribute in existing_item:
+        if attribute.startswith(('count#', 'bytes#')):
+            values[attribute] = 0
+    for content_type, (count, size) in user_usage['by_content_type'].items():
+        values[f'count#{content_type}'] = count
+        values[f'bytes#{content_type}'] = size
+
+    names = {f'#a{index}': attribute for index, attribute in enumerate(values)}
+    stats_table.update_item(
+        Key={'user_id': user_id},
+        UpdateExpression='SET ' + ', '.join(f'#a{index} = :v{index}' for index in range(len(values))),
+        ExpressionAttributeNames=names,
+        ExpressionAttributeValues={f':v{index}': value for index, value in enumerate(values.values())}
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description='Recount per-user usage counters')
+    parser.add_argument('--segments', type=int, default=8, help='Parallel scan segments')
+    parser.add_argument('--dry-run', action='store_true', help='Print the counts without writing')
+    args = parser.parse_args()
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.segments) as executor:
+        results = list(executor.map(lambda segment: scan_segment(segment, args.segments), range(args.segments)))
+    usage = merge_usage(results)
+
+    stats_table = get_dynamodb().Table(infra.USER_STATS_TABLE_NAME)
+    existing = {}
+    scan_kwargs = {}
+    while True:
+        response = stats_table.scan(**scan_kwargs)
+        for item in response.get('Items', []):
+            existing[item['user_id']] = item
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    # Users with a stats item but no images left are reset to zero
+    for user_id in existing:
+        usage.setdefault(user_id, new_usage())
+
+    changed = 0
+    for user_id, user_usage in sorted(usage.items()):
+        current = existing.get(user_id, {})
+        if (int(current.get('image_count', 0)) != user_usage['image_count']
+                or int(current.get('total_bytes', 0)) != user_usage['total_bytes']):
+            changed += 1
+            print(f"  {user_id}: {int(current.get('image_count', 0))} -> {user_usage['image_count']} images, "
+                  f"{int(current.get('total_bytes', 0))} -> {user_usage['total_bytes']} bytes")
+        if not args.dry_run:
+            write_usage(stats_table, user_id, user_usage, current)
+
+    action = 'would change' if args.dry_run else 'corrected'
+    print(f"✓ Recounted {len(usage)} users ({action} {changed}) in {time.monotonic() - started:.1f}s")
+
+if __name__ == "__main__":
+    main()
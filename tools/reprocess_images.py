@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Queue post-upload processing for images that have not been through a
+processor yet, e.g. after a new one is added to process_images.py. The
+worker only runs processors missing from an item's `processed` set, so
+re-queued images are not reprocessed otherwise. Safe to re-run.
+
+    python tools/reprocess_images.py --processor phash [--segments 8] [--dry-run]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, 'lambda_functions'))
+
+import setup_infrastructure as infra
+
+from image_metadata import decode_item, processing_job
+from process_images import PROCESSORS
+
+SQS_BATCH_SIZE = 10
+
+def get_session():
+    return boto3.session.Session(
+        aws_access_key_id='test',
+        aws_secret_access_key='test',
+        region_name=infra.AWS_REGION
+    )
+
+def reprocess_segment(segment, total_segments, processor_name, queue_url, dry_run):
+    # boto3 resources are not thread-safe, so each segment gets its own
+    session = get_session()
+    table = session.resource('dynamodb', endpoint_url=infra.LOCALSTACK_ENDPOINT).Table(infra.DYNAMODB_TABLE_NAME)
+    sqs_client = session.client('sqs', endpoint_url=infra.LOCALSTACK_ENDPOINT)
+    scanned = queued = 0
+    scan_kwargs = {
+        'Segment': segment,
+        'TotalSegments': total_segments,
+        'ProjectionExpression': 'image_id, user_id, user_key, s3_key, filename',
+        'FilterExpression': 'NOT contains(#processed, :name)',
+        'ExpressionAttributeNames': {'#processed': 'processed'},
+        'ExpressionAttributeValues': {':name': processor_name}
+    }
+    while True:
+        response = table.scan(**scan_kwargs)
+        scanned += response.get('ScannedCount', 0)
+        items = [decode_item(item) for item in response.get('Items', [])]
+        for start in range(0, len(items), SQS_BATCH_SIZE):
+            chunk = items[start:start + SQS_BATCH_SIZE]
+            failed = []
+            if not dry_run:
+                result = sqs_client.send_message_batch(
+                    QueueUrl=queue_url,
+                    Entries=[
+                        {'Id': str(index), 'MessageBody': json.dumps(processing_job(item))}
+                        for index, item in enumerate(chunk)
+                    ]
+                )
+                failed = result.get('Failed', [])
+                for failure in failed:
+                    print(f"Warning: Failed to queue {chunk[int(failure['Id'])]['image_id']}: {failure.get('Message')}")
+            queued += len(chunk) - len(failed)
+        if 'LastEvaluatedKey' not in response:
+            return scanned, queued
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def main():
+    parser = argparse.ArgumentParser(description='Queue images for a post-upload processor')
+    parser.add_argument('--processor', required=True, choices=[name for name, _ in PROCESSORS])
+    parser.add_argument('--segments', type=int, default=8, help='Parallel scan segments')
+    parser.add_argument('--dry-run', action='store_true', help='Count images without queueing')
+    args = parser.parse_args()
+
+    queue_url = None
+    if not args.dry_run:
+        sqs_client = get_session().client('sqs', endpoint_url=infra.LOCALSTACK_ENDPOINT)
+        queue_url = sqs_client.get_queue_url(QueueName=infra.PROCESSING_QUEUE_NAME)['QueueUrl']
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.segments) as executor:
+        results = list(executor.map(
+            lambda segment: reprocess_segment(segment, args.segments, args.processor, queue_url, args.dry_run),
+            range(args.segments)
+        ))
+    scanned = sum(result[0] for result in results)
+    queued = sum(result[1] for result in results)
+    action = 'would queue' if args.dry_run else 'queued'
+    print(f"✓ Scanned {scanned} items, {action} {queued} for '{args.processor}' in {time.monotonic() - started:.1f}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Turn on (or raise) write sharding for a heavy uploader. New images of the
+user are spread over --shards partitions of user-key-index, and their usage
+counters over as many user-stats items; existing images stay where they are
+and listings merge both, so this is safe online. Running upload functions
+pick up a raised count within SHARDED_USER_TTL seconds. The shard count can
+only be raised.
+
+    python tools/shard_user.py --user-id bigtenant --shards 8
+"""
+import argparse
+import os
+import sys
+
+import boto3
+from botocore.exceptions import ClientError
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, 'lambda_functions'))
+
+import setup_infrastructure as infra
+from image_metadata import user_id_error
+
+def main():
+    parser = argparse.ArgumentParser(description='Set the write-shard count for a user')
+    parser.add_argument('--user-id', required=True)
+    parser.add_argument('--shards', type=int, required=True, help='New shard count (2 or more)')
+    args = parser.parse_args()
+    if args.shards < 2:
+        parser.error('--shards must be at least 2')
+    if user_id_error(args.user_id):
+        parser.error(user_id_error(args.user_id))
+
+    dynamodb = boto3.resource(
+        'dynamodb',
+        endpoint_url=infra.LOCALSTACK_ENDPOINT,
+        aws_access_key_id='test',
+        aws_secret_access_key='test',
+        region_name=infra.AWS_REGION
+    )
+    stats_table = dynamodb.Table(infra.USER_STATS_TABLE_NAME)
+    try:
+        stats_table.update_item(
+            Key={'user_id': args.user_id},
+            UpdateExpression='SET key_shards = :shards',
+            ConditionExpression='attribute_not_exists(key_shards) OR key_shards < :shards',
+            ExpressionAttributeValues={':shards': args.shards}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        current = stats_table.get_item(Key={'user_id': args.user_id})['Item']['key_shards']
+        print(f"❌ {args.user_id} already has {current} shards; the count can only be raised")
+        return 1
+    print(f"✓ New images of {args.user_id} are now spread over {args.shards} shards")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())